@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Classify a synthetic corpus of product names built from the seed
+configs of msrptw.database.config, part by part substring checks (the
+former Directory.classify_product_auto) against ConfigMatcher.
+
+    $ python -m benchmarks.classify --names 1000000
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import time
+import random
+import tempfile
+from argparse import ArgumentParser
+from sqlalchemy.orm import subqueryload
+from msrptw.database import config
+from msrptw.database.config import session_scope
+from msrptw.database.model import Config, Part
+from msrptw.matcher import ConfigMatcher
+
+FILLERS = ['臺灣', '履歷', '產銷', '特選', '(冷藏)', '約', '500g', '1kg', '3入', '/盒', '-', '新鮮', '進口']
+
+
+def classify_by_parts(config, name):
+    alias_id = None
+    for part in config.parts:
+        find = part.name in name
+        for alias in part.aliases:
+            if alias.name in name and not alias.anti:
+                alias_id = alias.id
+                find = True
+        for alias in part.aliases:
+            if alias.name in name and alias.anti:
+                find = False
+        if find:
+            return part, alias_id
+    return None, alias_id
+
+
+def corpus(configs, size, seed=0):
+    rng = random.Random(seed)
+    tokens = dict((c, [p.name for p in c.parts] + [a.name for p in c.parts for a in p.aliases]) for c in configs)
+    for _ in range(size):
+        c = rng.choice(configs)
+        words = [rng.choice(FILLERS) for _ in range(rng.randint(0, 3))]
+        words += [rng.choice(tokens[c]) for _ in range(rng.randint(1, 2))]
+        rng.shuffle(words)
+        yield c, ''.join(words)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--names', type=int, default=1000000)
+    args = parser.parse_args()
+
+    config.setup_session('sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    config.init()
+    with session_scope() as session:
+        configs = session.query(Config).options(
+            subqueryload(Config.parts).subqueryload(Part.aliases)
+        ).all()
+        session.expunge_all()
+
+    names = list(corpus(configs, args.names))
+    print('%d names, %d configs, %d parts, %d aliases' % (
+        len(names), len(configs), sum(len(c.parts) for c in configs),
+        sum(len(p.aliases) for c in configs for p in c.parts)))
+
+    start = time.time()
+    expected = [classify_by_parts(c, name) for c, name in names]
+    elapsed = time.time() - start
+    print('%-10s %8.2fs %10.0f names/s' % ('part loop', elapsed, len(names) / elapsed))
+
+    start = time.time()
+    matchers = dict((c, ConfigMatcher(c)) for c in configs)
+    results = [matchers[c].classify(name) for c, name in names]
+    elapsed = time.time() - start
+    print('%-10s %8.2fs %10.0f names/s' % ('automaton', elapsed, len(names) / elapsed))
+
+    assert results == expected, 'automaton and part loop disagree'
+
+
+if __name__ == '__main__':
+    main()
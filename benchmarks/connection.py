@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare module level requests.get against the pooled sessions of
+msrptw.connection on a local keep-alive HTTP server.
+
+    $ python -m benchmarks.connection --requests 2000 --threads 8
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+import time
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from msrptw import connection
+
+BODY = ('<html><body>%s</body></html>' % ('<div class="item-name">紅蘿蔔</div>' * 200)).encode('utf-8')
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    connections = 0
+
+    def get_request(self):
+        self.connections += 1
+        return ThreadingHTTPServer.get_request(self)
+
+
+def run(name, fetch, url, total, threads, server):
+    server.connections = 0
+    start = time.time()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(lambda _: fetch(url).content, range(total)))
+    elapsed = time.time() - start
+    print('%-12s %6d requests %6d connections %8.2fs %8.0f req/s' % (
+        name, total, server.connections, elapsed, total / elapsed))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    server = CountingServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%s/product/view/POOYb' % server.server_address[1]
+
+    connection.configure(pool_size=args.threads)
+    run('requests.get', requests.get, url, args.requests, args.threads, server)
+    run('connection', connection.get, url, args.requests, args.threads, server)
+
+    connection.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Weight, count, origin and unit of the product titles and specs in
+benchmarks/fixtures, the regex callback and linear table scans of the
+former Directory helpers against the compiled Extractor, with and
+without its memo. Every result is checked against the former helpers.
+
+    $ python -m benchmarks.extract --rounds 200
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import re
+import json
+import time
+import tempfile
+from argparse import ArgumentParser
+from lxml import html
+from msrptw.database import config
+from msrptw.database.cache import references
+from msrptw.directory import Directory
+from msrptw.extract import Extractor
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+GLOBAL_REPLACE_RE = re.compile('''
+    [ 　台]
+    |
+    [０-９]
+''', re.X)
+
+
+def legacy_normalize(s):
+
+    def replace(m):
+        return Directory.TO_REPLACE_MAP.get(m.group(), '')
+
+    return GLOBAL_REPLACE_RE.sub(replace, s).lower()
+
+
+def legacy_count(s):
+    s = legacy_normalize(s)
+    counts = Directory.MULTI_RE.findall(s)
+    if counts:
+        return int(''.join([c for c in counts[0] if c.isalnum()]))
+    return 1
+
+
+def legacy_weight(s):
+    s = legacy_normalize(s)
+    try:
+        token = Directory.UNIT_RE.findall(s)[0]
+        for index, multiplier in Directory.UNIT_MAP.values():
+            if token[index]:
+                return float(token[index]) * multiplier
+    except IndexError:
+        return None
+
+
+def legacy_origin(s):
+    s = legacy_normalize(s)
+    for key in Directory.ORIGIN_MAP.keys():
+        if key in s:
+            return Directory.ORIGIN_MAP[key]
+    return ''
+
+
+def legacy_unit(units, s):
+    for unit in units:
+        if unit.name in s:
+            return unit
+    return None
+
+
+def titles():
+    """(name, spec) pairs of every market fixture"""
+    pairs = []
+    with open(os.path.join(FIXTURES, 'honestbee.json'), 'rb') as f:
+        pairs += [(p['title'], p.get('size') or '') for p in json.loads(f.read().decode('utf-8'))['products']]
+    with open(os.path.join(FIXTURES, 'carrefour.json'), 'rb') as f:
+        pairs += [(p['Name'], '') for p in json.loads(f.read().decode('utf-8'))['content']['ProductListModel']]
+    with open(os.path.join(FIXTURES, 'geant.json'), 'rb') as f:
+        items = json.loads(f.read().decode('utf-8'))['pageModel']['contentBlock']['itemList'][0]
+        pairs += [(p['productName'], p.get('descSpecification') or '') for p in items['bottomCategoryProducts']]
+    for name, xpath in (('wellcome.html', '//div[@class="product-name"]/text()'),
+                        ('fengkang.html', '//div[@class="vw"]/div[@class="tt21"]/text()'),
+                        ('rtmart.html', '//h2[@class="product_Titlename"]/span/text()')):
+        with open(os.path.join(FIXTURES, name), 'rb') as f:
+            pairs += [(''.join(html.fromstring(f.read()).xpath(xpath)).strip(), '')]
+    return pairs
+
+
+def run(pairs, rounds, weight, count, origin, unit):
+    start = time.time()
+    for _ in range(rounds):
+        for name, spec in pairs:
+            weight(spec or name)
+            count(name)
+            origin(name)
+            unit(name + spec)
+    return time.time() - start
+
+
+def report(name, total, elapsed):
+    print('%-10s %8d strings %8.3fs %8.3fus per string' % (name, total, elapsed, elapsed * 1e6 / total))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    config.setup_session('sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    config.init()
+    units = references.units()
+    pairs = titles()
+
+    extractor = Directory.extractor()
+    for name, spec in pairs:
+        for s in (name, spec, name + spec):
+            assert extractor.weight(s) == legacy_weight(s), s
+            assert int(extractor.multi(s) or 1) == legacy_count(s), s
+            assert extractor.origin(s) == legacy_origin(s), s
+            assert extractor.unit(s) == legacy_unit(units, s), s
+
+    total = len(pairs) * args.rounds * 4
+    report('legacy', total, run(pairs, args.rounds, legacy_weight, legacy_count, legacy_origin,
+                                lambda s: legacy_unit(units, s)))
+
+    for name, memo_size in (('compiled', 0), ('memoized', 8192)):
+        extractor = Extractor(Directory.TO_REPLACE_MAP, Directory.TO_DELETE, Directory.ORIGIN_MAP, units,
+                              Directory.UNIT_RE, Directory.MULTI_RE, memo_size=memo_size)
+        report(name, total, run(pairs, args.rounds, extractor.weight, extractor.multi,
+                                extractor.origin, extractor.unit))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Rows stored and write time of a simulated price history, one Price row
+a day against the change-only PriceInterval rows of the writer. The
+daily series of msrptw.query and msrptw.report are checked to be the
+same in both modes. The database is re-initialized, do not point it at
+production.
+
+    $ python -m benchmarks.intervals --products 2000 --days 60 --change 0.05
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import time
+import random
+import datetime
+import tempfile
+from argparse import ArgumentParser
+from msrptw.database import config
+from msrptw.database.config import session_scope
+from msrptw.database.model import Market, Part, Product, Price, PriceInterval
+from msrptw.writer import Writer
+from msrptw import query, report
+
+
+def seed(total):
+    with session_scope() as session:
+        market = session.query(Market).first()
+        part = session.query(Part).filter(Part.name == '紅蘿蔔').first()
+        session.bulk_insert_mappings(Product, [
+            {'name': '紅蘿蔔%s' % i, 'pid': str(i), 'market_id': market.id, 'part_id': part.id, 'weight': 600,
+             'count': 1} for i in range(total)
+        ])
+    with session_scope() as session:
+        return [id for id, in session.query(Product.id)]
+
+
+def history(product_ids, days, change):
+    """(date, product_id, price) of every day, a price changes with the
+    given probability a day and some days a product is missing"""
+    random.seed(0)
+    prices = dict((id, random.randint(20, 200)) for id in product_ids)
+    start = datetime.date.today() - datetime.timedelta(days=days - 1)
+    for i in range(days):
+        date = start + datetime.timedelta(days=i)
+        for id in product_ids:
+            if random.random() < change:
+                prices[id] = random.randint(20, 200)
+            if random.random() < 0.02:
+                continue
+            yield date, id, prices[id]
+
+
+def write(writer, rows):
+    start = time.time()
+    for date, product_id, price in rows:
+        writer.put_price(product_id, date, price)
+    writer.close()
+    return time.time() - start
+
+
+def count(model):
+    with session_scope() as session:
+        return session.query(model).count()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--dbpath', help='sql connection here, default to a temporary sqlite file.')
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--change', help='probability of a price change a day.', type=float, default=0.05)
+    args = parser.parse_args()
+
+    db_path = args.dbpath
+    if not db_path:
+        db_path = 'sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    config.setup_session(db_path)
+    config.init()
+    product_ids = seed(args.products)
+    rows = list(history(product_ids, args.days, args.change))
+    start, end = rows[0][0], rows[-1][0]
+
+    for name, intervals, model in (('daily', False, Price), ('intervals', True, PriceInterval)):
+        elapsed = write(Writer(intervals=intervals), rows)
+        print('%-10s %8d prices %8d rows %8.3fs' % (name, len(rows), count(model), elapsed))
+
+        with session_scope() as session:
+            series = query.price_series(session, '紅蘿蔔', start, end)
+            frame = report.load(session, start, end, part_name='紅蘿蔔')
+        if intervals:
+            # the same days, the ones a product was missing included
+            assert series == daily_series
+            assert len(frame) == len(rows)
+        else:
+            daily_series = series
+            assert len(frame) == len(rows)
+            # read the intervals alone next
+            with session_scope() as session:
+                session.query(Price).delete()
+
+
+if __name__ == '__main__':
+    main()
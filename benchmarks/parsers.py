@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Per page parsing cost of every market class over the stored pages in
+benchmarks/fixtures, no network. Each phase is timed on its own:
+
+    parse   lxml.html.fromstring / json.loads of the raw response
+    xpath   XPATH_MAP extraction (detail page of CarrfourBrowser)
+    fields  get_weight, get_count, get_unit and get_origin on the strings
+    build   Product and Price construction
+    total   parse_product_price / parse_products_prices from raw bytes
+
+and the peak Python heap traced while parsing one page (lxml's own C
+allocations are not traced). Results are written to
+benchmarks/results/parsers-<commit>.json, compare two runs with --compare.
+
+    $ python -m benchmarks.parsers --pages 300
+    $ python -m benchmarks.parsers --compare benchmarks/results/parsers-1234abc.json
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import io
+import sys
+import json
+import time
+import datetime
+import tempfile
+import subprocess
+import tracemalloc
+from argparse import ArgumentParser
+from lxml import html
+from msrptw.database import config
+from msrptw.database.model import Product, Price
+from msrptw.directory import Directory
+from msrptw import marketbrowser, marketapi
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(ROOT, 'fixtures')
+RESULTS = os.path.join(ROOT, 'results')
+
+BROWSERS = [
+    (marketbrowser.WellcomeBrowser, 'wellcome.html', 'https://sbd-ec.wellcome.com.tw/product/view/POOYb'),
+    (marketbrowser.FengKangBrowser, 'fengkang.html', 'http://shop.supermarket.com.tw/Shop-p-6738.html'),
+    (marketbrowser.RtmartBrowser, 'rtmart.html',
+     'http://www.rt-mart.com.tw/direct/index.php?action=product_detail&prod_no=P0000200612345'),
+]
+
+APIS = [
+    (marketapi.CarrfourBrowser, 'carrefour.json'),
+    (marketapi.Rtmart, 'honestbee.json'),
+    (marketapi.Carrefour, 'honestbee.json'),
+    (marketapi.BinJung, 'honestbee.json'),
+    (marketapi.NewTaipeiCenter, 'honestbee.json'),
+    (marketapi.Geant, 'geant.json'),
+]
+
+# strings of an api item the market parses with the Directory helpers
+API_FIELDS = {
+    'CarrfourBrowser': ('Name', ),
+    'HonestBee': ('title', 'size'),
+    'Geant': ('productName', 'descSpecification'),
+}
+
+
+def fixture(name):
+    with io.open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+def timed(func, pages):
+    start = time.time()
+    for _ in range(pages):
+        func()
+    elapsed = time.time() - start
+    return {'ms_per_page': elapsed * 1000 / pages, 'pages_per_sec': pages / elapsed}
+
+
+def peak_kib(func):
+    func()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024.0
+
+
+def fields(market, strings):
+    for s in strings:
+        market.get_weight(s)
+        market.get_count(s)
+        market.get_unit(s)
+        market.get_origin(s)
+
+
+def build(market):
+    product = Product(source='', name='紅蘿蔔', market_id=market.market.id, pid='1',
+                      origin_id=1, weight=500, count=1, unit_id=None)
+    price = Price(price=35, date=market.date)
+    return product, price
+
+
+def bench_browser(market_class, name, url, pages):
+    market = market_class()
+    content = fixture(name)
+    page = html.fromstring(content)
+    strings = [Directory.flat_xpath(page, xpath) for xpath in market.XPATH_MAP.values()]
+
+    product, price = market.parse_product_price(url, page)
+    assert product and price, '%s fixture does not parse' % name
+
+    def total():
+        return market.parse_product_price(url, html.fromstring(content))
+
+    return {
+        'parse': timed(lambda: html.fromstring(content), pages),
+        'xpath': timed(lambda: [Directory.flat_xpath(page, x) for x in market.XPATH_MAP.values()], pages),
+        'fields': timed(lambda: fields(market, strings), pages),
+        'build': timed(lambda: build(market), pages),
+        'total': timed(total, pages),
+        'peak_kib': peak_kib(total),
+        'items': 1,
+    }
+
+
+def bench_api(market_class, name, pages):
+    market = market_class()
+    content = fixture(name)
+
+    def items():
+        dic = json.loads(content.decode('utf-8'))
+        for key in market.PRODUCTS_PATH:
+            dic = dic[key]
+        return dic
+
+    dics = items()
+    keys = [v for k, v in API_FIELDS.items() if isinstance(market, getattr(marketapi, k))][0]
+    strings = [d.get(key) or '' for d in dics for key in keys]
+
+    if isinstance(market, marketapi.CarrfourBrowser):
+        detail = fixture('carrefour_detail.html')
+        infos = market.parse_infos(html.fromstring(detail))
+
+        def extract():
+            return market.parse_infos(html.fromstring(detail))
+
+        def total():
+            return [market.parse_product_price(d, infos) for d in items()]
+    else:
+        extract = None
+
+        def total():
+            return market.parse_products_prices(items())
+
+    assert any(product for product, _ in total()), '%s fixture does not parse' % name
+
+    results = {
+        'parse': timed(lambda: json.loads(content.decode('utf-8')), pages),
+        'fields': timed(lambda: fields(market, strings), pages),
+        'build': timed(lambda: [build(market) for _ in dics], pages),
+        'total': timed(total, pages),
+        'peak_kib': peak_kib(total),
+        'items': len(dics),
+    }
+    if extract:
+        # one detail page per listed item
+        results['xpath'] = timed(extract, pages)
+    return results
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode().strip()
+    except Exception:
+        return 'unknown'
+
+
+def report(results, previous=None):
+    phases = ['parse', 'xpath', 'fields', 'build', 'total']
+    print('%-16s' % 'pages/sec' + ''.join('%12s' % p for p in phases) + '%12s%8s' % ('peak KiB', 'items'))
+    for name, result in sorted(results.items()):
+        row = '%-16s' % name
+        for phase in phases:
+            value = result.get(phase, {}).get('pages_per_sec')
+            cell = '%.0f' % value if value else '-'
+            if value and previous and phase in previous.get(name, {}):
+                cell += ' %+.0f%%' % ((value / previous[name][phase]['pages_per_sec'] - 1) * 100)
+            row += '%12s' % cell
+        row += '%12.1f%8d' % (result['peak_kib'], result['items'])
+        print(row)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--pages', type=int, default=200, help='pages parsed per phase.')
+    parser.add_argument('--compare', help='results file of an earlier run.')
+    parser.add_argument('--output', help='results file, default to benchmarks/results/parsers-<commit>.json.')
+    args = parser.parse_args()
+
+    config.setup_session('sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    config.init()
+
+    results = {}
+    for market_class, name, url in BROWSERS:
+        results[market_class.__name__] = bench_browser(market_class, name, url, args.pages)
+    for market_class, name in APIS:
+        results[market_class.__name__] = bench_api(market_class, name, args.pages)
+
+    previous = None
+    if args.compare:
+        with io.open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)['results']
+    report(results, previous)
+
+    output = args.output or os.path.join(RESULTS, 'parsers-%s.json' % commit())
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with io.open(output, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({
+            'commit': commit(),
+            'date': datetime.datetime.now().isoformat(),
+            'python': sys.version.split()[0],
+            'pages': args.pages,
+            'results': results,
+        }, indent=1))
+    print('saved %s' % output)
+
+
+if __name__ == '__main__':
+    main()
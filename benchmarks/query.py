@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""msrptw.query on a synthetic database of millions of prices, with the
+part and date indexes and without them (as before --migrate). The
+database is re-initialized, do not point it at production.
+
+    $ python -m benchmarks.query --products 5000 --days 400
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import time
+import random
+import datetime
+import tempfile
+from argparse import ArgumentParser
+from msrptw.database import config
+from msrptw.database.config import session_scope
+from msrptw.database.model import Market, Part, Product, Price
+from msrptw import query
+
+INDEXES = ['ix_product_part_market', 'ix_price_date_product']
+
+
+def seed(products, days):
+    random.seed(0)
+    today = datetime.date.today()
+    with session_scope() as session:
+        market_ids = [id for id, in session.query(Market.id)]
+        part_ids = [id for id, in session.query(Part.id)]
+        session.bulk_insert_mappings(Product, [{
+            'name': '商品%s' % i,
+            'pid': str(i),
+            'market_id': market_ids[i % len(market_ids)],
+            'part_id': part_ids[i % len(part_ids)],
+            'weight': random.choice([None, 200, 300, 600, 1000]),
+            'count': 1,
+        } for i in range(products)])
+    with session_scope() as session:
+        product_ids = [id for id, in session.query(Product.id)]
+    with config.engine.begin() as connection:
+        for i in range(days):
+            date = today - datetime.timedelta(days=i)
+            connection.execute(Price.__table__.insert(), [
+                {'product_id': id, 'date': date, 'price': random.randint(10, 500)} for id in product_ids
+            ])
+    return len(product_ids) * days
+
+
+def run(name, rounds, today):
+    with session_scope() as session:
+        parts = [name for name, in session.query(Part.name)]
+        for label, func in (
+            ('latest', lambda part: query.latest_prices(session, part, today)),
+            ('series 90d', lambda part: query.price_series(session, part, today - datetime.timedelta(days=89), today)),
+        ):
+            start = time.time()
+            rows = 0
+            for i in range(rounds):
+                rows += len(func(parts[i % len(parts)]))
+            elapsed = time.time() - start
+            print('%-16s %-10s %8.2fms per query %8d rows' % (name, label, elapsed * 1000 / rounds, rows // rounds))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--dbpath', help='sql connection here, default to a temporary sqlite file.')
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--days', type=int, default=400)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    db_path = args.dbpath
+    if not db_path:
+        db_path = 'sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    config.setup_session(db_path)
+    config.init()
+    start = time.time()
+    total = seed(args.products, args.days)
+    print('seeded %s prices in %.1fs' % (total, time.time() - start))
+    today = datetime.date.today()
+
+    run('indexed', args.rounds, today)
+    for table in (Product.__table__, Price.__table__):
+        for index in list(table.indexes):
+            if index.name in INDEXES:
+                index.drop(config.engine)
+    run('without indexes', args.rounds, today)
+
+
+if __name__ == '__main__':
+    main()
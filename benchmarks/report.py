@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Ranking table of a year of prices, row by row over ORM objects (the
+former ad-hoc scripts) against the single query and column arithmetic
+of msrptw.report. The database is re-initialized, do not point it at
+production.
+
+    $ python -m benchmarks.report --products 2000 --days 365
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+import os
+import time
+import random
+import datetime
+import tempfile
+from argparse import ArgumentParser
+from msrptw.database import config
+from msrptw.database.config import session_scope
+from msrptw.database.model import Market, Part, Product, Price
+from msrptw import report
+
+
+def seed(products, days):
+    random.seed(0)
+    end = datetime.date.today()
+    dates = [end - datetime.timedelta(days=i) for i in range(days)]
+    with session_scope() as session:
+        market_ids = [id for id, in session.query(Market.id)]
+        part_ids = [id for id, in session.query(Part.id)]
+        session.bulk_insert_mappings(Product, [{
+            'name': '商品%s' % i,
+            'pid': str(i),
+            'market_id': market_ids[i % len(market_ids)],
+            'part_id': part_ids[i % len(part_ids)],
+            # some without weight
+            'weight': random.choice([None, 200, 300, 600, 1000]),
+            'count': random.choice([1, 1, 1, 2, 3]),
+        } for i in range(products)])
+    with session_scope() as session:
+        product_ids = [id for id, in session.query(Product.id)]
+    with config.engine.begin() as connection:
+        for date in dates:
+            connection.execute(Price.__table__.insert(), [
+                {'product_id': id, 'date': date, 'price': random.randint(10, 500)} for id in product_ids
+            ])
+    return dates[-1], end
+
+
+def row_by_row(session, start, end):
+    rows = []
+    for price in session.query(Price).filter(Price.date >= start).filter(Price.date <= end):
+        product = price.product
+        if product.part is None:
+            continue
+        count = product.count or 1
+        grams = product.weight * count if product.weight else None
+        rows.append({
+            'date': price.date,
+            'config': product.part.config.name,
+            'part': product.part.name,
+            'market': product.market.name,
+            'name': product.name,
+            'price': price.price,
+            'unit_price': round(price.price / count, 2),
+            'grams': grams,
+            'per_kg': round(price.price * 1000 / grams, 2) if grams else None,
+        })
+    groups = {}
+    for row in rows:
+        groups.setdefault((row['date'], row['config'], row['part']), []).append(row)
+    for group in groups.values():
+        group.sort(key=lambda r: (r['per_kg'] is None, r['per_kg'] or r['unit_price']))
+        for i, row in enumerate(group):
+            row['rank'] = i + 1
+    return rows
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--dbpath', help='sql connection here, default to a temporary sqlite file.')
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--legacy-days', help='days of the row by row run, it is slow.', type=int, default=7)
+    args = parser.parse_args()
+
+    db_path = args.dbpath
+    if not db_path:
+        db_path = 'sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    config.setup_session(db_path)
+    config.init()
+    start, end = seed(args.products, args.days)
+    legacy_start = end - datetime.timedelta(days=args.legacy_days - 1)
+
+    with session_scope() as session:
+        t = time.time()
+        rows = row_by_row(session, legacy_start, end)
+        elapsed = time.time() - t
+    print('%-10s %8d prices %8.3fs %8.3fs per 100k' % ('row by row', len(rows), elapsed, elapsed * 1e5 / len(rows)))
+
+    for start_date in (legacy_start, start):
+        with session_scope() as session:
+            t = time.time()
+            frame = report.load(session, start_date, end)
+            loaded = time.time() - t
+            frame = report.compute(frame)
+            elapsed = time.time() - t
+        print('%-10s %8d prices %8.3fs %8.3fs per 100k (query %.3fs)' % (
+            'report', len(frame), elapsed, elapsed * 1e5 / len(frame), loaded))
+
+
+if __name__ == '__main__':
+    main()
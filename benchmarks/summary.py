@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Daily statistics of a part by market over 90 days, aggregated from the
+price table on every request against the rows of daily_part_summary, and
+the time to update one market and day after its run. The database is
+re-initialized, do not point it at production.
+
+    $ python -m benchmarks.summary --products 5000 --days 400
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import time
+import datetime
+import tempfile
+from argparse import ArgumentParser
+from sqlalchemy import func
+from msrptw.database import config
+from msrptw.database.config import session_scope
+from msrptw.database.model import Market, Part, Product, Price
+from msrptw import query, summary
+from benchmarks.query import seed
+
+
+def aggregate(session, part, start, end):
+    # what a dashboard ran before, min/max/mean only
+    return session.query(
+        Price.date, Market.name, func.count(Price.id), func.min(Price.price), func.max(Price.price),
+        func.avg(Price.price)
+    ).join(
+        Product, Price.product_id == Product.id
+    ).join(
+        Part, Product.part_id == Part.id
+    ).join(
+        Market, Product.market_id == Market.id
+    ).filter(
+        Part.name == part
+    ).filter(
+        Price.date >= start
+    ).filter(
+        Price.date <= end
+    ).group_by(Price.date, Market.name).order_by(Price.date, Market.name).all()
+
+
+def timed(label, func, rounds):
+    start = time.time()
+    for _ in range(rounds):
+        rows = func()
+    print('%-22s %8.2fms %6d rows' % (label, (time.time() - start) * 1000 / rounds, len(rows)))
+    return rows
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--dbpath', help='sql connection here, default to a temporary sqlite file.')
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--days', type=int, default=400)
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+
+    db_path = args.dbpath
+    if not db_path:
+        db_path = 'sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    config.setup_session(db_path)
+    config.init()
+    print('seeded %s prices' % seed(args.products, args.days))
+    end = datetime.date.today()
+    start = end - datetime.timedelta(days=89)
+
+    with session_scope() as session:
+        t = time.time()
+        summary.rebuild(session, end - datetime.timedelta(days=args.days - 1), end)
+        print('rebuild %s days %.1fs' % (args.days, time.time() - t))
+        market_id = session.query(Market.id).first()[0]
+        timed('update market and day', lambda: [summary.update(session, end, market_id)], args.rounds)
+
+        aggregated = timed('aggregate prices', lambda: aggregate(session, '紅蘿蔔', start, end), args.rounds)
+        summarized = timed('read summary', lambda: query.part_summary(session, '紅蘿蔔', start, end), args.rounds)
+        for a, s in zip(aggregated, summarized):
+            assert a[:5] == (s[0], s[1], s[2], s[3], s[5]), (a, s)
+
+
+if __name__ == '__main__':
+    main()
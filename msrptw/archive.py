@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+import json
+import mmap
+import zlib
+import struct
+import datetime
+import threading
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+from .httpcache import HttpCache, tee
+
+
+class Archive(object):
+    """Append-only file of every raw response of a run, records are
+    (meta json, zlib body) pairs and an index of request key => record
+    is written at close. A run that crashed leaves no index, replay then
+    rebuilds it from the record headers
+
+    layout: MAGIC, header, records..., index record, index offset, END"""
+
+    MAGIC = b'MSRPTWA1'
+    END = b'MSRPTWA.'
+    SIZES = struct.Struct('>II')
+    OFFSET = struct.Struct('>Q')
+
+    @staticmethod
+    def key(method, url, params=None, headers=None):
+        return method + ':' + HttpCache.key(url, params, headers)
+
+
+class ArchiveRecorder(Archive):
+
+    def __init__(self, path, date=None):
+        self.path = path
+        self.index = {}
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._file.write(self.MAGIC)
+        date = date or datetime.date.today()
+        self.write_record({'date': date.isoformat()}, b'')
+
+    def write_record(self, meta, body):
+        meta_bytes = json.dumps(meta).encode('utf-8')
+        self._file.write(self.SIZES.pack(len(meta_bytes), len(body)))
+        self._file.write(meta_bytes)
+        offset = self._file.tell()
+        self._file.write(body)
+        return offset
+
+    def add(self, method, url, params, headers, response, stream=False):
+        """a streamed response is recorded once the caller has read its body
+        to the end, compressed chunk by chunk meanwhile"""
+        key = self.key(method, url, params, headers)
+        meta = {
+            'key': key,
+            'url': response.url,
+            'status': response.status_code,
+            'encoding': response.encoding,
+            'headers': dict(response.headers),
+        }
+        if not stream:
+            self.write(key, meta, zlib.compress(response.content))
+            return
+
+        compressor = zlib.compressobj()
+        body = []
+
+        def write(chunk):
+            body.append(compressor.compress(chunk))
+
+        def done(complete):
+            if complete:
+                body.append(compressor.flush())
+                self.write(key, meta, b''.join(body))
+
+        tee(response, write, done)
+
+    def write(self, key, meta, body):
+        with self._lock:
+            if self._file.closed:
+                return
+            offset = self.write_record(meta, body)
+            self.index[key] = (meta, offset, len(body))
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            index = zlib.compress(json.dumps(self.index).encode('utf-8'))
+            offset = self._file.tell()
+            self._file.write(self.SIZES.pack(0, len(index)))
+            self._file.write(index)
+            self._file.write(self.OFFSET.pack(offset))
+            self._file.write(self.END)
+            self._file.close()
+
+
+class ArchiveReader(Archive):
+    """memory-mapped archive, hands recorded responses back in place of
+    the network"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._map[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError('%s is not a response archive' % path)
+
+        meta, _, _, position = self.read_record(len(self.MAGIC))
+        self.date = datetime.datetime.strptime(meta['date'], '%Y-%m-%d').date()
+
+        if self._map[-len(self.END):] == self.END:
+            offset, = self.OFFSET.unpack_from(self._map, len(self._map) - len(self.END) - self.OFFSET.size)
+            _, index_length = self.SIZES.unpack_from(self._map, offset)
+            start = offset + self.SIZES.size
+            index = json.loads(zlib.decompress(self._map[start:start + index_length]).decode('utf-8'))
+            self.index = dict((key, tuple(value)) for key, value in index.items())
+        else:
+            self.index = self.scan(position)
+
+    def read_record(self, position):
+        meta_length, body_length = self.SIZES.unpack_from(self._map, position)
+        start = position + self.SIZES.size
+        meta = json.loads(self._map[start:start + meta_length].decode('utf-8')) if meta_length else None
+        offset = start + meta_length
+        return meta, offset, body_length, offset + body_length
+
+    def scan(self, position):
+        index = {}
+        while position + self.SIZES.size <= len(self._map):
+            try:
+                meta, offset, length, next_position = self.read_record(position)
+            except ValueError:
+                # truncated record at the end of a crashed run
+                break
+            if meta is None or next_position > len(self._map):
+                break
+            index[meta['key']] = (meta, offset, length)
+            position = next_position
+        return index
+
+    def response(self, method, url, params=None, headers=None):
+        response = Response()
+        response.url = url
+        response._content_consumed = True
+        found = self.index.get(self.key(method, url, params, headers))
+        if not found:
+            response.status_code = 404
+            response._content = b''
+            return response
+        meta, offset, length = found
+        response._content = zlib.decompress(self._map[offset:offset + length])
+        response.status_code = meta['status']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.encoding = meta['encoding']
+        return response
+
+    def close(self):
+        self._map.close()
+        self._file.close()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+import time
+import logging
+import threading
+import requests
+from logging.config import fileConfig
+from . import _logging_config_path
+
+fileConfig(_logging_config_path)
+log = logging.getLogger(__name__)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """raised instead of sending a request to a host that is down, handled
+    wherever a connection error already is"""
+
+
+class CircuitBreaker(object):
+    """Per host breaker, opens after `threshold` requests in a row failed
+    for good (connection error, timeout or 5xx after the retries) and
+    fails every request at once for `cooldown` seconds, then lets a single
+    probe through: success closes it, failure opens it again"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, host, threshold=5, cooldown=30):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def admit(self):
+        # CLOSED, HALF_OPEN for the single probe, None if rejected
+        with self._lock:
+            if self.state == self.CLOSED:
+                return self.CLOSED
+            if self.state == self.OPEN and time.time() - self.opened >= self.cooldown:
+                self.state = self.HALF_OPEN
+                return self.HALF_OPEN
+            self.rejected += 1
+            return None
+
+    def allow(self):
+        return self.admit() is not None
+
+    def check(self):
+        """once per request, retries included, True for the probe which
+        must end in success() or failure()"""
+        state = self.admit()
+        if state is None:
+            raise CircuitOpenError('circuit of %s is open' % self.host)
+        return state == self.HALF_OPEN
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    log.error('主機%s連續%s次請求失敗，暫停請求%s秒' % (self.host, self.failures, self.cooldown))
+                self.state = self.OPEN
+                self.opened = time.time()
+
+
+_breakers = {}
+_lock = threading.Lock()
+
+
+def get_breaker(host):
+    with _lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host)
+    return breaker
+
+
+def reset():
+    with _lock:
+        _breakers.clear()
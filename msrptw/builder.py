@@ -3,55 +3,166 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 import sys
+import logging
 from argparse import ArgumentParser
+from logging.config import fileConfig
+from pathos.pools import _ThreadPool
+from pathos.multiprocessing import cpu_count
+from . import _logging_config_path
 from .database import config
 from .directory import Directory
-from . import marketbrowser, marketapi
-
-
-def build(db_path, setup):
+from . import marketbrowser, marketapi, connection, limiter
+
+fileConfig(_logging_config_path)
+log = logging.getLogger(__name__)
+
+MARKETS = [
+    marketbrowser.WellcomeBrowser,
+    marketbrowser.FengKangBrowser,
+    marketbrowser.RtmartBrowser,
+    marketapi.Rtmart,
+    marketapi.Carrefour,
+    marketapi.CarrfourBrowser,
+    marketapi.BinJung,
+    marketapi.NewTaipeiCenter,
+]
+
+
+def market_groups(market_classes):
+    """market classes of the same market (NAME) together, in their order.
+    The classes of a market insert products under one market id, run at
+    the same time two of them could insert the same pid at once"""
+    groups = []
+    for market_class in market_classes:
+        for group in groups:
+            if group[0].NAME == market_class.NAME:
+                group.append(market_class)
+                break
+        else:
+            groups.append([market_class])
+    return groups
+
+
+def direct_group(market_classes, workers=None, processes=None):
+    for market_class in market_classes:
+        direct(market_class, workers, processes)
+
+
+def direct(market_class, workers=None, processes=None):
+    try:
+        market = market_class()
+        if processes and isinstance(market, marketbrowser.MarketBrowser):
+            market.direct(workers=workers, processes=processes)
+        else:
+            market.direct(workers=workers)
+    except Exception as e:
+        log.exception(e)
+        log.error(Directory.ERROR_MAP[6] % market_class.NAME)
+
+
+def build(db_path, setup, parallel_markets=1, workers=None, engine='thread', concurrency=100,
+          migrate=False, chunk_size=None, cache_dir=None, cache_size=512, record=None, replay=None,
+          stream_json=False, parse_processes=None, deadline=None, manual_file=None, price_intervals=False):
     if db_path:
         config.setup_session(db_path)
         if setup:
             config.init()
-
-        w = marketbrowser.WellcomeBrowser()
-        w.direct()
-
-        f = marketbrowser.FengKangBrowser()
-        f.direct()
-
-        r1 = marketbrowser.RtmartBrowser()
-        r1.direct()
-
-        r2 = marketapi.Rtmart()
-        r2.direct()
-
-        c1 = marketapi.Carrefour()
-        c1.direct()
-
-        c2 = marketapi.CarrfourBrowser()
-        c2.direct()
-
-        b = marketapi.BinJung()
-        b.direct()
-
-        n = marketapi.NewTaipeiCenter()
-        n.direct()
-
-        Directory.clear_stack()
+        elif migrate:
+            config.migrate()
+
+        if chunk_size:
+            Directory.WRITER.capacity = chunk_size
+
+        Directory.WRITER.intervals = price_intervals
+
+        if deadline:
+            Directory.DEADLINE = deadline
+
+        if manual_file:
+            Directory.MANUAL_PATH = manual_file
+
+        connection.configure_cache(cache_dir, cache_size * 1024 * 1024)
+
+        marketapi.MarketApi.STREAM_JSON = stream_json
+
+        if record:
+            connection.configure_archive(record, 'record')
+        elif replay:
+            connection.configure_archive(replay, 'replay')
+            Directory.DATE = connection.ARCHIVE.date
+
+        try:
+            if engine == 'asyncio':
+                # python 3 only, keep the import out of the thread engine path
+                from .engine import AsyncEngine
+                connection.configure(pool_size=concurrency)
+                AsyncEngine(concurrency).run(market_groups(MARKETS))
+
+            elif parallel_markets > 1:
+                # several markets may hit the same host at once
+                connection.configure(pool_size=(workers or cpu_count()) * parallel_markets)
+                # each market keeps its own pool of `workers` threads, the
+                # classes of one market run in turn
+                pool = _ThreadPool(parallel_markets)
+                for group in market_groups(MARKETS):
+                    pool.apply_async(direct_group, args=(group, workers, parse_processes))
+                pool.close()
+                pool.join()
+            else:
+                connection.configure(pool_size=workers or cpu_count())
+                for market_class in MARKETS:
+                    direct(market_class, workers, parse_processes)
+
+            Directory.clear_stack()
+        finally:
+            for m in limiter.metrics():
+                log.info(Directory.INFO_MAP[6] % (m['host'], m['concurrency'], m['rate'] or '-', m['latency'] or 0,
+                                                   m['requests'], m['throttled'], m['errors']))
+            Directory.WRITER.close()
+            m = Directory.WRITER.metrics()
+            log.info(Directory.INFO_MAP[5] % (m['commits'], m['commits_per_sec'], m['rows'], m['queue_depth'],
+                                               m['max_queue_depth']))
+            # also writes the index of a recording
+            connection.close()
 
 
 def parse_args(args):
     parser = ArgumentParser()
     parser.add_argument('--dbpath', help='sql connection here.', required=True)
     parser.add_argument('--setup', help='present to initialize database.', action='store_true')
-    return parser.parse_args()
+    parser.add_argument('--migrate', help='present to add new tables and indexes to database.', action='store_true')
+    parser.add_argument('--chunk-size', help='prices committed together by the database writer.', type=int)
+    parser.add_argument('--price-intervals', help='store a price once until it changes instead of once a day.',
+                        action='store_true')
+    parser.add_argument('--cache-dir', help='directory of the on-disk http cache, no cache if absent.')
+    parser.add_argument('--cache-size', help='http cache size in MB.', type=int, default=512)
+    parser.add_argument('--record', help='write every raw response of the run to this archive file.')
+    parser.add_argument('--replay', help='parse the responses of an archive file instead of the network.')
+    parser.add_argument('--stream-json', help='decode api responses item by item while downloading. With '
+                        '--cache-dir or --record a response is stored as it is read, a --record keeps its '
+                        'compressed body in memory until then; cache hits and --replay are read whole.',
+                        action='store_true')
+    parser.add_argument('--manual-file', help='keep products waiting for manual classification in this file, '
+                                              'left over ones of a crashed run are asked first.')
+    parser.add_argument('--deadline', help='wall-clock seconds per market, remaining pages are skipped.',
+                        type=int)
+    parser.add_argument('--parse-processes', help='parse html pages on this many processes (thread engine).',
+                        type=int)
+    parser.add_argument('--parallel-markets', help='number of markets to crawl at the same time.',
+                        type=int, default=1)
+    parser.add_argument('--workers', help='threads per market, default to cpu count.', type=int)
+    parser.add_argument('--engine', help='crawl with thread pools or one asyncio loop.',
+                        choices=['thread', 'asyncio'], default='thread')
+    parser.add_argument('--concurrency', help='requests in flight across all markets with asyncio engine.',
+                        type=int, default=100)
+    return parser.parse_args(args)
 
 
 def main(args):
     args = parse_args(args)
-    build(args.dbpath, args.setup)
+    build(args.dbpath, args.setup, args.parallel_markets, args.workers, args.engine, args.concurrency,
+          args.migrate, args.chunk_size, args.cache_dir, args.cache_size, args.record, args.replay,
+          args.stream_json, args.parse_processes, args.deadline, args.manual_file, args.price_intervals)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from urlparse import urlparse
+except:
+    from urllib.parse import urlparse
+from pathos.multiprocessing import cpu_count
+from .httpcache import HttpCache
+from .archive import ArchiveRecorder, ArchiveReader
+from . import limiter, breaker
+
+# shared keep-alive sessions, one per host, so every market reuses
+# its TCP/TLS connections instead of opening one per request
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/71.0.3578.80 Safari/537.36',
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+}
+
+POOL_SIZE = cpu_count()
+
+# (connect, read) seconds, a dead host fails on connect instead of read
+TIMEOUT = (5, 30)
+
+# extra attempts of idempotent requests, sleeping a random share of
+# BACKOFF * 2 ** attempt seconds, at most MAX_BACKOFF, in between
+RETRIES = 2
+BACKOFF = 0.5
+MAX_BACKOFF = 8
+
+IDEMPOTENT = ('GET', 'HEAD')
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+CACHE = None
+
+# ArchiveRecorder or ArchiveReader, see configure_archive
+ARCHIVE = None
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+class LimitedSession(requests.Session):
+    """every request that reaches the network waits for the limiter of
+    its host and reports its status and latency back to it"""
+
+    def __init__(self, host_limiter):
+        super(LimitedSession, self).__init__()
+        self.limiter = host_limiter
+
+    def send(self, request, **kwargs):
+        start = self.limiter.acquire()
+        try:
+            res = super(LimitedSession, self).send(request, **kwargs)
+        except requests.exceptions.RequestException:
+            self.limiter.release(start, None)
+            raise
+        self.limiter.release(start, res.status_code)
+        return res
+
+
+def configure(pool_size=None):
+    """size the per host connection pools, usually to the number of
+    crawler threads that may hit one host at the same time"""
+    global POOL_SIZE
+    if pool_size:
+        POOL_SIZE = pool_size
+    close_sessions()
+
+
+def get_session(url):
+    host = urlparse(url).netloc
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            host_limiter = limiter.get_limiter(host)
+            session = LimitedSession(host_limiter)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(POOL_SIZE, host_limiter.max_concurrency))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update(HEADERS)
+            _sessions[host] = session
+    return session
+
+
+def configure_cache(path, max_size=512 * 1024 * 1024):
+    global CACHE
+    CACHE = HttpCache(path, max_size) if path else None
+
+
+def configure_archive(path, mode):
+    """'record' writes every response of the run to path, 'replay'
+    answers every request from path without network access"""
+    global ARCHIVE
+    if ARCHIVE is not None:
+        ARCHIVE.close()
+    ARCHIVE = None
+    if path and mode == 'record':
+        ARCHIVE = ArchiveRecorder(path)
+    elif path and mode == 'replay':
+        ARCHIVE = ArchiveReader(path)
+
+
+def request(method, url, ttl=None, **kwargs):
+    """ttl in seconds goes through the disk cache when one is configured,
+    0 always revalidates, None bypasses the cache. Idempotent requests
+    are retried on connection errors, timeouts and RETRY_STATUS, and any
+    request to a host whose circuit is open raises CircuitOpenError"""
+    params = kwargs.get('params')
+    headers = kwargs.get('headers')
+    kwargs.setdefault('timeout', TIMEOUT)
+
+    if isinstance(ARCHIVE, ArchiveReader):
+        return ARCHIVE.response(method, url, params, headers)
+
+    session = get_session(url)
+    host_breaker = breaker.get_breaker(urlparse(url).netloc)
+    retries = RETRIES if method in IDEMPOTENT else 0
+
+    probe = host_breaker.check()
+    settled = False
+    try:
+        for attempt in range(retries + 1):
+            res = None
+            try:
+                if CACHE is None or ttl is None or method != 'GET':
+                    res = session.request(method, url, **kwargs)
+                else:
+                    res = CACHE.fetch(session, url, ttl, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == retries:
+                    host_breaker.failure()
+                    settled = True
+                    raise
+            else:
+                if res.status_code not in RETRY_STATUS:
+                    host_breaker.success()
+                    settled = True
+                    break
+                if attempt == retries:
+                    if res.status_code >= 500:
+                        host_breaker.failure()
+                        settled = True
+                    break
+                res.close()
+            time.sleep(backoff(attempt, res))
+    finally:
+        # a probe ending any other way (429, an unexpected error) opens
+        # the circuit again rather than leaving it half-open
+        if probe and not settled:
+            host_breaker.failure()
+
+    if isinstance(ARCHIVE, ArchiveRecorder):
+        ARCHIVE.add(method, url, params, headers, res, kwargs.get('stream', False))
+
+    return res
+
+
+def backoff(attempt, res=None):
+    """full jitter, or the Retry-After of a 429 when it asks for longer"""
+    delay = random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+    retry_after = res.headers.get('Retry-After') if res is not None else None
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, min(int(retry_after), MAX_BACKOFF))
+    return delay
+
+
+def get(url, ttl=None, **kwargs):
+    return request('GET', url, ttl, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def close_sessions():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def close():
+    close_sessions()
+    # writes the index of a recording
+    configure_archive(None, None)
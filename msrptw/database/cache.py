@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+import threading
+from collections import namedtuple
+from sqlalchemy import event, or_
+from . import _session
+from .config import session_scope
+from .model import Market, Origin, Unit, Part, Alias, Classification
+
+# detached, read only stand-in of a reference row
+Reference = namedtuple('Reference', ['id', 'name'])
+
+
+class ReferenceCache(object):
+    """Process wide cache of the small reference tables (origin, unit,
+    market), loaded with one session on first use and shared by every
+    thread, call invalidate() after changing those tables by hand"""
+
+    MODELS = (Market, Origin, Unit)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = None
+
+    def _load(self):
+        tables = {}
+        with session_scope() as session:
+            tables['market'] = [Reference(m.id, m.name) for m in session.query(Market)]
+            tables['origin'] = [Reference(o.id, o.name) for o in session.query(Origin)]
+            # higher level first, matches 盒 before 片 in "3片/盒"
+            tables['unit'] = [Reference(u.id, u.name) for u in session.query(Unit).order_by(Unit.level.desc())]
+        return tables
+
+    def table(self, name):
+        tables = self._tables
+        if tables is None:
+            with self._lock:
+                if self._tables is None:
+                    self._tables = self._load()
+                tables = self._tables
+        return tables[name]
+
+    def find(self, table, name):
+        for reference in self.table(table):
+            if reference.name == name:
+                return reference
+        return None
+
+    def get(self, table, id):
+        for reference in self.table(table):
+            if reference.id == id:
+                return reference
+        return None
+
+    def markets(self):
+        return self.table('market')
+
+    def origins(self):
+        return self.table('origin')
+
+    def units(self):
+        return self.table('unit')
+
+    def snapshot(self):
+        # plain tables to hand to another process
+        return dict((name, list(self.table(name))) for name in ('market', 'origin', 'unit'))
+
+    def preload(self, tables):
+        with self._lock:
+            self._tables = tables
+
+    def invalidate(self):
+        with self._lock:
+            self._tables = None
+
+
+references = ReferenceCache()
+
+
+@event.listens_for(_session, 'after_flush')
+def _invalidate_references(session, flush_context):
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    if any(isinstance(instance, ReferenceCache.MODELS) for instance in changed):
+        references.invalidate()
+
+
+class ClassificationMemo(object):
+    """(config_id, normalized name) => (part_id, alias_id) of the
+    classification table, loaded on first use, rows are written by
+    Directory through the writer"""
+
+    MODELS = (Part, Alias)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._memo = None
+
+    def _load(self):
+        with session_scope() as session:
+            return dict(((c.config_id, c.name), (c.part_id, c.alias_id))
+                        for c in session.query(Classification))
+
+    def memo(self):
+        memo = self._memo
+        if memo is None:
+            with self._lock:
+                if self._memo is None:
+                    self._memo = self._load()
+                memo = self._memo
+        return memo
+
+    def get(self, config_id, name):
+        return self.memo().get((config_id, name))
+
+    def put(self, config_id, name, part_id, alias_id):
+        """False if the name was already classified"""
+        memo = self.memo()
+        with self._lock:
+            if (config_id, name) in memo:
+                return False
+            memo[(config_id, name)] = (part_id, alias_id)
+        return True
+
+    def invalidate(self):
+        with self._lock:
+            self._memo = None
+
+
+classifications = ClassificationMemo()
+
+
+@event.listens_for(_session, 'before_flush')
+def _invalidate_classifications(session, flush_context, instances):
+    # before the flush, so the rows of a deleted part are gone before it
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    if not any(isinstance(instance, ClassificationMemo.MODELS) for instance in changed):
+        return
+    # keywords changed, names are matched again, hand made decisions
+    # stay unless they gave up or their part is gone
+    table = Classification.__table__
+    session.execute(table.delete().where(or_(table.c.manual == False, table.c.part_id == None)))
+    deleted = [instance.id for instance in session.deleted if isinstance(instance, Part)]
+    if deleted:
+        session.execute(table.delete().where(table.c.part_id.in_(deleted)))
+    classifications.invalidate()
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 from __future__ import unicode_literals
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, select, func
 from contextlib import contextmanager
 from . import _base, _session
 from .model import Config, Market, Part, Origin, Alias, Unit
@@ -10,6 +10,10 @@ from .model import Config, Market, Part, Origin, Alias, Unit
 engine = None
 
 
+class MigrationError(Exception):
+    pass
+
+
 def setup_session(db_path):
     global engine
     engine = create_engine(db_path)
@@ -523,6 +527,40 @@ def init():
         session.add(u31)
 
 
+def migrate():
+    print('migrating database...')
+    # create tables, columns and indexes added since setup, rows are kept
+    _base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    for table in _base.metadata.sorted_tables:
+        columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                # new columns are nullable, existing rows get NULL
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name, column.type.compile(engine.dialect)))
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                if index.unique:
+                    check_unique(index)
+                index.create(engine)
+
+
+def check_unique(index):
+    # rows a new unique index would refuse, left for the user to resolve
+    columns = list(index.columns)
+    duplicates = engine.execute(
+        select(columns + [func.count()]).group_by(*columns).having(func.count() > 1)
+    ).fetchall()
+    if duplicates:
+        raise MigrationError('cannot create unique index %s, %s rows of %s share (%s), e.g. %s; '
+                             'remove the duplicates and migrate again' % (
+                                 index.name, sum(row[-1] for row in duplicates), index.table.name,
+                                 ', '.join(column.name for column in columns),
+                                 ', '.join('(%s)' % ', '.join('%s' % value for value in row[:-1]) for row in duplicates[:3])))
+
+
 @contextmanager
 def session_scope():
     session = _session()
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 from __future__ import unicode_literals
-from sqlalchemy import Integer, Column, ForeignKey, Sequence, String, Unicode, Date, DateTime, Boolean
+from sqlalchemy import Integer, Float, Column, ForeignKey, Sequence, String, Unicode, Date, DateTime, Boolean, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from . import _base
@@ -93,8 +93,29 @@ class Unit(_base):
         return self.name
 
 
+class Classification(_base):
+    """part of a normalized product name under a config, decided once
+    automatically or by hand and reused by every market, part_id is null
+    for names given up on by hand"""
+    __tablename__ = 'classification'
+    __table_args__ = (
+        Index('ix_classification_config_name', 'config_id', 'name', unique=True),
+    )
+    id = Column(Integer, Sequence('classification_id_seq'), primary_key=True, nullable=False)
+    config_id = Column(Integer, ForeignKey('config.id'))
+    name = Column(Unicode(30))
+    part_id = Column(Integer, ForeignKey('part.id'))
+    alias_id = Column(Integer, ForeignKey('alias.id'))
+    manual = Column(Boolean, default=False)
+
+
 class Product(_base):
     __tablename__ = 'product'
+    __table_args__ = (
+        Index('ix_product_market_pid', 'market_id', 'pid', unique=True),
+        # products of a part, by market
+        Index('ix_product_part_market', 'part_id', 'market_id'),
+    )
     id = Column(Integer, Sequence('product_id_seq'), primary_key=True, nullable=False)
     part_id = Column(Integer, ForeignKey('part.id'))
     part = relationship('Part', back_populates='products')
@@ -111,6 +132,9 @@ class Product(_base):
     source = Column(String(255))
     weight = Column(Integer, nullable=True)
     count = Column(Integer)
+    # last crawl that read name, origin, weight, count and unit from the
+    # full product data, see Directory.REFRESH_DAYS
+    verified = Column(Date)
     prices = relationship('Price')
 
     def __unicode__(self):
@@ -128,6 +152,12 @@ class Product(_base):
 
 class Price(_base):
     __tablename__ = 'price'
+    __table_args__ = (
+        # one price per product a day, also the upsert conflict target
+        Index('ix_price_product_date', 'product_id', 'date', unique=True),
+        # prices of a range of days for every product, see msrptw.report
+        Index('ix_price_date_product', 'date', 'product_id', 'price'),
+    )
     id = Column(Integer, Sequence('price_id_seq'), primary_key=True, nullable=False)
     product_id = Column(Integer, ForeignKey('product.id'))
     product = relationship('Product', back_populates='prices')
@@ -147,6 +177,48 @@ class Price(_base):
         return 'Price(product=%s, price=%s, date=%s)' % (product, self.price, self.date)
 
 
+class PriceInterval(_base):
+    """price of a product from valid_from to valid_to (inclusive), the
+    change-only storage of the writer: an unchanged price extends valid_to
+    instead of adding a row a day"""
+    __tablename__ = 'price_interval'
+    __table_args__ = (
+        # also finds the intervals of a product to extend, valid_to is left
+        # out of every index since extending it is the usual write
+        Index('ix_price_interval_product_from', 'product_id', 'valid_from', unique=True),
+    )
+    id = Column(Integer, Sequence('price_interval_id_seq'), primary_key=True, nullable=False)
+    product_id = Column(Integer, ForeignKey('product.id'))
+    price = Column(Integer)
+    valid_from = Column(Date)
+    valid_to = Column(Date)
+
+
+class DailyPartSummary(_base):
+    """price statistics of a part in a market on a day, per item and per kg
+    (of the weighed products), kept up to date by msrptw.summary"""
+    __tablename__ = 'daily_part_summary'
+    __table_args__ = (
+        Index('ix_daily_part_summary_part_date', 'part_id', 'date', 'market_id', unique=True),
+        # the rows of a market and day replaced after its run
+        Index('ix_daily_part_summary_date_market', 'date', 'market_id'),
+    )
+    id = Column(Integer, Sequence('daily_part_summary_id_seq'), primary_key=True, nullable=False)
+    date = Column(Date)
+    part_id = Column(Integer, ForeignKey('part.id'))
+    market_id = Column(Integer, ForeignKey('market.id'))
+    products = Column(Integer)
+    min_price = Column(Integer)
+    median_price = Column(Float)
+    max_price = Column(Integer)
+    mean_price = Column(Float)
+    weighed = Column(Integer)
+    min_per_kg = Column(Float)
+    median_per_kg = Column(Float)
+    max_per_kg = Column(Float)
+    mean_per_kg = Column(Float)
+
+
 class Log(_base):
     __tablename__ = 'log'
     id = Column(Integer, Sequence('log_id_seq'), primary_key=True, nullable=False)
@@ -2,15 +2,34 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 from __future__ import unicode_literals
+import os
+import io
 import sys
+import json
+import tempfile
+import threading
 import datetime
 import re
+import time
+import weakref
 import logging
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from pathos.multiprocessing import cpu_count
+from sqlalchemy import select
 from sqlalchemy.orm import subqueryload
 from logging.config import fileConfig
 from . import _logging_config_path
 from .database.config import session_scope
-from .database.model import Market, Product, Config, Origin, Price, Part, Unit
+from .database.cache import references, classifications
+from .database.model import Product, Config, Price, Part
+from .matcher import ConfigMatcher
+from .extract import Extractor, translate_table
+from .writer import Writer
+from .query import price_rows
+from . import limiter, breaker, summary
 
 fileConfig(_logging_config_path)
 log = logging.getLogger(__name__)
@@ -29,11 +48,8 @@ class Directory(object):
             (?:\w+)
     ''', re.X)
 
-    GLOBAL_REPLACE_RE = re.compile('''
-        [ 　台]
-        |
-        [０-９]    
-    ''', re.X)
+    # removed by normalize
+    TO_DELETE = ' 　'
 
     TO_REPLACE_MAP = {
         '台': '臺',
@@ -41,6 +57,8 @@ class Directory(object):
         '６': '6', '７': '7', '８': '8', '９': '9', '０': '0'
     }
 
+    NORMALIZE_TABLE = translate_table(TO_REPLACE_MAP, TO_DELETE)
+
     ORIGIN_MAP = {
         '臺北': '臺灣', '臺中': '臺灣', '基隆': '臺灣', '臺南': '臺灣', '高雄': '臺灣', '新北': '臺灣',
         '桃園': '臺灣', '嘉義': '臺灣', '新竹': '臺灣', '苗栗': '臺灣', '南投': '臺灣', '彰化': '臺灣',
@@ -80,7 +98,63 @@ class Directory(object):
         (?:[0-9]+)(?=[片粒顆支條包袋盒瓶罐入]) 
     ''', re.X)
 
-    STACK = []
+    # compiled from the tables above and the unit table, see extractor()
+    EXTRACTOR = None
+
+    # crawl date, today if None, set to the recording date on replay
+    DATE = None
+
+    # wall-clock seconds a market may run, tasks left after it are skipped
+    DEADLINE = None
+
+    # seconds a cached response is served without revalidation,
+    # 0 always sends a conditional request when a disk cache is configured
+    CACHE_TTL = 0
+
+    # host => HostLimiter settings, e.g. {'www.example.com': {'rate': 10, 'max_concurrency': 16}},
+    # a host shared by several markets shares one limiter
+    LIMITS = {}
+
+    # scraped products not yet in database, classified and stored by one
+    # background thread as they come, store blocks while the queue is full
+    STACK = queue.Queue(10000)
+
+    STACK_LOCK = threading.Lock()
+
+    STACK_THREAD = None
+
+    # json lines of the products left for manual classification, kept
+    # until clear_stack, a temporary file if None
+    MANUAL_PATH = None
+
+    MANUAL_KEYS = set()
+
+    # (market_id, date) of prices stored from the stack, their summary is
+    # updated again by clear_stack
+    STACK_DAYS = set()
+
+    # (market_id, pid) => (id, part_id, verified, static fields, last price)
+    # of products already in database, static fields as in STATIC_FIELDS
+    PRODUCTS = {}
+
+    # days a product's static fields are trusted before its full product
+    # data (detail page) is read again
+    REFRESH_DAYS = 7
+
+    # fields a read of the full product data checks against the stored row
+    STATIC_FIELDS = ('origin_id', 'weight', 'count', 'unit_id')
+
+    # a listing price moving more than this share of the last price is
+    # checked against the full product data
+    SUSPICIOUS_RATIO = 0.3
+
+    PRODUCTS_LOCK = threading.Lock()
+
+    # config => ConfigMatcher, compiled once per loaded config
+    MATCHERS = weakref.WeakKeyDictionary()
+
+    # the one thread writing products and prices
+    WRITER = Writer()
 
     ERROR_MAP = {
         0: '商品重量單位轉換失敗',
@@ -89,6 +163,10 @@ class Directory(object):
         3: '處理html文本%s發生溢位或值錯誤\n請查看原始頁面:(%s)',
         4: '訪問商品頁面(%s)請求逾時',
         5: '處理json文本發生溢位或值錯誤\n%s',
+        6: '執行市場%s發生錯誤',
+        7: '市場%s超過時限%s秒，略過剩餘工作',
+        8: '訪問頁面(%s)失敗: %s',
+        9: '更新市場%s於%s的每日價格統計失敗',
     }
 
     INFO_MAP = {
@@ -96,7 +174,11 @@ class Directory(object):
         1: '無法自動分類商品「%s」，產地%s，請定義產品類型或放棄(Enter)\n%s:',
         2: '將商品%s人工定義為%s',
         3: '放棄定義商品%s',
-        4: '將商品%s自動定義為%s'
+        4: '將商品%s自動定義為%s',
+        5: '資料庫提交%s次(每秒%.2f次)，寫入%s筆價格，佇列深度%s(最大%s)',
+        6: '主機%s併發上限%s，速率上限%s/秒，平均延遲%.3f秒，請求%s次，限流%s次，錯誤%s次',
+        7: '更新市場%s於%s的每日價格統計%s筆',
+        8: '商品%s重新驗證，更新%s',
     }
 
     def __init__(self):
@@ -104,144 +186,333 @@ class Directory(object):
         if not self.PRODUCT_MAP or not self.NAME:
             raise NotImplementedError
 
-        self.date = datetime.date.today().strftime('%Y-%m-%d')
+        self.date = self.DATE or datetime.date.today()
+
+        limiter.configure(self.LIMITS)
+
+        self.deadline = time.time() + self.DEADLINE if self.DEADLINE else None
+        self.deadline_logged = False
 
         with session_scope() as session:
             self.configs = session.query(Config).options(
                 subqueryload(Config.parts).subqueryload(Part.aliases)
             ).all()
-            self.units = session.query(Unit).order_by(Unit.level.desc()).all()
-            self.market = session.query(Market).filter(Market.name == self.NAME).first()
             session.expunge_all()
 
-    @staticmethod
-    def normalize(s):
-
-        def replace(m):
+        self.market = references.find('market', self.NAME)
 
-            found = m.group()
+        self.load_products()
 
-            if found in Directory.TO_REPLACE_MAP:
-                return Directory.TO_REPLACE_MAP[found]
+    def expired(self):
+        if self.deadline is None or time.time() < self.deadline:
+            return False
+        if not self.deadline_logged:
+            self.deadline_logged = True
+            log.error(Directory.ERROR_MAP[7] % (self.NAME, self.DEADLINE))
+        return True
 
-            return ''
+    def run_task(self, func, *args):
+        """body of a pool task, skipped past the deadline and logging the
+        errors apply_async would drop"""
+        if self.expired():
+            return
+        try:
+            func(*args)
+        except breaker.CircuitOpenError:
+            # logged once when the circuit opened
+            pass
+        except Exception as e:
+            log.exception(e)
+
+    def default_workers(self):
+        # enough threads to reach the largest window the limiters may open
+        if not self.LIMITS:
+            return cpu_count()
+        return max(settings.get('max_concurrency', cpu_count()) for settings in self.LIMITS.values())
 
-        s = Directory.GLOBAL_REPLACE_RE.sub(replace, s)
+    @staticmethod
+    def extractor():
+        # rebuilt when the unit table is reloaded
+        units = references.units()
+        extractor = Directory.EXTRACTOR
+        if extractor is None or extractor.units is not units:
+            extractor = Directory.EXTRACTOR = Extractor(
+                Directory.TO_REPLACE_MAP, Directory.TO_DELETE, Directory.ORIGIN_MAP, units,
+                Directory.UNIT_RE, Directory.MULTI_RE)
+        return extractor
 
-        return s.lower()
+    @staticmethod
+    def normalize(s):
+        return s.translate(Directory.NORMALIZE_TABLE).lower()
 
     @staticmethod
     def get_origin(origin_str, default='其他'):
+        value = Directory.extractor().origin(origin_str)
+        return references.find('origin', value or default)
 
-        origin_str = Directory.normalize(origin_str)
+    def get_unit(self, unit_str):
+        return Directory.extractor().unit(unit_str)
 
-        def find(s):
-            for key in Directory.ORIGIN_MAP.keys():
-                if key in s:
-                    return Directory.ORIGIN_MAP[key]
-            return ''
+    PRODUCT_FIELDS = ('source', 'name', 'market_id', 'pid', 'origin_id', 'weight', 'count', 'unit_id')
 
-        with session_scope() as session:
-            value = find(origin_str)
-            if value:
-                origin = session.query(Origin).filter(Origin.name == value).first()
-            else:
-                origin = session.query(Origin).filter(Origin.name == default).first()
-            session.expunge(origin)
+    def __getstate__(self):
+        # a market sent to a parsing process leaves its configs behind
+        state = self.__dict__.copy()
+        state.pop('configs', None)
+        return state
 
-        return origin
+    @staticmethod
+    def to_record(product, price):
+        record = dict((field, getattr(product, field)) for field in Directory.PRODUCT_FIELDS)
+        record['price'] = price.price
+        record['date'] = price.date
+        return record
 
-    def get_unit(self, unit_str):
+    @staticmethod
+    def from_record(record):
+        product = Product(**dict((field, record[field]) for field in Directory.PRODUCT_FIELDS))
+        price = Price(price=record['price'], date=record['date'])
+        return product, price
+
+    def store(self, config, product, price):
+        if product is None:
+            # price of a known product, see known_price
+            self.set_price(price)
+            return
+        found = self.check_product(product)
+        if not found:
+            Directory.push_stack(config, product, price)
+        elif found[1]:
+            price.product_id = found[0]
+            self.set_price(price)
+            Directory.set_verified(product, price)
+
+    def known_price(self, pid, price):
+        """Price of a classified product verified within REFRESH_DAYS, None
+        when its full product data should be read again"""
+        if price is None:
+            return None
+        key = (self.market.id, str(pid))
+        found = Directory.PRODUCTS.get(key)
+        if not found or not found[1] or not found[2]:
+            return None
+        if (self.date - found[2]).days >= self.REFRESH_DAYS:
+            return None
+        if Directory.suspicious(found, price):
+            return None
+        Directory.set_last_price(key, price)
+        return Price(price=price, date=self.date, product_id=found[0])
 
-        for unit in self.units:
-            if unit.name in unit_str:
-                return unit
+    def due_refresh(self, pid):
+        """True when the full product data of a classified product is read
+        again, from the source rather than a cached copy which could be
+        as old as the verified date it would renew"""
+        found = Directory.PRODUCTS.get((self.market.id, str(pid)))
+        return bool(found and found[1])
 
-        return None
+    @classmethod
+    def suspicious(cls, found, price):
+        # no weight to compare prices with, or a price far from the last one
+        weight = found[3][cls.STATIC_FIELDS.index('weight')]
+        if not weight:
+            return True
+        last = found[4]
+        return bool(last) and abs(price - last) > last * cls.SUSPICIOUS_RATIO
 
     @classmethod
-    def clear_stack(cls):
+    def push_stack(cls, config, product, price):
+        cls.start_stack()
+        cls.STACK.put((config, product, price))
 
-        def set_product_price(pd, pc):
+    @classmethod
+    def start_stack(cls):
+        if cls.STACK_THREAD is not None:
+            return
+        with cls.STACK_LOCK:
+            if cls.STACK_THREAD is None:
+                if cls.MANUAL_PATH is None:
+                    fd, cls.MANUAL_PATH = tempfile.mkstemp(prefix='msrptw-manual-', suffix='.jsonl')
+                    os.close(fd)
+                thread = threading.Thread(target=cls.work_stack, name='stack')
+                thread.daemon = True
+                thread.start()
+                cls.STACK_THREAD = thread
 
-            if pd.part_id:
-                pc.product = pd
-                Directory.set_price(pc)
-            else:
-                Directory.set_product(pd)
+    @classmethod
+    def work_stack(cls):
+        while True:
+            item = cls.STACK.get()
+            try:
+                if item is None:
+                    return
+                cls.process_stack_item(*item)
+            except Exception as e:
+                log.exception(e)
+            finally:
+                cls.STACK.task_done()
 
-        manuals = []
+    @staticmethod
+    def set_product_price(product, price):
+        product.verified = price.date
+        product = Directory.set_product(product)
+        if product.part_id:
+            price.product_id = product.id
+            Directory.set_price(price)
+            Directory.STACK_DAYS.add((product.market_id, price.date))
 
-        for config, product, price in cls.STACK:
-            product = Directory.classify_product_auto(config, product)
-            if product.part_id:
-                set_product_price(product, price)
-            else:
-                manuals.append((config, product, price))
+    @classmethod
+    def process_stack_item(cls, config, product, price):
+        key = Directory.product_key(product)
+
+        # a product listed in several categories is stacked more than once
+        found = Directory.check_product(product)
+        if found:
+            if found[1]:
+                price.product_id = found[0]
+                Directory.set_price(price)
+                cls.STACK_DAYS.add((product.market_id, price.date))
+            return
+        if key in cls.MANUAL_KEYS:
+            return
+
+        # the same name seen in another market or run
+        if Directory.classify_product_memo(config, product):
+            Directory.set_product_price(product, price)
+            return
+
+        product = Directory.classify_product_auto(config, product)
+        if product.part_id:
+            Directory.remember(config, product, manual=False)
+            Directory.set_product_price(product, price)
+            return
+
+        cls.MANUAL_KEYS.add(key)
+        record = Directory.to_record(product, price)
+        record['date'] = record['date'].isoformat()
+        record['config_id'] = config.id
+        with io.open(cls.MANUAL_PATH, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    @classmethod
+    def clear_stack(cls):
+        """wait for the queued products, then ask for the ones automatic
+        classification left behind"""
+
+        with cls.STACK_LOCK:
+            thread, cls.STACK_THREAD = cls.STACK_THREAD, None
+        if thread is not None:
+            cls.STACK.put(None)
+            thread.join()
+
+        if cls.MANUAL_PATH and os.path.exists(cls.MANUAL_PATH):
+            with io.open(cls.MANUAL_PATH, encoding='utf-8') as f:
+                records = [json.loads(line) for line in f if line.strip()]
+
+            with session_scope() as session:
+                configs = dict((c.id, c) for c in session.query(Config).options(
+                    subqueryload(Config.parts).subqueryload(Part.aliases)
+                ))
+                session.expunge_all()
+
+            for record in records:
+                record['date'] = datetime.datetime.strptime(record['date'], '%Y-%m-%d').date()
+                product, price = Directory.from_record(record)
+                # a crashed run may have left it, stored since
+                if Directory.check_product(product):
+                    continue
+                config = configs[record['config_id']]
+                # answered for the same name earlier in the list
+                if not Directory.classify_product_memo(config, product):
+                    product = Directory.classify_product_manual(config, product)
+                    Directory.remember(config, product, manual=True)
+                Directory.set_product_price(product, price)
 
-        for config, product, price in manuals:
-            product = Directory.classify_product_manual(config, product)
-            set_product_price(product, price)
+            os.remove(cls.MANUAL_PATH)
+        cls.MANUAL_KEYS = set()
 
-        cls.STACK = []
+        Directory.flush_prices()
+        days, cls.STACK_DAYS = cls.STACK_DAYS, set()
+        for market_id, date in days:
+            Directory.update_summary(market_id, date)
 
     @staticmethod
     def set_product(product):
-        with session_scope() as session:
-            session.add(product)
-
-    @classmethod
-    def get_count(cls, s):
-
-        s = cls.normalize(s)
-
-        counts = cls.MULTI_RE.findall(s)
+        product = Directory.WRITER.insert_product(product)
+        with Directory.PRODUCTS_LOCK:
+            Directory.PRODUCTS[Directory.product_key(product)] = (
+                product.id, product.part_id, product.verified, Directory.static_fields(product), None)
+        return product
 
-        if counts:
-            count_str = ''.join([s for s in counts[0] if s.isalnum()])
-            count = int(count_str)
+    @staticmethod
+    def static_fields(product):
+        return tuple(getattr(product, field) for field in Directory.STATIC_FIELDS)
 
-            return count
+    @classmethod
+    def forget_products(cls, ids):
+        # inserted products a failed commit rolled back, found again as new
+        ids = set(ids)
+        with cls.PRODUCTS_LOCK:
+            for key in [key for key, found in cls.PRODUCTS.items() if found[0] in ids]:
+                del cls.PRODUCTS[key]
 
+    @classmethod
+    def get_count(cls, s):
+        multi = cls.extractor().multi(s)
+        if multi:
+            return int(multi)
         return 1
 
     @classmethod
     def get_weight(cls, s):
-
-        s = cls.normalize(s)
-
         try:
-            token = cls.UNIT_RE.findall(s)[0]
-            for index, multiplier in cls.UNIT_MAP.values():
-                unit_value = token[index]
-                if unit_value:
-                    try:
-                        unit_value = float(unit_value)
-                    except ValueError:
-                        log.error(Directory.ERROR_MAP[0])
-                        return None
-                    # 120g => 120 * 1 * 3
-                    return unit_value * multiplier
-        except:
+            return cls.extractor().weight(s)
+        except ValueError:
+            log.error(Directory.ERROR_MAP[0])
             return None
 
+    @staticmethod
+    def get_matcher(config):
+        matcher = Directory.MATCHERS.get(config)
+        if matcher is None:
+            matcher = Directory.MATCHERS[config] = ConfigMatcher(config)
+        return matcher
+
+    @staticmethod
+    def memo_name(product):
+        return Directory.normalize(product.name).strip()
+
+    @staticmethod
+    def classify_product_memo(config, product):
+        """True if the name was classified before, product gets its part
+        or stays without one when it was given up on"""
+        found = classifications.get(config.id, Directory.memo_name(product))
+        if found is None:
+            return False
+        product.part_id, alias_id = found
+        if alias_id is not None:
+            product.alias_id = alias_id
+        return True
+
+    @staticmethod
+    def remember(config, product, manual):
+        name = Directory.memo_name(product)
+        if classifications.put(config.id, name, product.part_id, product.alias_id):
+            Directory.WRITER.put_classification({
+                'config_id': config.id,
+                'name': name,
+                'part_id': product.part_id,
+                'alias_id': product.alias_id,
+                'manual': manual,
+            })
+
     @staticmethod
     def classify_product_auto(config, product):
-        for part in config.parts:
-            find = False
-            if part.name in product.name:
-                find = True
-            for alias in part.aliases:
-                if alias.name in product.name and not alias.anti:
-                    product.alias_id = alias.id
-                    find = True
-            for alias in part.aliases:
-                if alias.name in product.name and alias.anti:
-                    find = False
-            if find:
-                product.part_id = part.id
-                log.info(Directory.INFO_MAP[4] % (product.name, part.name))
-                return product
+        part, alias_id = Directory.get_matcher(config).classify(product.name)
+        if alias_id is not None:
+            product.alias_id = alias_id
+        if part:
+            product.part_id = part.id
+            log.info(Directory.INFO_MAP[4] % (product.name, part.name))
         return product
 
     @staticmethod
@@ -254,7 +525,7 @@ class Directory(object):
         while True:
             options = ''.join('(%s): %s ' % (i, part.name) for i, part in enumerate(config.parts))
             options = decode(options)
-            i = input(Directory.INFO_MAP[1] % (product.name, product.origin.name, options))
+            i = input(Directory.INFO_MAP[1] % (product.name, references.get('origin', product.origin_id).name, options))
 
             if not i:
                 log.info(Directory.INFO_MAP[3] % product.name)
@@ -271,38 +542,89 @@ class Directory(object):
                     break
         return product
 
+    def load_products(self):
+        # one query for the whole market instead of one per scraped item
+        fields = [getattr(Product, field) for field in Directory.STATIC_FIELDS]
+        with session_scope() as session:
+            rows = session.query(Product.pid, Product.id, Product.part_id, Product.verified, *fields).filter(
+                Product.market_id == self.market.id
+            ).all()
+            # last price within REFRESH_DAYS, what a listing price is checked against
+            products = select([Product.id]).where(Product.market_id == self.market.id)
+            prices = price_rows(self.date - datetime.timedelta(days=self.REFRESH_DAYS), self.date, products)
+            last = dict((product_id, price) for product_id, price in session.query(
+                prices.c.product_id, prices.c.price
+            ).order_by(prices.c.valid_from, prices.c.source.desc()))
+        with Directory.PRODUCTS_LOCK:
+            for row in rows:
+                pid, id, part_id, verified = row[:4]
+                Directory.PRODUCTS[(self.market.id, pid)] = (id, part_id, verified, tuple(row[4:]), last.get(id))
+
+    @staticmethod
+    def product_key(product):
+        # api ids may come as int, pid column is a string
+        return product.market_id, str(product.pid)
+
     @staticmethod
     def check_product(product):
-        with session_scope() as session:
+        # (id, part_id, verified) if the product is known, None otherwise
+        return Directory.PRODUCTS.get(Directory.product_key(product))
+
+    @classmethod
+    def set_price(cls, price):
+        # committed in groups by the writer thread
+        cls.WRITER.put_price(price.product_id, price.date, price.price)
 
-            db_product = session.query(Product).filter(
-                Product.pid == product.pid
-            ).filter(
-                Product.market_id == product.market_id
-            ).first()
+    @classmethod
+    def set_verified(cls, product, price):
+        """full product data of a known product was read, its verified date
+        and the static fields that changed since are updated"""
+        key = cls.product_key(product)
+        fields = cls.static_fields(product)
+        with cls.PRODUCTS_LOCK:
+            id, part_id, verified, stored, _ = cls.PRODUCTS[key]
+            cls.PRODUCTS[key] = (id, part_id, price.date, fields, price.price)
+        changed = dict((field, value) for field, value, old in zip(cls.STATIC_FIELDS, fields, stored)
+                       if value != old)
+        if changed:
+            log.info(Directory.INFO_MAP[8] % (product.name, ', '.join(sorted(changed))))
+        if changed or verified != price.date:
+            cls.WRITER.put_verified(id, price.date, changed)
 
-            if db_product:
-                session.expunge(db_product)
-                return db_product
-            return product
+    @classmethod
+    def set_last_price(cls, key, price):
+        with cls.PRODUCTS_LOCK:
+            found = cls.PRODUCTS[key]
+            cls.PRODUCTS[key] = found[:4] + (price,)
 
-    @staticmethod
-    def set_price(price):
-        with session_scope() as session:
+    @classmethod
+    def flush_prices(cls):
+        # waits until every price stored so far is committed
+        cls.WRITER.flush()
 
-            db_price = session.query(Price).filter(
-                Price.date == price.date
-            ).filter(
-                Price.product_id == price.product.id
-            ).first()
+    def summarize(self):
+        """end of the market's run, commits its prices and replaces its
+        daily summary of the day"""
+        self.flush_prices()
+        Directory.update_summary(self.market.id, self.date)
 
-            if db_price:
-                db_price.price = price.price
-            else:
-                session.add(price)
+    @staticmethod
+    def update_summary(market_id, date):
+        market = references.get('market', market_id)
+        name = market.name if market else market_id
+        try:
+            with session_scope() as session:
+                rows = summary.update(session, date, market_id)
+            log.info(Directory.INFO_MAP[7] % (name, date, rows))
+        except Exception as e:
+            log.exception(e)
+            log.error(Directory.ERROR_MAP[9] % (name, date))
 
     @staticmethod
     def flat_xpath(page, s):
         s = ''.join(page.xpath(s)).strip()
         s = Directory.normalize(s)
-        return s
\ No newline at end of file
+        return s
+
+
+Directory.WRITER.on_lost = Directory.forget_products
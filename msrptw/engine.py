@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from logging.config import fileConfig
+from . import _logging_config_path
+from .directory import Directory
+from .marketbrowser import MarketBrowser
+
+fileConfig(_logging_config_path)
+log = logging.getLogger(__name__)
+
+
+class AsyncEngine(object):
+    """Drive every market from one asyncio loop instead of a cpu_count()
+    thread pool per market, the blocking fetch, parse and Directory calls
+    run on an executor and at most `concurrency` of them are in flight
+    across all markets"""
+
+    def __init__(self, concurrency=100):
+        self.concurrency = concurrency
+        self.semaphore = None
+
+    def run(self, market_groups):
+        """market_groups are lists of market classes run one after the
+        other, see builder.market_groups"""
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(self.concurrency)
+        loop.set_default_executor(executor)
+        try:
+            loop.run_until_complete(self.direct_all(market_groups))
+        finally:
+            loop.close()
+            executor.shutdown()
+
+    async def direct_all(self, market_groups):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        await self.gather(self.direct_group(group) for group in market_groups)
+
+    async def direct_group(self, market_classes):
+        for market_class in market_classes:
+            await self.direct(market_class)
+
+    async def direct(self, market_class):
+        try:
+            market = await self.call(market_class)
+            if isinstance(market, MarketBrowser):
+                await self.browse_pages(market)
+            else:
+                await self.browse_apis(market)
+            await self.call(market.summarize)
+        except Exception as e:
+            log.exception(e)
+            log.error(Directory.ERROR_MAP[6] % market_class.NAME)
+
+    async def call(self, func, *args):
+        async with self.semaphore:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, func, *args)
+
+    @staticmethod
+    async def gather(coroutines):
+        # like the thread pools, one failing task must not stop the others
+        results = await asyncio.gather(*coroutines, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                log.error(result, exc_info=result)
+
+    @staticmethod
+    def config_map_strs(market):
+        for config in market.configs:
+            if market.expired():
+                return
+            log.info(Directory.INFO_MAP[0] % (market.market.name, config.name))
+            try:
+                map_strs = market.PRODUCT_MAP[config.name]
+            except KeyError:
+                log.error(Directory.ERROR_MAP[1] % config.name)
+                continue
+            for map_str in map_strs:
+                yield config, map_str
+
+    async def browse_pages(self, market):
+
+        async def browse_each(config, url):
+            if market.expired():
+                return
+            price = market.listed_price(url)
+            if price:
+                await self.call(market.store, config, None, price)
+                return
+            product, price = await self.call(market.get_product_price, url)
+            if not product and not price:
+                return
+            await self.call(market.store, config, product, price)
+
+        async def browse_list(config, map_str):
+            urls = await self.call(market.get_product_urls, map_str)
+            await self.gather(browse_each(config, url) for url in urls)
+
+        await self.gather(browse_list(c, m) for c, m in self.config_map_strs(market))
+
+    async def browse_apis(self, market):
+
+        async def browse_each(config, map_str):
+            if market.expired():
+                return
+            results = await self.call(market.get_products_prices, map_str)
+            for product, price in results:
+                await self.call(market.store, config, product, price)
+
+        await self.gather(browse_each(c, m) for c, m in self.config_map_strs(market))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+import re
+try:
+    from functools import lru_cache
+except ImportError:
+    lru_cache = None
+
+
+def translate_table(replace_map, delete):
+    table = dict((ord(k), v) for k, v in replace_map.items())
+    table.update((ord(ch), None) for ch in delete)
+    return table
+
+
+def table_re(keys):
+    """every key at every position, overlapping ones included, the
+    alternation tries keys in table order so the first key of the table
+    wins where several start at one position"""
+    return re.compile('(?=(%s))' % '|'.join(re.escape(key) for key in keys))
+
+
+class Extractor(object):
+    """Normalization, weight, multiplier, origin and unit of a string from
+    compiled tables: one str.translate, then one regex per table instead
+    of a Python callback per match and a linear scan per table. Table order
+    is kept, the first key of a table found anywhere in the string wins.
+    Each result is memoized on the raw string, the normalized string once
+    for all of them"""
+
+    def __init__(self, replace_map, delete, origin_map, units, weight_re, multi_re, memo_size=8192):
+        self.normalize_table = translate_table(replace_map, delete)
+        # most strings have nothing to translate
+        self.normalize_re = re.compile('[%s]' % re.escape(''.join(replace_map.keys()) + delete))
+        self.origin_map = origin_map
+        self.origin_rank = dict((key, i) for i, key in enumerate(origin_map.keys()))
+        self.origin_any = re.compile('|'.join(re.escape(key) for key in origin_map.keys()))
+        self.origin_re = table_re(origin_map.keys())
+        self.units = units
+        self.unit_rank = {}
+        for i, unit in enumerate(units):
+            self.unit_rank.setdefault(unit.name, i)
+        self.unit_re = table_re([unit.name for unit in units]) if units else None
+        self.weight_re = weight_re
+        self.multi_re = multi_re
+        if lru_cache is not None and memo_size:
+            for name in ('normalize', 'weight', 'multi', 'origin', 'unit'):
+                setattr(self, name, lru_cache(memo_size)(getattr(self, name)))
+
+    def normalize(self, raw):
+        if self.normalize_re.search(raw):
+            raw = raw.translate(self.normalize_table)
+        return raw.lower()
+
+    def weight(self, raw):
+        # 1.2kg => 1200.0, 300g => 300.0
+        m = self.weight_re.search(self.normalize(raw))
+        if not m:
+            return None
+        if m.group('kg'):
+            return float(m.group('kg')) * 1000
+        return float(m.group('g'))
+
+    def multi(self, raw):
+        # 300g*2 => '2', 3入 => '3', None without multiplier
+        m = self.multi_re.search(self.normalize(raw))
+        if not m:
+            return None
+        return ''.join(ch for ch in m.group() if ch.isalnum())
+
+    def origin(self, raw):
+        # value of the first ORIGIN_MAP key in the string, '' if none
+        s = self.normalize(raw)
+        if not self.origin_any.search(s):
+            return ''
+        return self.origin_map[min(self.origin_re.findall(s), key=self.origin_rank.get)]
+
+    def unit(self, raw):
+        # first unit of the table in the raw string, not normalized
+        if self.unit_re is None:
+            return None
+        names = self.unit_re.findall(raw)
+        if not names:
+            return None
+        return self.units[min(self.unit_rank[name] for name in names)]
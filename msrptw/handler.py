@@ -2,16 +2,179 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 from __future__ import unicode_literals
+import sys
+import time
+import datetime
 import logging
+import threading
+import traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from .database import config
 from .database.config import session_scope
 from .database.model import Log
 
 
 class SQLAlchemyHandler(logging.Handler):
+    """Write log records to the log table from a background thread,
+    emit only enqueues, records are bulk inserted every `capacity`
+    records or `interval` seconds and flushed on shutdown. The same
+    error repeated within `rate_limit` seconds is stored once with a
+    count, stored when it comes back or at flush, rows older than
+    `retention_days` are deleted"""
+
+    SUPPRESSED = '%s\n(%s秒內重複%s次)'
+
+    def __init__(self, capacity=500, interval=1.0, retention_days=None, rate_limit=60, max_queue=100000):
+        logging.Handler.__init__(self)
+        self.capacity = capacity
+        self.interval = interval
+        self.retention_days = retention_days
+        self.rate_limit = rate_limit
+        self.queue = queue.Queue(max_queue)
+        self.thread = None
+        self.pending = []
+        self.repeats = {}
+        self.purged = 0
+        self._start_lock = threading.Lock()
+
     def emit(self, record):
-        log = Log(
-            logger=record.__dict__['name'],
-            level=record.__dict__['levelname'],
-            msg=record.__dict__['msg'], )
-        with session_scope() as session:
-            session.add(log)
\ No newline at end of file
+        try:
+            row = self.format_row(record)
+            if row:
+                self.start()
+                self.queue.put_nowait(row)
+        except queue.Full:
+            pass
+        except Exception:
+            self.handleError(record)
+
+    def format_row(self, record):
+        msg = record.getMessage()
+
+        if record.levelno >= logging.ERROR and self.rate_limit:
+            # emit runs under the handler lock
+            key = (record.name, record.levelname, msg)
+            now = time.time()
+            first, count = self.repeats.get(key, (None, 0))
+            if first is not None and now - first < self.rate_limit:
+                self.repeats[key] = (first, count + 1)
+                return None
+            if len(self.repeats) > 1000:
+                self.repeats = dict((k, v) for k, v in self.repeats.items() if now - v[0] < self.rate_limit)
+            self.repeats[key] = (now, 0)
+            if count:
+                msg = self.SUPPRESSED % (msg, self.rate_limit, count)
+
+        return {
+            'logger': record.name,
+            'level': record.levelname,
+            'msg': msg,
+            'datetime': datetime.datetime.fromtimestamp(record.created),
+        }
+
+    def suppressed(self):
+        """rows of the repeats counted since their error was stored, under
+        the handler lock"""
+        rows = []
+        now = datetime.datetime.now()
+        for key, (first, count) in list(self.repeats.items()):
+            if not count:
+                continue
+            name, level, msg = key
+            rows.append({
+                'logger': name,
+                'level': level,
+                'msg': self.SUPPRESSED % (msg, self.rate_limit, count),
+                'datetime': now,
+            })
+            self.repeats[key] = (first, 0)
+        return rows
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self._start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, name='SQLAlchemyHandler')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def work(self):
+        deadline = time.time() + self.interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, dict):
+                self.pending.append(item)
+                if len(self.pending) < self.capacity and time.time() < deadline:
+                    continue
+                self.write()
+                deadline = time.time() + self.interval
+            elif item is None:
+                self.write()
+                deadline = time.time() + self.interval
+            else:
+                # flush marker, (event, stop)
+                event, stop = item
+                self.write()
+                event.set()
+                if stop:
+                    return
+
+    def write(self):
+        # no database configured yet, keep at most max_queue records around
+        if config.engine is None:
+            del self.pending[:-self.queue.maxsize]
+            return
+        if not self.pending and not self.purge_due():
+            return
+        try:
+            rows, self.pending = self.pending, []
+            with session_scope() as session:
+                if rows:
+                    session.bulk_insert_mappings(Log, rows)
+                self.purge(session)
+        except Exception:
+            # logging from here would come back to this handler
+            traceback.print_exc(file=sys.stderr)
+
+    def purge_due(self):
+        # at most once an hour
+        return self.retention_days and time.time() - self.purged >= 3600
+
+    def purge(self, session):
+        if not self.purge_due():
+            return
+        self.purged = time.time()
+        oldest = datetime.datetime.now() - datetime.timedelta(days=self.retention_days)
+        session.query(Log).filter(Log.datetime < oldest).delete(synchronize_session=False)
+
+    def flush(self, stop=False, timeout=30):
+        if self.thread is None or not self.thread.is_alive():
+            return
+        # counts of the last window would wait for an error that may not come
+        self.acquire()
+        try:
+            rows = self.suppressed()
+        finally:
+            self.release()
+        event = threading.Event()
+        try:
+            for row in rows:
+                self.queue.put(row, timeout=timeout)
+            self.queue.put((event, stop), timeout=timeout)
+        except queue.Full:
+            return
+        event.wait(timeout)
+
+    def close(self):
+        try:
+            self.flush(stop=True)
+        finally:
+            logging.Handler.close(self)
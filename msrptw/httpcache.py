@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import json
+import zlib
+import time
+import struct
+import hashlib
+import tempfile
+import threading
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import stream_decode_response_unicode
+
+replace = getattr(os, 'replace', os.rename)
+
+
+class HttpCache(object):
+    """Size bounded on-disk cache of GET responses keyed by url, params
+    and explicit headers. Bodies are zlib compressed next to their
+    ETag/Last-Modified, a hit touches the file so eviction drops the
+    least recently used entries first"""
+
+    HEADER = struct.Struct('>I')
+
+    # files being written, left alone by evict
+    TEMP_SUFFIX = '.tmp'
+
+    def __init__(self, path, max_size=512 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._size = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @staticmethod
+    def key(url, params=None, headers=None):
+        s = json.dumps([url, sorted((params or {}).items()), sorted((headers or {}).items())], sort_keys=True)
+        return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+    def file_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        path = self.file_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None, None
+        length, = self.HEADER.unpack_from(data)
+        meta = json.loads(data[self.HEADER.size:self.HEADER.size + length].decode('utf-8'))
+        body = zlib.decompress(data[self.HEADER.size + length:])
+        return meta, body
+
+    def set(self, key, response, stored=None):
+        write, done = self.writer(key, response, stored)
+        write(response.content)
+        done(True)
+
+    def writer(self, key, response, stored=None):
+        """(write, done) of an entry stored as its body is read: write(chunk)
+        compresses a chunk into a file aside, done(complete) renames it in
+        place, or drops it when the body was not read to the end"""
+        meta = {
+            'url': response.url,
+            'status': response.status_code,
+            'encoding': response.encoding,
+            'headers': dict(response.headers),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'stored': stored or time.time(),
+        }
+        meta_bytes = json.dumps(meta).encode('utf-8')
+
+        path = self.file_path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+
+        # write aside then rename, readers never see half a file
+        fd, temp = tempfile.mkstemp(dir=directory, suffix=self.TEMP_SUFFIX)
+        f = os.fdopen(fd, 'wb')
+        f.write(self.HEADER.pack(len(meta_bytes)) + meta_bytes)
+        compressor = zlib.compressobj()
+
+        def write(chunk):
+            f.write(compressor.compress(chunk))
+
+        def done(complete):
+            try:
+                if complete:
+                    f.write(compressor.flush())
+                f.close()
+                if not complete:
+                    os.remove(temp)
+                    return
+                try:
+                    old_size = os.path.getsize(path)
+                except OSError:
+                    old_size = 0
+                size = os.path.getsize(temp)
+                replace(temp, path)
+            except (IOError, OSError):
+                # removed under us, e.g. the cache cleared by hand, not cached
+                return
+
+            with self._lock:
+                self._size = self.size() + size - old_size
+                full = self._size > self.max_size
+            if full:
+                self.evict()
+
+        return write, done
+
+    def entries(self):
+        for directory, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith(self.TEMP_SUFFIX):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def size(self):
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self.entries())
+        return self._size
+
+    def evict(self):
+        # down to 90% so a full cache does not evict on every write
+        with self._lock:
+            size = sum(size for _, size, _ in self.entries())
+            for _, entry_size, path in sorted(self.entries()):
+                if size <= self.max_size * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                    size -= entry_size
+                except OSError:
+                    pass
+            self._size = size
+
+    @staticmethod
+    def response(meta, body):
+        response = Response()
+        response._content = body
+        response._content_consumed = True
+        response.status_code = meta['status']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.encoding = meta['encoding']
+        response.url = meta['url']
+        return response
+
+    def fetch(self, session, url, ttl, params=None, headers=None, **kwargs):
+        """serve from disk within ttl seconds, afterwards revalidate with
+        If-None-Match/If-Modified-Since and reuse the body on 304"""
+
+        key = self.key(url, params, headers)
+        meta, body = self.get(key)
+
+        if meta and time.time() - meta['stored'] < ttl:
+            return self.response(meta, body)
+
+        request_headers = dict(headers or {})
+        if meta and meta['etag']:
+            request_headers['If-None-Match'] = meta['etag']
+        if meta and meta['last_modified']:
+            request_headers['If-Modified-Since'] = meta['last_modified']
+
+        res = session.get(url, params=params, headers=request_headers, **kwargs)
+
+        if res.status_code == 304 and meta:
+            cached = self.response(meta, body)
+            # validators the server sent along replace the stored ones
+            for header in ('ETag', 'Last-Modified'):
+                if res.headers.get(header):
+                    cached.headers[header] = res.headers[header]
+            self.set(key, cached)
+            return cached
+
+        if res.status_code == 200 and kwargs.get('stream'):
+            # stored while the caller reads it, the body stays unread here
+            tee(res, *self.writer(key, res))
+        elif res.status_code == 200:
+            self.set(key, res)
+
+        return res
+
+
+def tee(response, write, done):
+    """response whose iter_content (and content) also hands each chunk to
+    write, done(complete) is called once the body is read to the end or
+    given up on"""
+    iter_content = response.iter_content
+    finished = []
+
+    def finish(complete):
+        if not finished:
+            finished.append(complete)
+            done(complete)
+
+    def chunks(chunk_size):
+        # one chunk ahead, a body is complete when its last chunk is handed
+        # out, a json decoder stops there without asking for the end
+        end = object()
+        try:
+            source = iter_content(chunk_size)
+            chunk = next(source, end)
+            while chunk is not end:
+                following = next(source, end)
+                write(chunk)
+                if following is end:
+                    finish(True)
+                yield chunk
+                chunk = following
+            finish(True)
+        finally:
+            finish(False)
+
+    def teed(chunk_size=1, decode_unicode=False):
+        if decode_unicode:
+            return stream_decode_response_unicode(chunks(chunk_size), response)
+        return chunks(chunk_size)
+
+    response.iter_content = teed
+    return response
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+import json
+import codecs
+
+
+class Reader(object):
+    """text buffer over an iterator of chunks, values are decoded with
+    JSONDecoder.raw_decode once they are complete in the buffer"""
+
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def read(self):
+        # drop what has been consumed, keeps the buffer around one element
+        if self.position > 65536:
+            self.buffer = self.buffer[self.position:]
+            self.position = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer += chunk
+                return True
+        self.eof = True
+        return False
+
+    def peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in self.WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read():
+                raise ValueError('unexpected end of json')
+
+    def expect(self, chars):
+        ch = self.peek()
+        if ch not in chars:
+            raise ValueError('expected %s at %s, got %s' % (chars, self.position, ch))
+        self.position += 1
+        return ch
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # a number or literal may go on in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.read()
+
+
+def iter_items(chunks, path):
+    """yield the elements of the array at path (keys and list indexes)
+    one at a time, siblings before it are skipped and nothing after the
+    array is read"""
+
+    reader = Reader(chunks)
+
+    for step in path:
+        if isinstance(step, int):
+            reader.expect('[')
+            for _ in range(step):
+                reader.value()
+                reader.expect(',')
+            continue
+
+        reader.expect('{')
+        while True:
+            if reader.peek() == '}':
+                raise KeyError(step)
+            key = reader.value()
+            reader.expect(':')
+            if key == step:
+                break
+            reader.value()
+            if reader.expect(',}') == '}':
+                raise KeyError(step)
+
+    reader.expect('[')
+    if reader.peek() == ']':
+        return
+    while True:
+        yield reader.value()
+        if reader.expect(',]') == ']':
+            return
+
+
+def iter_text(response, chunk_size=16384):
+    """decoded text chunks of a response requested with stream=True"""
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')('replace')
+    try:
+        for chunk in response.iter_content(chunk_size):
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+    finally:
+        response.close()
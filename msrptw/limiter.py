@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+import time
+import threading
+
+
+class HostLimiter(object):
+    """Per host gate of outgoing requests, a token bucket caps the request
+    rate and an AIMD window caps the requests in flight: the window grows
+    by one per window of fast answers and is cut by `backoff` on 429, 5xx,
+    connection errors or when the average latency rises above
+    `latency_factor` times the base latency, the lowest one seen lately"""
+
+    # a rise of latency smaller than this is jitter, not congestion
+    LATENCY_JITTER = 0.05
+
+    # share of its distance to the average latency the base latency rises
+    # by per answer, so a single fast outlier does not stay the base
+    BASE_DECAY = 0.05
+
+    def __init__(self, host, rate=None, burst=None, concurrency=4, min_concurrency=1, max_concurrency=32,
+                 latency_factor=2.0, backoff=0.5):
+        self.host = host
+        self.rate = rate
+        self.burst = burst or max(rate or 0, 1)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_factor = latency_factor
+        self.backoff = backoff
+
+        self.limit = float(min(max(concurrency, min_concurrency), max_concurrency))
+        self.in_flight = 0
+        self.tokens = float(self.burst)
+        self.refilled = time.time()
+        self.latency = None
+        self.base_latency = None
+        self.decreased = 0
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self._cond = threading.Condition()
+
+    def configure(self, **settings):
+        settings = dict(settings)
+        with self._cond:
+            concurrency = settings.pop('concurrency', None)
+            # a window already learned by another market of the host is kept
+            if concurrency and not self.requests:
+                self.limit = float(concurrency)
+            for key, value in settings.items():
+                setattr(self, key, value)
+            if 'rate' in settings and 'burst' not in settings:
+                self.burst = max(self.rate or 0, 1)
+            self.limit = float(min(max(self.limit, self.min_concurrency), self.max_concurrency))
+            self._cond.notify_all()
+
+    def _take_token(self):
+        # returns seconds to wait for the next token, 0 if one was taken
+        if not self.rate:
+            return 0
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                if self.in_flight >= int(self.limit):
+                    self._cond.wait()
+                    continue
+                wait = self._take_token()
+                if not wait:
+                    break
+                self._cond.wait(wait)
+            self.in_flight += 1
+            self.requests += 1
+        return time.time()
+
+    def release(self, start, status_code):
+        """status_code is None when the request raised"""
+        now = time.time()
+        elapsed = now - start
+        with self._cond:
+            self.in_flight -= 1
+
+            if status_code is None or status_code == 429 or status_code >= 500:
+                if status_code == 429:
+                    self.throttled += 1
+                    self.tokens = 0
+                else:
+                    self.errors += 1
+                self._decrease(now)
+            else:
+                self.latency = elapsed if self.latency is None else self.latency * 0.8 + elapsed * 0.2
+                if self.base_latency is None or elapsed < self.base_latency:
+                    self.base_latency = elapsed
+                else:
+                    self.base_latency += (min(self.latency, elapsed) - self.base_latency) * self.BASE_DECAY
+                if self.latency > max(self.base_latency * self.latency_factor,
+                                      self.base_latency + self.LATENCY_JITTER):
+                    self._decrease(now)
+                else:
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+            self._cond.notify_all()
+
+    def _decrease(self, now):
+        # one cut per round trip, the answers of a burst all report
+        # the same congestion
+        if now - self.decreased < (self.latency or 0):
+            return
+        self.decreased = now
+        self.limit = max(self.min_concurrency, self.limit * self.backoff)
+
+    def metrics(self):
+        with self._cond:
+            return {
+                'host': self.host,
+                'concurrency': int(self.limit),
+                'in_flight': self.in_flight,
+                'rate': self.rate,
+                'latency': self.latency,
+                'base_latency': self.base_latency,
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'errors': self.errors,
+            }
+
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def get_limiter(host):
+    with _lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = _limiters[host] = HostLimiter(host)
+    return limiter
+
+
+def configure(limits):
+    """limits maps a host to HostLimiter settings, markets sharing a host
+    share one limiter"""
+    for host, settings in limits.items():
+        get_limiter(host).configure(**settings)
+
+
+def metrics():
+    with _lock:
+        limiters = list(_limiters.values())
+    return [limiter.metrics() for limiter in limiters]
+
+
+def reset():
+    with _lock:
+        _limiters.clear()
@@ -3,17 +3,18 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 import abc
-import requests
 import json
+import time
 import logging
+import threading
 import re
 from lxml import html
 from logging.config import fileConfig
 from pathos.pools import _ThreadPool
-from pathos.multiprocessing import cpu_count
 from . import _logging_config_path
 from .database.model import Product, Price
 from .directory import Directory
+from . import connection, jsonstream, breaker
 
 fileConfig(_logging_config_path)
 log = logging.getLogger(__name__)
@@ -21,19 +22,45 @@ log = logging.getLogger(__name__)
 
 class MarketApi(Directory):
     """MarketApi class use products getter api from website,
-    loads response json with Product and Price class and do
+    parses each product object of the response json with
+    parse_product_price into Product and Price class and do
     further with Directory methods"""
     __meta__ = abc.ABCMeta
 
+    # decode only the product array of a response, item by item while
+    # it is downloaded, instead of the whole document at once
+    STREAM_JSON = False
+
     @abc.abstractmethod
     def api(self):
         return
 
+    @abc.abstractmethod
+    def parse_product_price(self, dic):
+        return
+
     @abc.abstractmethod
     def get_products_prices(self):
         return
 
-    def direct(self):
+    @staticmethod
+    def decode(res, path):
+        if MarketApi.STREAM_JSON:
+            return jsonstream.iter_items(jsonstream.iter_text(res), path)
+        dic = json.loads(res.text)
+        for key in path:
+            dic = dic[key]
+        return dic
+
+    def parse_products_prices(self, dics):
+        results = []
+        for dic in dics:
+            product, price = self.parse_product_price(dic)
+            if product and price:
+                results.append((product, price))
+        return results
+
+    def direct(self, workers=None):
 
         def browse_each(config):
 
@@ -45,28 +72,23 @@ class MarketApi(Directory):
 
                 for map_str in map_strs:
 
+                    if self.expired():
+                        return
+
                     results = self.get_products_prices(map_str)
 
                     for product, price in results:
-
-                        product = Directory.check_product(product)
-
-                        if not product.id:
-                            Directory.STACK.append((config, product, price))
-
-                        elif product.part_id:
-                            price.product = product
-                            Directory.set_price(price)
+                        self.store(config, product, price)
 
             except KeyError:
                 log.error(Directory.ERROR_MAP[1] % config.name)
 
-        cpu = cpu_count()
-        pool = _ThreadPool(cpu)
+        pool = _ThreadPool(workers or self.default_workers())
         for c in self.configs:
-            pool.apply_async(browse_each, args=(c, ))
+            pool.apply_async(self.run_task, args=(browse_each, c))
         pool.close()
         pool.join()
+        self.summarize()
 
 
 class CarrfourBrowser(MarketApi):
@@ -90,114 +112,207 @@ class CarrfourBrowser(MarketApi):
         (?:.+?)(?=[\d-]+.*|$)
     ''', re.X)
 
+    PRODUCTS_PATH = ('content', 'ProductListModel')
+
+    # detail pages fetched at the same time by one get_products_prices
+    INFOS_WORKERS = 8
+
+    # seconds origin, weight and capacity of a product id are reused,
+    # also the disk cache ttl of detail pages when one is configured.
+    # Products due for refresh (see Directory.due_refresh) skip both
+    INFOS_TTL = 7 * 24 * 3600
+
+    # Id => (time, (origin_str, weight_str, unit_str))
+    INFOS = {}
+
+    # url => [Event, infos, fresh] of a detail page being fetched
+    INFOS_INFLIGHT = {}
+
+    INFOS_LOCK = threading.Lock()
+
+    XPATH_MAP = {
+        'origin': '//div[@id="pro-content2"]//div[contains(string(), "商品來源")]/following-sibling::div[1]/text()',
+        'weight': '//div[@id="pro-content2"]//div[contains(string(), "重量")]/following-sibling::div[1]/text()',
+        'unit': '//div[@id="pro-content2"]//div[contains(string(), "容量")]/following-sibling::div[1]/text()',
+    }
+
     @staticmethod
-    def api(category_id, size, hook=None):
+    def api(category_id, size):
         params = {
             'categoryId': category_id,
             'orderBy': 21,
             'pageIndex': 1,
             'pageSize': size
         }
-        res = requests.post(CarrfourBrowser.API_ROUTE, params=params)
-        dic = json.loads(res.text, object_hook=hook)
-        return dic['content']['ProductListModel']
+        res = connection.post(CarrfourBrowser.API_ROUTE, params=params, stream=MarketApi.STREAM_JSON)
+        return MarketApi.decode(res, CarrfourBrowser.PRODUCTS_PATH)
 
     def get_products_prices(self, map_str):
 
-        def hook(dic):
-
+        results = []
+        dics = []
+        for dic in self.api(category_id=map_str[0], size=map_str[1]):
             if not dic.get('Price'):
-                return dic
+                continue
+            # recently verified products need no detail page
+            price = self.known_price(dic.get('Id'), self.listed_price(dic))
+            if price:
+                results.append((None, price))
+            else:
+                dics.append(dic)
+
+        # detail pages in their own stage instead of one by one while decoding
+        infos = self.enrich(dics)
+
+        for dic in dics:
+            if dic.get('Id') not in infos:
+                log.error(Directory.ERROR_MAP[5] % dic)
+                continue
+            product, price = self.parse_product_price(dic, infos[dic.get('Id')])
+            if product and price:
+                results.append((product, price))
+        return results
 
+    def enrich(self, dics):
+
+        def fetch(dic):
             try:
-                name_str = dic.get('Name')
-                price_str = dic.get('Price')
-                special_price = dic.get('SpecialPrice')
-                count_str = dic.get('ItemQtyPerPack')
-                origin_route = dic.get('SeName')
-                pid = str(dic.get('Id'))
-
-                # 紅蘿蔔500g => 紅蘿蔔
-                name = self.NAME_RE.findall(name_str)[0]
-
-                # get special price rather than normal price
-                if special_price:
-                    price = float(special_price)
-                else:
-                    price = float(price_str)
-
-                # get origin_str and weight_str from page
-                product_url = self.INDEX_ROUTE + origin_route
-                origin_str, weight_str, unit_str = self.get_infos(product_url)
-                origin = Directory.get_origin(origin_str, default='其他')
-
-                if weight_str:
-                    weight = self.get_weight(weight_str)
-                # try to find weight in title
-                else:
-                    weight = self.get_weight(name_str)
-
-                unit = self.get_unit(unit_str)
-
-                count = int(count_str)
-
-            except:
-                d = {
-                    'Name': name_str,
-                    'ItemQtyPerPack': count_str,
-                    'Price': price_str
-                }
-                log.error(Directory.ERROR_MAP[5] % d)
-                return dic
+                return dic.get('Id'), self.get_cached_infos(dic.get('Id'), self.INDEX_ROUTE + dic.get('SeName'),
+                                                            self.due_refresh(dic.get('Id')))
+            except breaker.CircuitOpenError:
+                return dic.get('Id'), None
+            except Exception as e:
+                log.exception(e)
+                return dic.get('Id'), None
+
+        pool = _ThreadPool(self.INFOS_WORKERS)
+        try:
+            results = pool.map(fetch, dics)
+        finally:
+            pool.close()
+            pool.join()
+
+        return dict((id, infos) for id, infos in results if infos is not None)
+
+    @classmethod
+    def get_cached_infos(cls, id, url, fresh=False):
+        """infos of a detail page, fresh ones skip the memo and the disk
+        cache, they verify the product again"""
+        ttl = 0 if fresh else cls.INFOS_TTL
+
+        with cls.INFOS_LOCK:
+            cached = cls.INFOS.get(id)
+            if not fresh and cached and time.time() - cached[0] < cls.INFOS_TTL:
+                return cached[1]
+            inflight = cls.INFOS_INFLIGHT.get(url)
+            owner = inflight is None
+            if owner:
+                inflight = cls.INFOS_INFLIGHT[url] = [threading.Event(), None, fresh]
+
+        # the same url is already being fetched by another thread
+        if not owner:
+            inflight[0].wait()
+            infos = inflight[1]
+            if infos is None or (fresh and not inflight[2]):
+                infos = cls.get_infos(url, ttl)
+            with cls.INFOS_LOCK:
+                cls.INFOS[id] = (time.time(), infos)
+            return infos
+
+        try:
+            infos = inflight[1] = cls.get_infos(url, ttl)
+            with cls.INFOS_LOCK:
+                cls.INFOS[id] = (time.time(), infos)
+            return infos
+        finally:
+            with cls.INFOS_LOCK:
+                del cls.INFOS_INFLIGHT[url]
+            inflight[0].set()
+
+    @staticmethod
+    def listed_price(dic):
+        try:
+            return float(dic.get('SpecialPrice') or dic.get('Price'))
+        except (TypeError, ValueError):
+            return None
+
+    def parse_product_price(self, dic, infos=None):
+
+        if not dic.get('Price'):
+            return None, None
+
+        try:
+            name_str = dic.get('Name')
+            price_str = dic.get('Price')
+            special_price = dic.get('SpecialPrice')
+            count_str = dic.get('ItemQtyPerPack')
+            origin_route = dic.get('SeName')
+            pid = str(dic.get('Id'))
+
+            # 紅蘿蔔500g => 紅蘿蔔
+            name = self.NAME_RE.findall(name_str)[0]
+
+            # get special price rather than normal price
+            if special_price:
+                price = float(special_price)
+            else:
+                price = float(price_str)
 
-            price = Price(price=price,
-                          date=self.date)
+            # get origin_str and weight_str from page
+            product_url = self.INDEX_ROUTE + origin_route
+            if infos is None:
+                infos = self.get_infos(product_url, self.CACHE_TTL)
+            origin_str, weight_str, unit_str = infos
+            origin = Directory.get_origin(origin_str, default='其他')
 
-            product = Product(source=product_url,
-                              name=name,
-                              market_id=self.market.id,
-                              pid=pid,
-                              origin=origin,
-                              weight=weight,
-                              count=count,
-                              unit=unit)
+            if weight_str:
+                weight = self.get_weight(weight_str)
+            # try to find weight in title
+            else:
+                weight = self.get_weight(name_str)
 
-            return product, price
+            unit = self.get_unit(unit_str)
 
-        results = []
+            count = int(count_str)
 
-        ps = self.api(category_id=map_str[0],
-                      size=map_str[1],
-                      hook=hook)
+        except:
+            d = {
+                'Name': dic.get('Name'),
+                'ItemQtyPerPack': dic.get('ItemQtyPerPack'),
+                'Price': dic.get('Price')
+            }
+            log.error(Directory.ERROR_MAP[5] % d)
+            return None, None
 
-        for item in ps:
-            try:
-                if isinstance(item[0], Product) and isinstance(item[1], Price):
-                    results.append(item)
-            except KeyError:
-                pass
+        price = Price(price=price,
+                      date=self.date)
 
-        return results
+        product = Product(source=product_url,
+                          name=name,
+                          market_id=self.market.id,
+                          pid=pid,
+                          origin_id=origin.id,
+                          weight=weight,
+                          count=count,
+                          unit_id=unit.id if unit else None)
+
+        return product, price
 
     @staticmethod
-    def get_infos(url):
+    def get_infos(url, ttl=None):
+        res = connection.get(url, ttl=ttl)
+        return CarrfourBrowser.parse_infos(html.fromstring(res.content))
 
-        res = requests.get(url)
-        page = html.fromstring(res.content)
+    @staticmethod
+    def parse_infos(page):
 
         xpath = Directory.flat_xpath
 
-        origin_str = xpath(page, '''
-            //div[@id="pro-content2"]//div[contains(string(), "商品來源")]/following-sibling::div[1]/text()
-        ''')
+        origin_str = xpath(page, CarrfourBrowser.XPATH_MAP['origin'])
 
-        weight_str = xpath(page, '''
-            //div[@id="pro-content2"]//div[contains(string(), "重量")]/following-sibling::div[1]/text()
-        ''')
+        weight_str = xpath(page, CarrfourBrowser.XPATH_MAP['weight'])
 
-        unit_str = xpath(page, '''
-            //div[@id="pro-content2"]//div[contains(string(), "容量")]/following-sibling::div[1]/text()
-        ''')
+        unit_str = xpath(page, CarrfourBrowser.XPATH_MAP['unit'])
 
         return origin_str, weight_str, unit_str
 
@@ -207,6 +322,13 @@ class HonestBee(MarketApi):
     INDEX_ROUTE = 'https://www.honestbee.tw/zh-TW'
     API_ROUTE = 'https://www.honestbee.tw/api/api/departments/%s'
 
+    PRODUCTS_PATH = ('products', )
+
+    # one api for all the stores below, which share this limiter
+    LIMITS = {
+        'www.honestbee.tw': {'rate': 20, 'concurrency': 8, 'max_concurrency': 48},
+    }
+
     def __init__(self, **args):
         super(HonestBee, self).__init__()
         if not self.STORE_ID:
@@ -218,7 +340,7 @@ class HonestBee(MarketApi):
         }
 
     @staticmethod
-    def api(config_id, store_id, category_ids, page, header, hook=None):
+    def api(config_id, store_id, category_ids, page, header, ttl=None):
 
         params = {
             'categoryIds[]': category_ids,
@@ -227,87 +349,82 @@ class HonestBee(MarketApi):
             'page': page
         }
 
-        res = requests.get(HonestBee.API_ROUTE % config_id, params=params, headers=header)
-        dic = json.loads(res.text, object_hook=hook)
-        return dic['products']
+        res = connection.get(HonestBee.API_ROUTE % config_id, ttl=ttl, params=params, headers=header,
+                             stream=MarketApi.STREAM_JSON)
+        return MarketApi.decode(res, HonestBee.PRODUCTS_PATH)
 
     def get_products_prices(self, map_str):
 
-        def hook(dic):
+        results = []
 
-            if dic.get('status') != 'status_available':
-                return dic
+        page = map_str[2]
 
-            try:
-                name_str = dic.get('title')
-                unit_type = dic.get('unitType')
-                price_str = dic.get('price')
-                size_str = dic.get('size')
+        for i in range(1, page + 1):
 
-                pid_str = dic.get('pid')
+            ps = self.api(config_id=map_str[0],
+                          store_id=self.STORE_ID,
+                          category_ids=map_str[1],
+                          page=i,
+                          header=self.header,
+                          ttl=self.CACHE_TTL)
 
-                pid = str(pid_str)
-                name = self.normalize(name_str)
-                weight_str = self.normalize(size_str)
-                price = float(price_str)
+            results += self.parse_products_prices(ps)
 
-                # try to find unit in size key
-                count = self.get_count(size_str)
+        return results
 
-                # try to find weight in size key
-                weight = self.get_weight(weight_str)
+    def parse_product_price(self, dic):
 
-                # try to find origin in title key
-                origin = self.get_origin(name_str, default='臺灣')
+        if dic.get('status') != 'status_available':
+            return None, None
 
-                # try to find unit in title
-                unit = self.get_unit(name_str)
+        try:
+            name_str = dic.get('title')
+            unit_type = dic.get('unitType')
+            price_str = dic.get('price')
+            size_str = dic.get('size')
 
-            except:
-                d = {
-                    'title': name_str,
-                    'unit_type': unit_type,
-                    'size': size_str,
-                    'price': price_str
-                }
-                log.error(Directory.ERROR_MAP[5] % d)
-                return dic
+            pid_str = dic.get('pid')
 
-            price = Price(price=price,
-                          date=self.date)
+            pid = str(pid_str)
+            name = self.normalize(name_str)
+            weight_str = self.normalize(size_str)
+            price = float(price_str)
 
-            product = Product(source=HonestBee.INDEX_ROUTE,
-                              name=name,
-                              market_id=self.market.id,
-                              pid=pid,
-                              origin=origin,
-                              weight=weight,
-                              count=count,
-                              unit=unit)
+            # try to find unit in size key
+            count = self.get_count(size_str)
 
-            return product, price
+            # try to find weight in size key
+            weight = self.get_weight(weight_str)
 
-        results = []
+            # try to find origin in title key
+            origin = self.get_origin(name_str, default='臺灣')
 
-        page = map_str[2]
+            # try to find unit in title
+            unit = self.get_unit(name_str)
 
-        for i in range(1, page + 1):
+        except:
+            d = {
+                'title': dic.get('title'),
+                'unit_type': dic.get('unitType'),
+                'size': dic.get('size'),
+                'price': dic.get('price')
+            }
+            log.error(Directory.ERROR_MAP[5] % d)
+            return None, None
 
-            ps = self.api(config_id=map_str[0],
-                          store_id=self.STORE_ID,
-                          category_ids=map_str[1],
-                          page=i,
-                          header=self.header,
-                          hook=hook)
+        price = Price(price=price,
+                      date=self.date)
 
-            for item in ps:
-                try:
-                    if isinstance(item[0], Product) and isinstance(item[1], Price):
-                        results.append(item)
-                except KeyError:
-                    pass
+        product = Product(source=HonestBee.INDEX_ROUTE,
+                          name=name,
+                          market_id=self.market.id,
+                          pid=pid,
+                          origin_id=origin.id,
+                          weight=weight,
+                          count=count,
+                          unit_id=unit.id if unit else None)
 
-        return results
+        return product, price
 
 
 class Rtmart(HonestBee):
@@ -407,6 +524,8 @@ class Geant(MarketApi):
     API_ROUTE = 'https://shopping.friday.tw/ec2/getBottomCategoryProduct'
     INDEX_ROUTE = 'https://shopping.friday.tw'
 
+    PRODUCTS_PATH = ('pageModel', 'contentBlock', 'itemList', 0, 'bottomCategoryProducts')
+
     PRODUCT_MAP = {
         '海鮮': ['384550', '384324'],
         '牛肉': ['384298'],
@@ -423,79 +542,64 @@ class Geant(MarketApi):
         return 'Geant()'
 
     @staticmethod
-    def api(config_id, hook=None):
+    def api(config_id, ttl=None):
 
         params = {
             'cid': config_id,
         }
 
-        res = requests.get(Geant.API_ROUTE, params=params)
-        dic = json.loads(res.text, object_hook=hook)
-        return dic['pageModel']['contentBlock']['itemList'][0]['bottomCategoryProducts']
+        res = connection.get(Geant.API_ROUTE, ttl=ttl, params=params, stream=MarketApi.STREAM_JSON)
+        return MarketApi.decode(res, Geant.PRODUCTS_PATH)
 
     def get_products_prices(self, map_str):
+        return self.parse_products_prices(self.api(config_id=map_str,
+                                                   ttl=self.CACHE_TTL))
 
-        def hook(dic):
-
-            try:
-                name_str = dic.get('productName', None)
-                if name_str:
-                    name = self.normalize(name_str)
-
-                pid = dic.get('productId', None)
+    def parse_product_price(self, dic):
 
-                price_str = dic.get('salePrice', None)
-                if price_str:
-                    price = float(price_str)
+        name_str = dic.get('productName', None)
+        price_str = dic.get('salePrice', None)
+        info_str = dic.get('descSpecification', '')
 
-                info_str = dic.get('descSpecification', '')
+        try:
+            name = self.normalize(name_str)
 
-                # try to find unit in size key
-                count = self.get_count(info_str)
+            pid = dic.get('productId', None)
 
-                # try to find weight in size key
-                weight = self.get_weight(info_str)
+            price = float(price_str)
 
-                # try to find origin in title key
-                origin = self.get_origin(name_str, default='臺灣')
+            # try to find unit in size key
+            count = self.get_count(info_str)
 
-                # try to find unit in title
-                unit = self.get_unit(name_str)
+            # try to find weight in size key
+            weight = self.get_weight(info_str)
 
-            except:
-                if name_str or info_str or price_str:
-                    d = {
-                        'title': name_str,
-                        'info': info_str,
-                        'price': price_str
-                    }
-                    log.error(Directory.ERROR_MAP[5] % d)
-                return dic
+            # try to find origin in title key
+            origin = self.get_origin(name_str, default='臺灣')
 
-            price = Price(price=price,
-                          date=self.date)
+            # try to find unit in title
+            unit = self.get_unit(name_str)
 
-            product = Product(source=Geant.INDEX_ROUTE,
-                              name=name,
-                              market_id=self.market.id,
-                              pid=pid,
-                              origin=origin,
-                              weight=weight,
-                              count=count,
-                              unit=unit)
-
-            return product, price
-
-        results = []
+        except:
+            if name_str or info_str or price_str:
+                d = {
+                    'title': name_str,
+                    'info': info_str,
+                    'price': price_str
+                }
+                log.error(Directory.ERROR_MAP[5] % d)
+            return None, None
 
-        ps = self.api(config_id=map_str,
-                      hook=hook)
+        price = Price(price=price,
+                      date=self.date)
 
-        for item in ps:
-            try:
-                if isinstance(item[0], Product) and isinstance(item[1], Price):
-                    results.append(item)
-            except KeyError:
-                pass
+        product = Product(source=Geant.INDEX_ROUTE,
+                          name=name,
+                          market_id=self.market.id,
+                          pid=pid,
+                          origin_id=origin.id,
+                          weight=weight,
+                          count=count,
+                          unit_id=unit.id if unit else None)
 
-        return results
\ No newline at end of file
+        return product, price
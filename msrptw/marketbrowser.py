@@ -13,10 +13,12 @@ except:
 from lxml import html
 from logging.config import fileConfig
 from pathos.pools import _ThreadPool
-from pathos.multiprocessing import cpu_count
+from .database import config
+from .database.cache import references
 from .database.model import Product, Price
 from . import _logging_config_path
 from .directory import Directory
+from . import connection, breaker
 
 
 fileConfig(_logging_config_path)
@@ -25,20 +27,73 @@ log = logging.getLogger(__name__)
 
 class MarketBrowser(Directory):
     """Get all urls from products page with abstract method get_product_urls,
-    and browse each product with get_product_price method for getting Product
-    and Price instance and do further with Directory methods"""
+    and browse each product with get_product_price method, which parses the
+    page with abstract method parse_product_price for getting Product and
+    Price instance and do further with Directory methods"""
     __metaclass__ = abc.ABCMeta
 
+    # item, url and price xpaths of a listing page, url and price relative
+    # to an item, prices found there spare the product page of products
+    # verified within REFRESH_DAYS
+    LISTING_XPATH = None
+
+    def __init__(self):
+        super(MarketBrowser, self).__init__()
+        # product url => price shown on a listing page
+        self.listed = {}
+
+    def __getstate__(self):
+        state = super(MarketBrowser, self).__getstate__()
+        state.pop('listed', None)
+        return state
+
     @abc.abstractmethod
-    def get_product_urls(self):
+    def get_product_urls(self, map_str):
         return
 
+    @staticmethod
     @abc.abstractmethod
-    def get_product_price(self):
+    def get_pid(url):
         return
 
+    def parse_listing(self, page, prefix=''):
+        """product urls of a listing page. The price of an item is only
+        remembered when the item holds one product url and one price,
+        any other item (bundles, a grid row without its own container,
+        an original and a special price) leaves its products to their
+        product page"""
+        urls = set()
+        for item in page.xpath(self.LISTING_XPATH['item']):
+            hrefs = set(prefix + href for href in item.xpath(self.LISTING_XPATH['url']))
+            urls.update(hrefs)
+            price_strs = item.xpath(self.LISTING_XPATH['price'])
+            if len(hrefs) != 1 or len(price_strs) != 1:
+                continue
+            try:
+                self.listed[hrefs.pop()] = int(Directory.NUM_RE.findall(price_strs[0].replace(',', ''))[0])
+            except (IndexError, ValueError):
+                pass
+        return list(urls)
+
+    def listed_price(self, url):
+        try:
+            pid = self.get_pid(url)
+        except (IndexError, KeyError):
+            return None
+        return self.known_price(pid, self.listed.get(url))
+
+    @abc.abstractmethod
+    def parse_product_price(self, url, page):
+        return
+
+    def get_product_price(self, url):
+        page = MarketBrowser.get_html(url, self.CACHE_TTL)
+        return self.parse_product_price(url, page)
+
     def config_generator(self):
         for config in self.configs:
+            if self.expired():
+                return
             log.info(MarketBrowser.INFO_MAP[0] % (self.market.name, config.name))
             urls = []
             try:
@@ -49,42 +104,114 @@ class MarketBrowser(Directory):
             except KeyError:
                 log.error(Directory.ERROR_MAP[1] % config.name)
 
-    def direct(self):
+    def direct(self, workers=None, processes=None):
+
+        if processes:
+            return self.direct_processes(workers, processes)
 
         def browse_each(config, url):
+            price = self.listed_price(url)
+            if price:
+                self.store(config, None, price)
+                return
             product, price = self.get_product_price(url)
             if not product and not price:
                 return
-            # return self if not exists
-            product = self.check_product(product)
-            if not product.id:
-                Directory.STACK.append((config, product, price))
-            elif product.part_id:
-                price.product = product
-                self.set_price(price)
-            return
-
-        cpu = cpu_count()
-        pool = _ThreadPool(cpu)
+            self.store(config, product, price)
+
+        pool = _ThreadPool(workers or self.default_workers())
         for c, urls in self.config_generator():
             for u in urls:
-                pool.apply_async(browse_each, args=(c, u))
+                pool.apply_async(self.run_task, args=(browse_each, c, u))
         pool.close()
         pool.join()
+        self.summarize()
+
+    def direct_processes(self, workers, processes):
+        """threads only fetch raw pages, lxml and regex work runs on a
+        process pool that sends back plain records for the threads to
+        store"""
+
+        # python 3 only, like the asyncio engine
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        db_path = config.engine.url.__to_string__(hide_password=False)
+        executor = ProcessPoolExecutor(processes,
+                                       mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_parser,
+                                       initargs=(self, references.snapshot(), db_path))
+
+        def browse_each(config, url):
+            price = self.listed_price(url)
+            if price:
+                self.store(config, None, price)
+                return
+            content = MarketBrowser.fetch_html(url, self.CACHE_TTL)
+            record = executor.submit(_parse_record, url, content).result()
+            if not record:
+                return
+            product, price = self.from_record(record)
+            self.store(config, product, price)
+
+        pool = _ThreadPool(workers or self.default_workers())
+        try:
+            for c, urls in self.config_generator():
+                for u in urls:
+                    pool.apply_async(self.run_task, args=(browse_each, c, u))
+            pool.close()
+            pool.join()
+        finally:
+            executor.shutdown()
+        self.summarize()
 
     @staticmethod
-    def get_html(url):
-        header = {
-            'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/71.0.3578.80 Safari/537.36',
-        }
+    def fetch_html(url, ttl=None):
         try:
-            res = requests.get(url, timeout=30, headers=header)
-            parsed_page = html.fromstring(res.content)
+            res = connection.get(url, ttl=ttl)
+        except breaker.CircuitOpenError:
+            # logged once when the circuit opened
+            return None
         except requests.exceptions.Timeout:
             log.error(Directory.ERROR_MAP[4] % url)
+            return None
+        except requests.exceptions.RequestException as e:
+            log.error(Directory.ERROR_MAP[8] % (url, e))
+            return None
+        # an error page or the 404 of a replay miss parses to nothing
+        if res.status_code != 200:
+            log.error(Directory.ERROR_MAP[8] % (url, res.status_code))
+            return None
+        return res.content
+
+    @staticmethod
+    def parse_html(content):
+        if not content:
             return html.Element('html')
+        return html.fromstring(content)
 
-        return parsed_page
+    @staticmethod
+    def get_html(url, ttl=None):
+        return MarketBrowser.parse_html(MarketBrowser.fetch_html(url, ttl))
+
+
+# state of a parsing process of MarketBrowser.direct_processes
+_parser = None
+
+
+def _init_parser(market, tables, db_path):
+    global _parser
+    # logs of the worker still go to the log table
+    config.setup_session(db_path)
+    references.preload(tables)
+    _parser = market
+
+
+def _parse_record(url, content):
+    product, price = _parser.parse_product_price(url, MarketBrowser.parse_html(content))
+    if not product or not price:
+        return None
+    return _parser.to_record(product, price)
 
 
 class WellcomeBrowser(MarketBrowser):
@@ -103,6 +230,19 @@ class WellcomeBrowser(MarketBrowser):
         '水果': [(2, 4), (2, 6)]
     }
 
+    XPATH_MAP = {
+        'name': '//div[@class="product-name"]/text()',
+        'spec': '//ul[@class="product-list"]/li[3]/text()',
+        'origin': '//ul[@class="product-list"]/li[2]/text()',
+        'price': '//span[@class="item-price"]/text()',
+    }
+
+    LISTING_XPATH = {
+        'item': '//div[@class="item-name"]/..',
+        'url': './div[@class="item-name"]/a/@href',
+        'price': './/span[@class="item-price"]/text()',
+    }
+
     NAME_RE = re.compile('''
             (?:.+?)(?=[\d])
     ''', re.X)
@@ -113,26 +253,27 @@ class WellcomeBrowser(MarketBrowser):
     def __repr__(self):
         return 'WellcomeBrowser()'
 
-    @staticmethod
-    def get_product_urls(map_str):
+    def get_product_urls(self, map_str):
         url = WellcomeBrowser.PRODUCTS_ROUTE % (map_str[0], map_str[1])
-        page = MarketBrowser.get_html(url)
-        urls = page.xpath('//div[@class="item-name"]/a/@href')
-        return [WellcomeBrowser.INDEX_ROUTE + url for url in set(urls)]
+        page = MarketBrowser.get_html(url, WellcomeBrowser.CACHE_TTL)
+        return self.parse_listing(page, WellcomeBrowser.INDEX_ROUTE)
 
-    def get_product_price(self, url):
+    @staticmethod
+    def get_pid(url):
+        # product/view/POOYb => POOYb
+        return Directory.STR_RE.findall(url)[-1]
 
-        page = MarketBrowser.get_html(url)
+    def parse_product_price(self, url, page):
 
         xpath = Directory.flat_xpath
 
-        name_str = xpath(page, '//div[@class="product-name"]/text()')
+        name_str = xpath(page, self.XPATH_MAP['name'])
 
-        spec_str = xpath(page, '//ul[@class="product-list"]/li[3]/text()')
+        spec_str = xpath(page, self.XPATH_MAP['spec'])
 
-        origin_str = xpath(page, '//ul[@class="product-list"]/li[2]/text()')
+        origin_str = xpath(page, self.XPATH_MAP['origin'])
 
-        price_str = xpath(page, '//span[@class="item-price"]/text()')
+        price_str = xpath(page, self.XPATH_MAP['price'])
 
         try:
             # 紅蘿蔔3入/袋 => 紅蘿蔔
@@ -146,8 +287,7 @@ class WellcomeBrowser(MarketBrowser):
             if not weight:
                 count = self.get_count(spec_str)
 
-            # product/view/POOYb => POOYb
-            pid = Directory.STR_RE.findall(url)[-1]
+            pid = self.get_pid(url)
 
             # 產地：台灣 => Origin(name='臺灣')
             origin = self.get_origin(origin_str)
@@ -165,12 +305,12 @@ class WellcomeBrowser(MarketBrowser):
 
         product = Product(source=url,
                           name=name,
-                          origin=origin,
+                          origin_id=origin.id,
                           market_id=self.market.id,
                           pid=pid,
                           weight=weight,
                           count=count,
-                          unit=unit)
+                          unit_id=unit.id if unit else None)
 
         price = Price(price=price, date=self.date)
 
@@ -184,6 +324,11 @@ class FengKangBrowser(MarketBrowser):
     PRODUCTS_ROUTE = 'http://shop.supermarket.com.tw/Shop_ProductList.html?c0=%s&c1=%s&c2=%s&page=%s'
     INDEX_ROUTE = 'http://shop.supermarket.com.tw'
 
+    # small site, slows down quickly under load
+    LIMITS = {
+        'shop.supermarket.com.tw': {'rate': 5, 'concurrency': 2, 'max_concurrency': 6},
+    }
+
     PRODUCT_MAP = {
         '常溫商品': [(0, 153, 236, 1), (0, 153, 358, 1), (0, 153, 245, 1), (0, 153, 387, 1),
                  (0, 153, 245, 1), (0, 154, 260, 1), (0, 154, 246, 1), (0, 154, 254, 1)],
@@ -200,6 +345,19 @@ class FengKangBrowser(MarketBrowser):
         '雜貨': [(0, 153, 357, 1)],
     }
 
+    XPATH_MAP = {
+        'name': '//div[@class="vw"]/div[@class="tt21"]/text()',
+        'price': '//div[@class="vw"]/div[@class="tt23"]//h4/text()',
+        'origin': '//div[@id="tab1"]/div[contains(string(), "產　　地：")]/text()',
+        'unit': '//div[@id="tab1"]/div[contains(string(), "包　　裝：")]/text()',
+    }
+
+    LISTING_XPATH = {
+        'item': '//div[@class="lisa3 lisa3-2"]//div[@class="t2"]/..',
+        'url': './div[@class="t2"]/a/@href',
+        'price': './/h4/text()',
+    }
+
     NAME_RE = re.compile('''
         (?:.+?)(?=\d+.*|約.*|\W+.*|$)
     ''', re.X)
@@ -222,26 +380,27 @@ class FengKangBrowser(MarketBrowser):
     def __repr__(self):
         return 'FengKangBrowser()'
 
-    @staticmethod
-    def get_product_urls(map_str):
+    def get_product_urls(self, map_str):
         url = FengKangBrowser.PRODUCTS_ROUTE % (map_str[0], map_str[1], map_str[2], map_str[3])
-        page = MarketBrowser.get_html(url)
-        urls = page.xpath('//div[@class="lisa3 lisa3-2"]//div[@class="t2"]/a/@href')
-        return [FengKangBrowser.INDEX_ROUTE + url for url in set(urls)]
+        page = MarketBrowser.get_html(url, FengKangBrowser.CACHE_TTL)
+        return self.parse_listing(page, FengKangBrowser.INDEX_ROUTE)
 
-    def get_product_price(self, url):
+    @staticmethod
+    def get_pid(url):
+        # 胡蘿蔔-Shop-6738.html => 6738
+        return FengKangBrowser.PID_RE.findall(url)[0]
 
-        page = MarketBrowser.get_html(url)
+    def parse_product_price(self, url, page):
 
         xpath = Directory.flat_xpath
 
-        name_str = xpath(page, '//div[@class="vw"]/div[@class="tt21"]/text()')
+        name_str = xpath(page, self.XPATH_MAP['name'])
 
-        price_str = xpath(page, '//div[@class="vw"]/div[@class="tt23"]//h4/text()')
+        price_str = xpath(page, self.XPATH_MAP['price'])
 
-        origin_str = xpath(page, '//div[@id="tab1"]/div[contains(string(), "產　　地：")]/text()')
+        origin_str = xpath(page, self.XPATH_MAP['origin'])
 
-        unit_str = xpath(page, '//div[@id="tab1"]/div[contains(string(), "包　　裝：")]/text()')
+        unit_str = xpath(page, self.XPATH_MAP['unit'])
 
         try:
             # 胡蘿蔔/約500g => 胡蘿蔔
@@ -250,8 +409,7 @@ class FengKangBrowser(MarketBrowser):
             # try to find weight in title, could be null
             weight = self.get_weight(name_str)
 
-            # 胡蘿蔔-Shop-6738.html => 6738
-            pid = FengKangBrowser.PID_RE.findall(url)[0]
+            pid = self.get_pid(url)
 
             # try to find origin in introduction
             try:
@@ -276,12 +434,12 @@ class FengKangBrowser(MarketBrowser):
 
         product = Product(source=url,
                           name=name,
-                          origin=origin,
+                          origin_id=origin.id,
                           market_id=self.market.id,
                           pid=pid,
                           weight=weight,
                           count=count,
-                          unit=unit)
+                          unit_id=unit.id if unit else None)
 
         price = Price(price=price, date=self.date)
 
@@ -307,6 +465,18 @@ class RtmartBrowser(MarketBrowser):
         '雜貨': ['3767']
     }
 
+    XPATH_MAP = {
+        'name': '//div[@class="pro_rightbox"]/h2[@class="product_Titlename"]/span/text()',
+        'price': '//div[@class="product_PRICEBOX"]//span[@class="price_num"]/text()',
+        'intro': '//table[@class="title_word"]//table/tr/td/text()',
+    }
+
+    LISTING_XPATH = {
+        'item': '//div[@class="classify_prolistBox"]//h5[@class="for_proname"]/..',
+        'url': './h5[@class="for_proname"]/a/@href',
+        'price': './/span[@class="price_num"]/text()',
+    }
+
     NAME_RE = re.compile('''
         (?:.+?)(?=\d+.*|\(約+.*|$)
     ''', re.X)
@@ -325,27 +495,28 @@ class RtmartBrowser(MarketBrowser):
     def __repr__(self):
         return 'FengKangBrowser()'
 
-    @staticmethod
-    def get_product_urls(map_str):
+    def get_product_urls(self, map_str):
         if len(map_str) == 4:
             url = RtmartBrowser.FRESH_ROUTE % map_str
         else:
             url = RtmartBrowser.NORMAL_ROUTE % map_str
-        page = MarketBrowser.get_html(url)
-        urls = page.xpath('//div[@class="classify_prolistBox"]//h5[@class="for_proname"]/a/@href')
-        return [url for url in set(urls)]
+        page = MarketBrowser.get_html(url, RtmartBrowser.CACHE_TTL)
+        return self.parse_listing(page)
 
-    def get_product_price(self, url):
+    @staticmethod
+    def get_pid(url):
+        # &prod_no=12345 => 12345
+        return urlparse.parse_qs(url)['prod_no'][0]
 
-        page = MarketBrowser.get_html(url)
+    def parse_product_price(self, url, page):
 
         xpath = Directory.flat_xpath
 
-        name_str = xpath(page, '//div[@class="pro_rightbox"]/h2[@class="product_Titlename"]/span/text()')
+        name_str = xpath(page, self.XPATH_MAP['name'])
 
-        price_str = xpath(page, '//div[@class="product_PRICEBOX"]//span[@class="price_num"]/text()')
+        price_str = xpath(page, self.XPATH_MAP['price'])
 
-        intro_str = xpath(page, '//table[@class="title_word"]//table/tr/td/text()')
+        intro_str = xpath(page, self.XPATH_MAP['intro'])
 
         try:
 
@@ -367,8 +538,7 @@ class RtmartBrowser(MarketBrowser):
             except IndexError:
                 weight = self.get_weight(name_str)
 
-            # &prod_no=12345 => 12345
-            pid = urlparse.parse_qs(url)['prod_no'][0]
+            pid = self.get_pid(url)
 
             # try to find origin in introduction
             try:
@@ -394,12 +564,12 @@ class RtmartBrowser(MarketBrowser):
             return None, None
 
         product = Product(source=url,
-                          name=name, origin=origin,
+                          name=name, origin_id=origin.id,
                           market_id=self.market.id,
                           pid=pid,
                           weight=weight,
                           count=count,
-                          unit=unit)
+                          unit_id=unit.id if unit else None)
 
         price = Price(price=price, date=self.date)
 
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from collections import deque
+
+
+class Automaton(object):
+    """Aho-Corasick automaton, finds every keyword of a fixed set in a
+    text with one pass over its characters, overlapping keywords
+    included"""
+
+    def __init__(self, keywords):
+
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+
+        for keyword in keywords:
+            state = 0
+            for ch in keyword:
+                if ch not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                    self.goto[state][ch] = len(self.goto) - 1
+                state = self.goto[state][ch]
+            self.output[state] = (keyword, )
+
+        # breadth first, a state's fail link is resolved before its children
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(ch, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                self.output[child] += self.output[self.fail[child]]
+
+    def search(self, text):
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+class ConfigMatcher(object):
+    """Parts, aliases and anti aliases of one Config compiled into a
+    single automaton, classify keeps the precedence of checking part by
+    part: first part found wins, non anti aliases set alias_id even on a
+    part rejected later by an anti alias"""
+
+    def __init__(self, config):
+
+        self.parts = list(config.parts)
+        self.aliases = [list(part.aliases) for part in self.parts]
+
+        # keyword => indexes of the parts using it
+        self.index = {}
+        for i, part in enumerate(self.parts):
+            self.index.setdefault(part.name, set()).add(i)
+            for alias in self.aliases[i]:
+                self.index.setdefault(alias.name, set()).add(i)
+
+        # '' is in every name
+        self.always = self.index.pop('', set())
+
+        self.automaton = Automaton(self.index.keys())
+
+    def classify(self, name):
+        """return (part, alias_id), part is None when nothing matches and
+        alias_id is None when no alias was found"""
+
+        found = self.automaton.search(name)
+        found.add('')
+
+        candidates = set(self.always)
+        for keyword in found:
+            candidates.update(self.index.get(keyword, ()))
+
+        alias_id = None
+        for i in sorted(candidates):
+            part = self.parts[i]
+            find = part.name in found
+            for alias in self.aliases[i]:
+                if alias.name in found and not alias.anti:
+                    alias_id = alias.id
+                    find = True
+            for alias in self.aliases[i]:
+                if alias.name in found and alias.anti:
+                    find = False
+            if find:
+                return part, alias_id
+        return None, alias_id
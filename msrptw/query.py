@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Prices of a part across markets, each question one SQL statement
+walking the part and product indexes (`--migrate` adds them to an
+existing database). Daily prices and price intervals are read alike,
+intervals are expanded to days. A day found in both (a database switched
+to intervals the day it was crawled again) counts its daily price only.
+
+    $ python -m msrptw.query --dbpath sqlite:///msrptw.db latest 雞胸肉
+    $ python -m msrptw.query --dbpath sqlite:///msrptw.db series 紅蘿蔔 --start 2018-09-01 --end 2018-11-30 --market 頂好
+    $ python -m msrptw.query --dbpath sqlite:///msrptw.db summary 紅蘿蔔 --start 2018-09-01 --end 2018-11-30
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+import sys
+import datetime
+from argparse import ArgumentParser
+from sqlalchemy import func, case, and_, select, join, union_all, literal, Date
+from .database import config
+from .database.config import session_scope
+from .database.model import Part, Market, Origin, Product, Price, PriceInterval, DailyPartSummary
+
+# a price older than this is a product no longer sold
+MAX_AGE = 7
+
+
+def per_kg(price):
+    # price of a kg, null without weight
+    grams = Product.weight * func.coalesce(func.nullif(Product.count, 0), 1)
+    return case([(Product.weight > 0, price * 1000.0 / grams)], else_=None)
+
+
+# source of a price row, the daily price first when both have the day
+DAILY = 0
+INTERVAL = 1
+
+
+def price_rows(start, end, products=None):
+    """(product_id, valid_from, valid_to, price, source) of the daily prices
+    and the price intervals overlapping start to end, a daily price being a
+    one day interval, of the product ids selected by products or of every
+    product"""
+    daily = select([
+        Price.product_id, Price.date.label('valid_from'), Price.date.label('valid_to'), Price.price,
+        literal(DAILY).label('source')
+    ]).where(
+        Price.date >= start
+    ).where(
+        Price.date <= end
+    ).where(
+        Price.price.isnot(None)
+    )
+    intervals = select([
+        PriceInterval.product_id, PriceInterval.valid_from, PriceInterval.valid_to, PriceInterval.price,
+        literal(INTERVAL).label('source')
+    ]).where(
+        PriceInterval.valid_from <= end
+    ).where(
+        PriceInterval.valid_to >= start
+    ).where(
+        PriceInterval.price.isnot(None)
+    )
+    if products is not None:
+        daily = daily.where(Price.product_id.in_(products))
+        intervals = intervals.where(PriceInterval.product_id.in_(products))
+    return union_all(daily, intervals).alias()
+
+
+def part_products(part, market=None):
+    products = join(Product, Part, Product.part_id == Part.id)
+    query = select([Product.id]).where(Part.name == part)
+    if market:
+        products = products.join(Market, Product.market_id == Market.id)
+        query = query.where(Market.name == market)
+    return query.select_from(products)
+
+
+def first_source(rows, key):
+    """rows (sorted by source within a key) less the ones of a key already
+    seen, the other source of a day priced twice"""
+    seen = set()
+    for row in rows:
+        k = key(row)
+        if k not in seen:
+            seen.add(k)
+            yield row
+
+
+def expand(rows, start, end):
+    """one row a day of (valid_from, valid_to, ...) rows, clipped to start
+    and end: (date, ...)"""
+    day = datetime.timedelta(days=1)
+    for row in rows:
+        date = max(row[0], start)
+        last = min(row[1], end)
+        while date <= last:
+            yield (date,) + tuple(row[2:])
+            date += day
+
+
+def latest_prices(session, part, date=None, market=None, max_age=MAX_AGE):
+    """latest price on or before date of every product of the part sold in
+    the last max_age days, cheapest per kg first, products without weight
+    last: (market, name, origin, price, weight, count, per_kg, date)"""
+    date = date or datetime.date.today()
+    start = date - datetime.timedelta(days=max_age - 1)
+    products = part_products(part, market)
+
+    # the price of each product starting last, rows of a few days each
+    rows = price_rows(start, date, products)
+    latest = session.query(
+        rows.c.product_id, func.max(rows.c.valid_from).label('valid_from')
+    ).filter(
+        rows.c.valid_from <= date
+    ).group_by(rows.c.product_id).subquery()
+
+    rows = price_rows(start, date, products)
+    query = session.query(
+        rows.c.product_id,
+        Market.name, Product.name, Origin.name, rows.c.price, Product.weight, Product.count,
+        per_kg(rows.c.price).label('per_kg'),
+        case([(rows.c.valid_to > date, literal(date, Date))], else_=rows.c.valid_to)
+    ).select_from(latest).join(
+        rows, and_(rows.c.product_id == latest.c.product_id, rows.c.valid_from == latest.c.valid_from)
+    ).join(
+        Product, Product.id == latest.c.product_id
+    ).join(
+        Market, Product.market_id == Market.id
+    ).outerjoin(
+        Origin, Product.origin_id == Origin.id
+    )
+    rows = query.order_by(Product.weight.is_(None), 'per_kg', rows.c.price, rows.c.source)
+    # a daily price and an interval may both start on the latest day
+    return [row[1:] for row in first_source(rows, lambda row: row[0])]
+
+
+def price_series(session, part, start, end=None, market=None):
+    """every price of the part's products from start to end, by day then
+    market, intervals expanded to days: (date, market, name, price, per_kg)"""
+    end = end or datetime.date.today()
+    rows = price_rows(start, end, part_products(part, market))
+    query = session.query(
+        rows.c.valid_from, rows.c.valid_to, Market.name, Product.name, rows.c.price,
+        per_kg(rows.c.price).label('per_kg'), rows.c.product_id, rows.c.source
+    ).select_from(rows).join(
+        Product, Product.id == rows.c.product_id
+    ).join(
+        Market, Product.market_id == Market.id
+    )
+    # (date, ..., product_id, source), one price a product and day
+    days = sorted(expand(query, start, end), key=lambda row: (row[0], row[5], row[6]))
+    days = first_source(days, lambda row: (row[0], row[5]))
+    return sorted((row[:5] for row in days), key=lambda row: row[:3])
+
+
+def part_summary(session, part, start, end=None, market=None):
+    """(date, market, products, min, median, max, mean price, min, median,
+    max, mean per kg) of a part by day then market, from the rows of
+    daily_part_summary instead of its prices"""
+    query = session.query(
+        DailyPartSummary.date, Market.name, DailyPartSummary.products,
+        DailyPartSummary.min_price, DailyPartSummary.median_price, DailyPartSummary.max_price,
+        DailyPartSummary.mean_price, DailyPartSummary.min_per_kg, DailyPartSummary.median_per_kg,
+        DailyPartSummary.max_per_kg, DailyPartSummary.mean_per_kg
+    ).join(
+        Market, DailyPartSummary.market_id == Market.id
+    ).filter(
+        # an equality on part_id, the (part_id, date) index even without planner statistics
+        DailyPartSummary.part_id.in_(select([Part.id]).where(Part.name == part))
+    ).filter(
+        DailyPartSummary.date >= start
+    ).filter(
+        DailyPartSummary.date <= (end or start)
+    )
+    if market:
+        query = query.filter(Market.name == market)
+    return query.order_by(DailyPartSummary.date, Market.name).all()
+
+
+def parse_date(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+
+def format_row(row):
+    return '\t'.join('' if value is None else '%.2f' % value if isinstance(value, float) else '%s' % value
+                     for value in row)
+
+
+def parse_args(args):
+    parser = ArgumentParser()
+    parser.add_argument('--dbpath', help='sql connection here.', required=True)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    latest = commands.add_parser('latest', help='latest price of every product of a part, cheapest per kg first.')
+    latest.add_argument('part', help='part name, e.g. 雞胸肉.')
+    latest.add_argument('--date', help='YYYY-MM-DD, default to today.', type=parse_date)
+    latest.add_argument('--market', help='only this market.')
+    latest.add_argument('--max-age', help='days a price stays current.', type=int, default=MAX_AGE)
+
+    series = commands.add_parser('series', help='daily prices of a part.')
+    series.add_argument('part', help='part name, e.g. 紅蘿蔔.')
+    series.add_argument('--start', help='first day, YYYY-MM-DD.', type=parse_date, required=True)
+    series.add_argument('--end', help='last day, YYYY-MM-DD, default to today.', type=parse_date)
+    series.add_argument('--market', help='only this market.')
+
+    summary = commands.add_parser('summary', help='daily price statistics of a part by market.')
+    summary.add_argument('part', help='part name, e.g. 紅蘿蔔.')
+    summary.add_argument('--start', help='first day, YYYY-MM-DD.', type=parse_date, required=True)
+    summary.add_argument('--end', help='last day, YYYY-MM-DD, default to the first day.', type=parse_date)
+    summary.add_argument('--market', help='only this market.')
+    return parser.parse_args(args)
+
+
+def main(args):
+    args = parse_args(args)
+    config.setup_session(args.dbpath)
+    with session_scope() as session:
+        if args.command == 'latest':
+            rows = latest_prices(session, args.part, args.date, args.market, args.max_age)
+        elif args.command == 'series':
+            rows = price_series(session, args.part, args.start, args.end, args.market)
+        else:
+            rows = part_summary(session, args.part, args.start, args.end, args.market)
+        for row in rows:
+            print(format_row(row))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
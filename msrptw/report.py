@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Price comparison report, the ranking table of the README: every price
+of a day or a range of days with the weight, count and part of its
+product, priced per kg and per unit and ranked within the part.
+
+    $ python -m msrptw.report --dbpath sqlite:///msrptw.db --format markdown
+    $ python -m msrptw.report --dbpath sqlite:///msrptw.db --start 2018-01-01 --end 2018-12-31 --output 2018.csv
+
+Needs numpy and pandas, `pip install msrptw[report]`.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+import io
+import sys
+import datetime
+from argparse import ArgumentParser
+from sqlalchemy import func
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = None
+    pd = None
+from .database import config
+from .database.config import session_scope
+from .database.model import Config, Part, Market, Product, Price, PriceInterval
+from .query import price_rows
+
+PRODUCT_COLUMNS = ['id', 'config', 'part', 'market', 'name', 'source', 'weight', 'count']
+PRICE_COLUMNS = ['product_id', 'valid_from', 'valid_to', 'price', 'source']
+COLUMNS = ['date', 'config', 'part', 'market', 'name', 'source', 'price', 'weight', 'count']
+
+# README headers of the markdown table
+HEADERS = [
+    ('part', '分類'),
+    ('market', '市場名'),
+    ('name', '品名'),
+    ('price', '單價'),
+    ('grams', '重量(克)'),
+    ('per_kg', '每公斤價格'),
+    ('source', '來源'),
+]
+
+FORMATS = ['csv', 'markdown', 'json']
+
+
+def require():
+    if pd is None:
+        raise ImportError('msrptw.report needs numpy and pandas, pip install msrptw[report]')
+
+
+def latest_date(session):
+    dates = [session.query(func.max(Price.date)).scalar(), session.query(func.max(PriceInterval.valid_to)).scalar()]
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+def load(session, start, end=None, config_name=None, part_name=None):
+    """prices from start to end (inclusive) with their product and part,
+    one column per field. Prices come as bare (product_id, valid_from,
+    valid_to, price) rows expanded to days, the few products are queried
+    apart and joined by id"""
+    require()
+    products = session.query(
+        Product.id, Config.name, Part.name, Market.name, Product.name, Product.source, Product.weight,
+        Product.count
+    ).join(
+        Part, Product.part_id == Part.id
+    ).join(
+        Config, Part.config_id == Config.id
+    ).join(
+        Market, Product.market_id == Market.id
+    )
+    if config_name:
+        products = products.filter(Config.name == config_name)
+    if part_name:
+        products = products.filter(Part.name == part_name)
+
+    end = end or start
+    prices = session.query(price_rows(start, end))
+
+    products = pd.DataFrame.from_records(fetch_raw(session, products), columns=PRODUCT_COLUMNS)
+    prices = pd.DataFrame.from_records(fetch_raw(session, prices), columns=PRICE_COLUMNS)
+    prices = expand(prices, start, end)
+    frame = prices.merge(products, left_on='product_id', right_on='id', how='inner', sort=False)
+    for column in ('price', 'weight', 'count'):
+        frame[column] = pd.to_numeric(frame[column], errors='coerce').astype('float64')
+    return frame[COLUMNS]
+
+
+def fetch_raw(session, query):
+    # tuples of the DBAPI cursor, without a result row object per price
+    result = session.connection().execute(query.statement)
+    try:
+        return result.cursor.fetchall()
+    finally:
+        result.close()
+
+
+def expand(prices, start, end):
+    """one row a day of each price interval within start and end, dates as
+    the driver returns them are parsed once a column"""
+    first = pd.to_datetime(prices['valid_from']).clip(lower=pd.Timestamp(start)).to_numpy()
+    last = pd.to_datetime(prices['valid_to']).clip(upper=pd.Timestamp(end)).to_numpy()
+    days = ((last - first) // np.timedelta64(1, 'D')).astype('int64') + 1
+    index = np.repeat(np.arange(len(prices)), days)
+    # day of each row within its interval
+    offset = np.arange(len(index)) - np.repeat(np.cumsum(days) - days, days)
+    days = pd.DataFrame({
+        'product_id': prices['product_id'].to_numpy()[index],
+        'date': first[index] + offset.astype('timedelta64[D]'),
+        'price': prices['price'].to_numpy()[index],
+        'source': prices['source'].to_numpy()[index],
+    })
+    # a day priced by both tables keeps its daily price
+    days = days.sort_values('source', kind='mergesort').drop_duplicates(['product_id', 'date'])
+    return days.sort_index().drop(columns='source')
+
+
+def compute(frame):
+    """adds unit_price, grams, per_kg and rank, the cheapest per kg of a
+    part on a day ranks 1, products without weight are ranked after the
+    others by unit price"""
+    require()
+    # a missing or zero count is one item
+    count = frame['count'].to_numpy()
+    count = np.where(count > 0, count, 1)
+    price = frame['price'].to_numpy()
+    grams = frame['weight'].to_numpy() * count
+    grams = np.where(grams > 0, grams, np.nan)
+
+    frame = frame.assign(
+        count=count,
+        unit_price=np.round(price / count, 2),
+        grams=grams,
+        per_kg=np.round(price * 1000 / grams, 2),
+    )
+
+    groups = [frame['date'], frame['config'], frame['part']]
+    weighed = frame['per_kg'].notna()
+    by_kg = frame['per_kg'].groupby(groups).rank(method='min')
+    # unweighed ones after every weighed one of the part
+    by_unit = frame['unit_price'].where(~weighed).groupby(groups).rank(method='min')
+    offset = weighed.groupby(groups).transform('sum')
+    frame['rank'] = by_kg.fillna(by_unit + offset).astype('int64')
+
+    return frame.sort_values(['date', 'config', 'part', 'rank', 'market', 'name'], kind='mergesort') \
+        .reset_index(drop=True)
+
+
+def build(session, start=None, end=None, config_name=None, part_name=None):
+    """ranked report of the latest day of prices by default"""
+    start = start or latest_date(session)
+    if start is None:
+        require()
+        # no prices yet, the columns load would return with their types
+        frame = pd.DataFrame(columns=COLUMNS).astype({
+            'date': 'datetime64[ns]', 'price': 'float64', 'weight': 'float64', 'count': 'float64'
+        })
+        return compute(frame)
+    return compute(load(session, start, end, config_name, part_name))
+
+
+def to_csv(frame):
+    return frame.to_csv(index=False)
+
+
+def to_json(frame):
+    frame = frame.assign(date=frame['date'].dt.strftime('%Y-%m-%d'))
+    return frame.to_json(orient='records', force_ascii=False)
+
+
+def to_markdown(frame):
+    """the table of the README, one per day when several"""
+    out = io.StringIO()
+    dates = frame['date'].unique()
+    for date in dates:
+        if len(dates) > 1:
+            out.write('## %s\n\n' % pd.Timestamp(date).strftime('%Y-%m-%d'))
+        day = frame[frame['date'] == date]
+        out.write('|    | %s | \n' % ' | '.join(header for _, header in HEADERS))
+        out.write('|----|%s| \n' % '|'.join('-----' for _ in HEADERS))
+        for i, row in enumerate(day[[column for column, _ in HEADERS]].itertuples(index=False)):
+            out.write('| %s | %s | \n' % (i, ' | '.join(format_cell(value) for value in row)))
+        out.write('\n')
+    return out.getvalue()
+
+
+def format_cell(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+    return '%s' % value
+
+
+WRITERS = {
+    'csv': to_csv,
+    'markdown': to_markdown,
+    'json': to_json,
+}
+
+
+def parse_date(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+
+def parse_args(args):
+    parser = ArgumentParser()
+    parser.add_argument('--dbpath', help='sql connection here.', required=True)
+    parser.add_argument('--start', help='first day, YYYY-MM-DD, default to the latest day with prices.',
+                        type=parse_date)
+    parser.add_argument('--end', help='last day, YYYY-MM-DD, default to the first day.', type=parse_date)
+    parser.add_argument('--config', help='only this config, e.g. 蔬菜.')
+    parser.add_argument('--part', help='only this part, e.g. 紅蘿蔔.')
+    parser.add_argument('--format', help='output format.', choices=FORMATS, default='csv')
+    parser.add_argument('--output', help='write to this file instead of stdout.')
+    return parser.parse_args(args)
+
+
+def main(args):
+    args = parse_args(args)
+    config.setup_session(args.dbpath)
+    with session_scope() as session:
+        frame = build(session, args.start, args.end, args.config, args.part)
+    text = WRITERS[args.format](frame)
+    if args.output:
+        with io.open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
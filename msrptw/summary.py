@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Daily price statistics per part and market in `daily_part_summary`.
+The rows of a market and day are replaced at the end of the market's
+run, rebuild recomputes a range of days for backfills, msrptw.query
+reads them:
+
+    $ python -m msrptw.summary --dbpath sqlite:///msrptw.db --start 2018-01-01 --end 2018-12-31
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+import sys
+import datetime
+from argparse import ArgumentParser
+from sqlalchemy import select
+from .database import config
+from .database.config import session_scope
+from .database.model import Market, Product, DailyPartSummary
+from .query import price_rows, first_source, parse_date
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return float(values[middle])
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def statistics(prices, per_kgs):
+    row = {
+        'products': len(prices),
+        'min_price': min(prices),
+        'median_price': median(prices),
+        'max_price': max(prices),
+        'mean_price': sum(prices) / len(prices),
+        'weighed': len(per_kgs),
+    }
+    if per_kgs:
+        row.update({
+            'min_per_kg': min(per_kgs),
+            'median_per_kg': median(per_kgs),
+            'max_per_kg': max(per_kgs),
+            'mean_per_kg': sum(per_kgs) / len(per_kgs),
+        })
+    return row
+
+
+def update(session, date, market_id=None):
+    """replaces the rows of the day (of the market only if given) from its
+    prices, returns the number of rows"""
+    products = select([Product.id]).where(Product.part_id.isnot(None))
+    if market_id is not None:
+        products = products.where(Product.market_id == market_id)
+    rows = price_rows(date, date, products)
+
+    # (market_id, part_id) => ([price], [price per kg])
+    groups = {}
+    for _, market, part, price, weight, count in first_source(session.query(
+        rows.c.product_id, Product.market_id, Product.part_id, rows.c.price, Product.weight, Product.count
+    ).select_from(rows).join(
+        Product, Product.id == rows.c.product_id
+    ).order_by(rows.c.source), lambda row: row[0]):
+        prices, per_kgs = groups.setdefault((market, part), ([], []))
+        prices.append(price)
+        grams = (weight or 0) * (count or 1)
+        if grams > 0:
+            per_kgs.append(price * 1000 / grams)
+
+    old = session.query(DailyPartSummary).filter(DailyPartSummary.date == date)
+    if market_id is not None:
+        old = old.filter(DailyPartSummary.market_id == market_id)
+    old.delete(synchronize_session=False)
+
+    summaries = []
+    for (market, part), (prices, per_kgs) in groups.items():
+        summary = statistics(prices, per_kgs)
+        summary.update({'date': date, 'market_id': market, 'part_id': part})
+        summaries.append(summary)
+    session.bulk_insert_mappings(DailyPartSummary, summaries)
+    return len(summaries)
+
+
+def rebuild(session, start, end, market_id=None):
+    """every day from start to end, one day a transaction"""
+    date = start
+    while date <= end:
+        update(session, date, market_id)
+        session.commit()
+        date += datetime.timedelta(days=1)
+
+
+def parse_args(args):
+    parser = ArgumentParser()
+    parser.add_argument('--dbpath', help='sql connection here.', required=True)
+    parser.add_argument('--start', help='first day to rebuild, YYYY-MM-DD.', type=parse_date, required=True)
+    parser.add_argument('--end', help='last day, YYYY-MM-DD, default to today.', type=parse_date)
+    parser.add_argument('--market', help='only this market.')
+    return parser.parse_args(args)
+
+
+def main(args):
+    args = parse_args(args)
+    config.setup_session(args.dbpath)
+    with session_scope() as session:
+        market_id = None
+        if args.market:
+            market_id = session.query(Market.id).filter(Market.name == args.market).scalar()
+            if market_id is None:
+                sys.exit('unknown market %s' % args.market)
+        rebuild(session, args.start, args.end or datetime.date.today(), market_id)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+import time
+import logging
+import datetime
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from logging.config import fileConfig
+from sqlalchemy import bindparam
+from sqlalchemy.dialects import postgresql
+from . import _logging_config_path
+from .database import config, _session
+from .database.model import Product, Price, PriceInterval, Classification
+
+fileConfig(_logging_config_path)
+log = logging.getLogger(__name__)
+
+
+class Writer(object):
+    """The only thread writing products and prices, on one connection of
+    its own. Crawl threads enqueue and return, rows are committed together
+    every `capacity` prices or `interval` seconds. New products are
+    inserted at once since their id is needed, each in a savepoint of the
+    transaction of the next group. A failed group is retried once, the
+    products it lost are reported to `on_lost` and their rows dropped.
+    With `intervals` prices are kept as PriceInterval rows extended while
+    the price is unchanged instead of one Price row a day"""
+
+    COMMIT = '寫入%s筆價格耗時%.3f秒(每千筆%.3f秒)'
+    DROP = '寫入失敗，放棄%s筆價格、%s筆驗證日期及%s筆分類'
+
+    def __init__(self, capacity=1000, interval=1.0, max_queue=100000, intervals=False, on_lost=None):
+        self.capacity = capacity
+        self.interval = interval
+        self.intervals = intervals
+        # called with the ids of products a rollback removed
+        self.on_lost = on_lost
+        self.queue = queue.Queue(max_queue)
+        self.thread = None
+        self.session = None
+        # ids of products inserted since the last commit, and of the ones
+        # a rollback removed, rows still queued for them are dropped
+        self.products = []
+        self.lost = set()
+        # the pending rows are a failed group put back once
+        self.retried = False
+        # (product_id, date) => price, product_id => {column: value} of
+        # its verified date and the static fields a refresh changed
+        self.prices = {}
+        self.verified = {}
+        self.classifications = []
+        self.started = None
+        self.commits = 0
+        self.rows = 0
+        self.max_depth = 0
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self._start_lock:
+            if self.thread is None:
+                self.started = time.time()
+                self.thread = threading.Thread(target=self.work, name='Writer')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def put(self, item):
+        self.start()
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def put_price(self, product_id, date, price):
+        self.put(('price', (product_id, date), price))
+
+    def put_verified(self, product_id, date, fields=None):
+        values = dict(fields or {})
+        values['verified'] = date
+        self.put(('verified', product_id, values))
+
+    def put_classification(self, row):
+        self.put(('classification', row))
+
+    def insert_product(self, product):
+        # [event, product, error], waits for the id
+        holder = [threading.Event(), None, None]
+        self.put(('product', product, holder))
+        holder[0].wait()
+        if holder[2] is not None:
+            raise holder[2]
+        return holder[1]
+
+    def flush(self, stop=False, timeout=None):
+        """returns once everything enqueued before is committed"""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        event = threading.Event()
+        self.queue.put(('flush', event, stop))
+        event.wait(timeout)
+        if stop:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def close(self):
+        self.flush(stop=True)
+
+    def work(self):
+        deadline = time.time() + self.interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                item = None
+
+            if item is None:
+                self.commit()
+                deadline = time.time() + self.interval
+                continue
+
+            kind = item[0]
+            if kind == 'price':
+                if item[1][0] not in self.lost:
+                    self.prices[item[1]] = item[2]
+            elif kind == 'verified':
+                if item[1] not in self.lost:
+                    self.verified.setdefault(item[1], {}).update(item[2])
+            elif kind == 'classification':
+                self.classifications.append(item[1])
+            elif kind == 'product':
+                self.add_product(item[1], item[2])
+            else:
+                # flush marker, ('flush', event, stop)
+                self.commit()
+                item[1].set()
+                if item[2]:
+                    self.close_session()
+                    return
+                continue
+
+            if len(self.prices) >= self.capacity or time.time() >= deadline:
+                self.commit()
+                deadline = time.time() + self.interval
+
+    def get_session(self):
+        if self.session is None:
+            self.session = _session(bind=config.engine.connect())
+        return self.session
+
+    def close_session(self):
+        if self.session is not None:
+            connection = self.session.bind
+            self.session.close()
+            connection.close()
+            self.session = None
+
+    def add_product(self, product, holder):
+        try:
+            session = self.get_session()
+            # a failed insert rolls back its savepoint only, not the
+            # products already inserted and handed out
+            with session.begin_nested():
+                session.add(product)
+            # keep the new id readable once the session moves on
+            session.expunge(product)
+            self.products.append(product.id)
+            # sqlite may give a lost id again
+            self.lost.discard(product.id)
+            holder[1] = product
+        except Exception as e:
+            log.exception(e)
+            if self.session is not None and not self.session.is_active:
+                self.rollback()
+            holder[2] = e
+        finally:
+            holder[0].set()
+
+    def commit(self):
+        if not self.prices and not self.verified and not self.classifications and not self.products:
+            return
+        prices, self.prices = self.prices, {}
+        verified, self.verified = self.verified, {}
+        classifications, self.classifications = self.classifications, []
+        rows = [{'product_id': product_id, 'date': date, 'price': price}
+                for (product_id, date), price in prices.items()]
+        start = time.time()
+        try:
+            session = self.get_session()
+            if rows and self.intervals:
+                store_intervals(session, rows)
+            elif rows:
+                upsert_prices(session, rows)
+            if verified:
+                session.bulk_update_mappings(Product, [dict(values, id=id) for id, values in verified.items()])
+            if classifications:
+                session.bulk_insert_mappings(Classification, classifications)
+            session.commit()
+        except Exception as e:
+            log.exception(e)
+            self.rollback()
+            self.retry(prices, verified, classifications)
+            return
+        self.products = []
+        self.retried = False
+        self.commits += 1
+        self.rows += len(rows)
+        if rows:
+            elapsed = time.time() - start
+            log.debug(Writer.COMMIT % (len(rows), elapsed, elapsed * 1000 / len(rows)))
+
+    def rollback(self):
+        # a new connection next time, the failure may have been the connection
+        lost, self.products = self.products, []
+        if lost:
+            self.lost.update(lost)
+            if self.on_lost is not None:
+                self.on_lost(lost)
+        if self.session is None:
+            return
+        try:
+            self.session.rollback()
+        finally:
+            self.close_session()
+
+    def retry(self, prices, verified, classifications):
+        """rows of a failed group go back pending for the next group, except
+        the ones of lost products, and are dropped if they fail again"""
+        if self.retried:
+            self.retried = False
+            log.error(Writer.DROP % (len(prices), len(verified), len(classifications)))
+            return
+        self.retried = True
+        for key, price in prices.items():
+            if key[0] not in self.lost:
+                self.prices.setdefault(key, price)
+        for product_id, values in verified.items():
+            if product_id not in self.lost:
+                # newer values queued since win
+                values = dict(values)
+                values.update(self.verified.get(product_id, {}))
+                self.verified[product_id] = values
+        self.classifications = classifications + self.classifications
+
+    def metrics(self):
+        elapsed = time.time() - self.started if self.started else 0
+        return {
+            'commits': self.commits,
+            'rows': self.rows,
+            'commits_per_sec': self.commits / elapsed if elapsed else 0.0,
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_depth,
+        }
+
+
+def upsert_prices(session, rows):
+    if session.get_bind().dialect.name == 'postgresql':
+        stmt = postgresql.insert(Price.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['product_id', 'date'],
+            set_={'price': stmt.excluded.price}
+        )
+        session.execute(stmt, rows)
+        return
+
+    # other dialects, one select for the chunk then bulk update/insert
+    dates = set(row['date'] for row in rows)
+    product_ids = set(row['product_id'] for row in rows)
+    existing = dict(
+        ((product_id, date), id)
+        for id, product_id, date in session.query(Price.id, Price.product_id, Price.date).filter(
+            Price.date.in_(dates)
+        ).filter(
+            Price.product_id.in_(product_ids)
+        )
+    )
+
+    updates = []
+    inserts = []
+    for row in rows:
+        id = existing.get((row['product_id'], row['date']))
+        if id:
+            updates.append({'id': id, 'price': row['price']})
+        else:
+            inserts.append(row)
+
+    session.bulk_update_mappings(Price, updates)
+    session.bulk_insert_mappings(Price, inserts)
+
+
+def store_intervals(session, rows):
+    """one select of the intervals the rows may extend or split, then bulk
+    update/insert of the changed ones"""
+    by_product = {}
+    for row in sorted(rows, key=lambda row: row['date']):
+        by_product.setdefault(row['product_id'], []).append(row)
+    # the day before the first row, an interval ending there is extended
+    oldest = min(row['date'] for row in rows) - datetime.timedelta(days=1)
+
+    intervals = {}
+    for interval_id, product_id, price, valid_from, valid_to in session.query(
+        PriceInterval.id, PriceInterval.product_id, PriceInterval.price, PriceInterval.valid_from,
+        PriceInterval.valid_to
+    ).filter(
+        PriceInterval.product_id.in_(by_product.keys())
+    ).filter(
+        PriceInterval.valid_to >= oldest
+    ).order_by(PriceInterval.product_id, PriceInterval.valid_from):
+        intervals.setdefault(product_id, []).append({
+            'id': interval_id, 'product_id': product_id, 'price': price, 'valid_from': valid_from, 'valid_to': valid_to
+        })
+
+    changed = {}
+    for product_id, product_rows in by_product.items():
+        product_intervals = intervals.setdefault(product_id, [])
+        for row in product_rows:
+            for interval in place_price(product_intervals, product_id, row['date'], row['price']):
+                changed[id(interval)] = interval
+
+    # updates first, a split interval moves its valid_from before the new one takes it
+    table = PriceInterval.__table__
+    updates = [dict(('b_' + k, v) for k, v in i.items()) for i in changed.values() if i['id'] is not None]
+    if updates:
+        session.execute(table.update().where(table.c.id == bindparam('b_id')).values(
+            price=bindparam('b_price'), valid_from=bindparam('b_valid_from'), valid_to=bindparam('b_valid_to')
+        ), updates)
+    inserts = [dict((k, v) for k, v in i.items() if k != 'id') for i in changed.values() if i['id'] is None]
+    if inserts:
+        session.execute(table.insert(), inserts)
+
+
+def place_price(intervals, product_id, date, price):
+    """puts the price of a day into the intervals of a product (sorted by
+    valid_from), returns the intervals changed or added"""
+    day = datetime.timedelta(days=1)
+    position = 0
+    for interval in intervals:
+        if interval['valid_from'] > date:
+            break
+        position += 1
+    prev = intervals[position - 1] if position else None
+    new = {'id': None, 'product_id': product_id, 'price': price, 'valid_from': date, 'valid_to': date}
+
+    if prev is None or prev['valid_to'] < date:
+        # after the latest interval starting before, extend it when unchanged
+        # the day after, a day without price is not known to have had it
+        if prev is not None and prev['price'] == price and date - prev['valid_to'] == day:
+            prev['valid_to'] = date
+            return [prev]
+        intervals.insert(position, new)
+        return [new]
+
+    # a day already covered, e.g. the same day crawled again
+    if prev['price'] == price:
+        return []
+    if prev['valid_from'] == prev['valid_to']:
+        prev['price'] = price
+        return [prev]
+    if prev['valid_from'] == date:
+        prev['valid_from'] = date + day
+        intervals.insert(position - 1, new)
+        return [prev, new]
+    changed = [prev, new]
+    if prev['valid_to'] > date:
+        tail = dict(prev, id=None, valid_from=date + day)
+        intervals.insert(position, tail)
+        changed.append(tail)
+    prev['valid_to'] = date - day
+    intervals.insert(position, new)
+    return changed
@@ -27,4 +27,5 @@ setup(
     ],
     packages=find_packages(),
     install_requires=['lxml', 'pathos', 'requests', 'sqlalchemy'],
+    extras_require={'report': ['numpy', 'pandas']},
 )
\ No newline at end of file
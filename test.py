@@ -5,8 +5,39 @@ from __future__ import print_function
 from __future__ import unicode_literals
 import unittest
 import os
-from msrptw import marketbrowser, marketapi
+import io
+import json
+import logging
+import random
+import re
+import time
+import datetime
+import sqlite3
+import tempfile
+import threading
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+import sqlalchemy
+from sqlalchemy import event
+from msrptw import marketbrowser, marketapi, builder
 from msrptw.database import config
+from msrptw.matcher import ConfigMatcher
+from msrptw.jsonstream import iter_items, iter_text
+from msrptw.limiter import HostLimiter
+from msrptw.breaker import CircuitBreaker, CircuitOpenError
+from msrptw.extract import Extractor
+from msrptw import httpcache
+from msrptw.httpcache import HttpCache
+from msrptw.archive import ArchiveRecorder, ArchiveReader
+from msrptw import report, connection, breaker
+from msrptw.writer import Writer, place_price
+from msrptw import summary, query
+from msrptw.directory import Directory
+from msrptw.handler import SQLAlchemyHandler
+from msrptw.database.cache import Reference, references, classifications
+from msrptw.database.model import Config, Market, Origin, Unit, Part, Alias, Product, Price, Classification, \
+    DailyPartSummary, Log, PriceInterval
+from lxml import html
 
 
 def get_success_rate(obj):
@@ -37,6 +68,1085 @@ def get_success_rate(obj):
     return test_count, success_rate, total_trans
 
 
+def setup_test_db():
+    # DB_TEST_URL or a fresh sqlite file enforcing foreign keys like postgresql
+    db_path = os.getenv("DB_TEST_URL")
+    if not db_path:
+        db_path = 'sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'test.db')
+    config.setup_session(db_path)
+    if config.engine.dialect.name == 'sqlite':
+        event.listen(config.engine, 'connect', lambda connection, record: connection.execute('PRAGMA foreign_keys=ON'))
+    config.init()
+
+
+class Stub(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def classify_by_parts(config, name):
+    # substring checks part by part, the reference for ConfigMatcher
+    alias_id = None
+    for part in config.parts:
+        find = part.name in name
+        for alias in part.aliases:
+            if alias.name in name and not alias.anti:
+                alias_id = alias.id
+                find = True
+        for alias in part.aliases:
+            if alias.name in name and alias.anti:
+                find = False
+        if find:
+            return part, alias_id
+    return None, alias_id
+
+
+class TestConfigMatcher(unittest.TestCase):
+    def setUp(self):
+        self.config = Stub(parts=[
+            Stub(id=1, name='全雞', aliases=[Stub(id=1, name='土雞', anti=False), Stub(id=2, name='胸', anti=True),
+                                            Stub(id=3, name='腿', anti=True)]),
+            Stub(id=2, name='雞胸肉', aliases=[Stub(id=4, name='雞胸', anti=False), Stub(id=5, name='胸肉', anti=False)]),
+            Stub(id=3, name='雞腿肉', aliases=[Stub(id=6, name='棒腿', anti=False), Stub(id=7, name='翅', anti=True)]),
+            Stub(id=4, name='雞翅', aliases=[Stub(id=8, name='翅腿', anti=False), Stub(id=9, name='二節翅', anti=False)]),
+        ])
+
+    def test_same_as_part_by_part(self):
+        tokens = ['全雞', '土雞', '胸', '腿', '雞胸肉', '雞胸', '胸肉', '雞腿肉', '棒腿', '翅', '雞翅', '翅腿',
+                  '二節翅', '雞', '臺灣', '1kg', '(', ')']
+        matcher = ConfigMatcher(self.config)
+        rng = random.Random(0)
+        for _ in range(5000):
+            name = ''.join(rng.choice(tokens) for _ in range(rng.randint(1, 5)))
+            self.assertEqual(matcher.classify(name), classify_by_parts(self.config, name), name)
+
+    def test_anti_alias_keeps_alias_id(self):
+        part, alias_id = ConfigMatcher(self.config).classify('土雞腿')
+        self.assertIsNone(part)
+        self.assertEqual(alias_id, 1)
+
+
+class TestJsonStream(unittest.TestCase):
+    def test_items_at_path_in_any_chunking(self):
+        doc = {
+            'meta': {'products': [{'title': 'skipped'}]},
+            'pageModel': {'contentBlock': {'itemList': [
+                {'other': [1, 2]},
+                {'bottomCategoryProducts': [{'productName': '紅蘿蔔', 'salePrice': 35, 'tags': [{}]},
+                                            {'productName': '\\"引號\\"', 'salePrice': 1.5e2}]},
+            ]}},
+            'after': 'never read',
+        }
+        text = json.dumps(doc, ensure_ascii=False, indent=1)
+        path = ('pageModel', 'contentBlock', 'itemList', 1, 'bottomCategoryProducts')
+        expected = doc['pageModel']['contentBlock']['itemList'][1]['bottomCategoryProducts']
+        for size in (1, 2, 5, 64, len(text)):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            self.assertEqual(list(iter_items(chunks, path)), expected)
+
+    def test_missing_key(self):
+        with self.assertRaises(KeyError):
+            list(iter_items(['{"products": []}'], ('content', )))
+
+
+class TestHostLimiter(unittest.TestCase):
+    def test_grows_while_fast_and_backs_off(self):
+        limiter = HostLimiter('example.com', concurrency=2, max_concurrency=8)
+        for _ in range(50):
+            limiter.release(limiter.acquire(), 200)
+        self.assertEqual(limiter.metrics()['concurrency'], 8)
+        limiter.release(limiter.acquire(), 503)
+        self.assertEqual(limiter.metrics()['concurrency'], 4)
+        self.assertEqual(limiter.metrics()['errors'], 1)
+
+    def test_fast_outlier_fades(self):
+        limiter = HostLimiter('example.com', concurrency=4, max_concurrency=8)
+
+        def answer(seconds):
+            limiter.acquire()
+            limiter.release(time.time() - seconds, 200)
+
+        answer(0.001)
+        for _ in range(100):
+            answer(0.2)
+        # the base rose to the usual latency, which is no congestion
+        self.assertGreater(limiter.metrics()['base_latency'], 0.15)
+        self.assertEqual(limiter.metrics()['concurrency'], 8)
+
+    def test_429_empties_bucket(self):
+        limiter = HostLimiter('example.com', rate=1000, burst=5)
+        limiter.release(limiter.acquire(), 429)
+        self.assertEqual(limiter.tokens, 0)
+        self.assertEqual(limiter.metrics()['throttled'], 1)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_then_probes(self):
+        breaker = CircuitBreaker('example.com', threshold=3, cooldown=0)
+        for _ in range(3):
+            breaker.check()
+            breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        # cooldown over, one probe goes through and the others wait for it
+        breaker.check()
+        with self.assertRaises(CircuitOpenError):
+            breaker.check()
+        breaker.success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_probe(self):
+        class Session(object):
+            calls = 0
+
+            def request(self, method, url, **kwargs):
+                Session.calls += 1
+                raise connection.requests.exceptions.ConnectionError('refused')
+
+        host = breaker.get_breaker('probe.example.com')
+        host.cooldown = 0
+        for _ in range(host.threshold):
+            host.failure()
+        get_session, sleep = connection.get_session, connection.time.sleep
+        connection.get_session = lambda url: Session()
+        connection.time.sleep = lambda seconds: None
+        try:
+            # the probe and its retries fail, the circuit opens again
+            with self.assertRaises(connection.requests.exceptions.ConnectionError):
+                connection.request('GET', 'http://probe.example.com/')
+            self.assertEqual(Session.calls, connection.RETRIES + 1)
+            self.assertEqual(host.state, CircuitBreaker.OPEN)
+            # and lets the next probe through after its cooldown
+            with self.assertRaises(connection.requests.exceptions.ConnectionError):
+                connection.request('GET', 'http://probe.example.com/')
+            self.assertEqual(host.state, CircuitBreaker.OPEN)
+        finally:
+            connection.get_session, connection.time.sleep = get_session, sleep
+            breaker.reset()
+
+
+class TestHttpCache(unittest.TestCase):
+    class Session(object):
+        # answers with the queued (status, headers, body), records the request headers
+        def __init__(self, *answers):
+            self.answers = list(answers)
+            self.sent = []
+
+        def get(self, url, params=None, headers=None, **kwargs):
+            self.sent.append(headers)
+            status, response_headers, body = self.answers.pop(0)
+            response = Response()
+            response.status_code = status
+            response.headers = CaseInsensitiveDict(response_headers)
+            if kwargs.get('stream'):
+                response.raw = io.BytesIO(body)
+                response._content = False
+            else:
+                response._content = body
+            response.encoding = 'utf-8'
+            response.url = url
+            return response
+
+    def setUp(self):
+        self.cache = HttpCache(tempfile.mkdtemp())
+        self.url = 'https://example.com/list'
+
+    def test_revalidate(self):
+        session = self.Session((200, {'ETag': '"v1"'}, b'<html>v1</html>'), (304, {}, b''),
+                               (200, {'ETag': '"v2"'}, b'<html>v2</html>'))
+        self.assertEqual(self.cache.fetch(session, self.url, 60).content, b'<html>v1</html>')
+        # fresh within the ttl, no request
+        self.assertEqual(self.cache.fetch(session, self.url, 60).content, b'<html>v1</html>')
+        self.assertEqual(len(session.sent), 1)
+
+        # not modified, the stored body is served and fresh again
+        response = self.cache.fetch(session, self.url, 0)
+        self.assertEqual(session.sent[1]['If-None-Match'], '"v1"')
+        self.assertEqual((response.status_code, response.content), (200, b'<html>v1</html>'))
+        self.cache.fetch(session, self.url, 60)
+        self.assertEqual(len(session.sent), 2)
+
+        # modified, the new body replaces it
+        self.assertEqual(self.cache.fetch(session, self.url, 0).content, b'<html>v2</html>')
+        meta, body = self.cache.get(HttpCache.key(self.url))
+        self.assertEqual((meta['etag'], body), ('"v2"', b'<html>v2</html>'))
+
+    def test_stream(self):
+        body = json.dumps({'items': [{'id': i} for i in range(1000)]}).encode('utf-8')
+        key = HttpCache.key(self.url)
+        # stored once the caller has read it to the end
+        response = self.cache.fetch(self.Session((200, {}, body)), self.url, 60, stream=True)
+        self.assertEqual(self.cache.get(key), (None, None))
+        self.assertEqual(len(list(iter_items(iter_text(response), ('items',)))), 1000)
+        self.assertEqual(self.cache.get(key)[1], body)
+
+        # nothing of a body given up on
+        response = self.cache.fetch(self.Session((200, {}, b'x' * 100000)), self.url + '/2', 60, stream=True)
+        next(response.iter_content(1024))
+        response.close()
+        self.assertEqual(self.cache.get(HttpCache.key(self.url + '/2')), (None, None))
+        self.assertEqual(list(os.walk(os.path.join(self.cache.path, HttpCache.key(self.url + '/2')[:2])))[0][2], [])
+
+    def test_304_new_validators(self):
+        session = self.Session((200, {'ETag': '"v1"'}, b'v1'), (304, {'ETag': '"v1b"'}, b''), (304, {}, b''))
+        self.cache.fetch(session, self.url, 0)
+        self.cache.fetch(session, self.url, 0)
+        self.cache.fetch(session, self.url, 0)
+        self.assertEqual(session.sent[2]['If-None-Match'], '"v1b"')
+
+    def test_evict_skips_files_being_written(self):
+        cache = HttpCache(tempfile.mkdtemp(), max_size=1000)
+        os.makedirs(os.path.join(cache.path, 'ab'))
+        temp = os.path.join(cache.path, 'ab', 'x' + HttpCache.TEMP_SUFFIX)
+        with open(temp, 'wb') as f:
+            f.write(b'x' * 2000)
+        for i in range(5):
+            session = self.Session((200, {}, os.urandom(400)))
+            cache.fetch(session, '%s/%s' % (self.url, i), 60)
+        self.assertTrue(os.path.exists(temp))
+        self.assertLessEqual(cache.size(), 1000)
+
+    def test_file_removed_while_written(self):
+        def replace(source, target):
+            os.remove(source)
+            raise OSError(2, 'No such file or directory')
+
+        session = self.Session((200, {}, b'v1'))
+        original = httpcache.replace
+        httpcache.replace = replace
+        try:
+            # served anyway, not cached
+            self.assertEqual(self.cache.fetch(session, self.url, 60).content, b'v1')
+        finally:
+            httpcache.replace = original
+        self.assertEqual(self.cache.get(HttpCache.key(self.url)), (None, None))
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'run.arc')
+        self.recorder = ArchiveRecorder(self.path, datetime.date(2018, 12, 1))
+        for i in range(3):
+            response = Response()
+            response.status_code = 200
+            response.headers = CaseInsensitiveDict({'Content-Type': 'text/html'})
+            response._content = ('<html>%s</html>' % i).encode('utf-8') * 100
+            response.encoding = 'utf-8'
+            response.url = 'https://example.com/%s' % i
+            self.recorder.add('GET', response.url, None, None, response)
+
+    def tearDown(self):
+        self.recorder.close()
+
+    def replayed(self, path):
+        reader = ArchiveReader(path)
+        try:
+            return reader.date, [reader.response('GET', 'https://example.com/%s' % i).content[:14]
+                                 for i in range(3)]
+        finally:
+            reader.close()
+
+    def test_round_trip(self):
+        self.recorder.close()
+        self.assertEqual(self.replayed(self.path), (datetime.date(2018, 12, 1), [
+            b'<html>0</html>', b'<html>1</html>', b'<html>2</html>'
+        ]))
+
+    def test_stream(self):
+        response = Response()
+        response.status_code = 200
+        response.raw = io.BytesIO(b'[1, 2, 3]')
+        response.encoding = 'utf-8'
+        response.url = 'https://example.com/api'
+        self.recorder.add('POST', response.url, None, None, response, stream=True)
+        self.assertEqual(list(iter_items(iter_text(response), ())), [1, 2, 3])
+        self.recorder.close()
+        reader = ArchiveReader(self.path)
+        try:
+            self.assertEqual(reader.response('POST', response.url).content, b'[1, 2, 3]')
+        finally:
+            reader.close()
+
+    def test_scan_after_crash(self):
+        # no index, the last record cut within its body or its meta
+        self.recorder._file.flush()
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        _, _, body_length = list(self.recorder.index.values())[-1]
+        crashed = self.path + '.crashed'
+        for cut in (5, body_length + 10):
+            with open(crashed, 'wb') as f:
+                f.write(data[:-cut])
+            self.assertEqual(self.replayed(crashed), (datetime.date(2018, 12, 1), [
+                b'<html>0</html>', b'<html>1</html>', b''
+            ]))
+
+
+class TestAsyncEngine(unittest.TestCase):
+    def test_run(self):
+        # python 3 only, like the builder keeps it out of the thread engine path
+        from msrptw.engine import AsyncEngine
+        state = {'in_flight': 0, 'max_in_flight': 0, 'stored': [], 'summarized': []}
+        lock = threading.Lock()
+
+        class StubMarket(object):
+            NAME = 'stub'
+            PRODUCT_MAP = {'蔬菜': list(range(8))}
+
+            def __init__(self):
+                self.configs = [Stub(name='蔬菜')]
+                self.market = Stub(name='stub')
+
+            def expired(self):
+                return False
+
+            def get_products_prices(self, map_str):
+                with lock:
+                    state['in_flight'] += 1
+                    state['max_in_flight'] = max(state['max_in_flight'], state['in_flight'])
+                try:
+                    time.sleep(0.05)
+                    if map_str == 3:
+                        raise ValueError('broken page')
+                    return [(None, map_str)]
+                finally:
+                    with lock:
+                        state['in_flight'] -= 1
+
+            def store(self, config, product, price):
+                state['stored'].append(price)
+
+            def summarize(self):
+                state['summarized'].append(self.NAME)
+
+        class BrokenMarket(StubMarket):
+            NAME = 'broken'
+
+            def __init__(self):
+                raise ValueError('no market')
+
+        AsyncEngine(concurrency=2).run([[StubMarket], [BrokenMarket]])
+        # at most two calls at once, the broken page and market stop nothing else
+        self.assertEqual(state['max_in_flight'], 2)
+        self.assertEqual(sorted(state['stored']), [0, 1, 2, 4, 5, 6, 7])
+        self.assertEqual(state['summarized'], ['stub'])
+
+
+class TestExtractor(unittest.TestCase):
+    def setUp(self):
+        self.units = [Reference(1, '盒'), Reference(2, '包'), Reference(3, '片')]
+        self.extractor = Extractor(Directory.TO_REPLACE_MAP, Directory.TO_DELETE, Directory.ORIGIN_MAP, self.units,
+                                   Directory.UNIT_RE, Directory.MULTI_RE)
+
+    def test_fields(self):
+        e = self.extractor
+        self.assertEqual(e.normalize('台灣 紅蘿蔔５００G'), '臺灣紅蘿蔔500g')
+        self.assertEqual(e.weight('紅蘿蔔1.2公斤'), 1200.0)
+        self.assertEqual(e.weight('紅蘿蔔５００G'), 500.0)
+        self.assertIsNone(e.weight('紅蘿蔔'))
+        self.assertEqual(e.multi('雞翅300g*2'), '2')
+        self.assertIsNone(e.multi('雞翅'))
+        self.assertEqual(e.unit('3片/盒'), self.units[0])
+
+    def test_origin_keeps_table_order(self):
+        # 澳洲 comes before 進口 in ORIGIN_MAP although later in the name
+        self.assertEqual(self.extractor.origin('進口澳洲牛'), '澳洲')
+        self.assertEqual(self.extractor.origin('台中國產'), '臺灣')
+        self.assertEqual(self.extractor.origin('牛'), '')
+
+    def test_weight_conversion_fails(self):
+        setup_test_db()
+        # a pattern letting through a number float() refuses
+        Directory.EXTRACTOR = Extractor(Directory.TO_REPLACE_MAP, Directory.TO_DELETE, Directory.ORIGIN_MAP,
+                                        references.units(), re.compile('(?P<kg>[0-9.]+)kg|(?P<g>[0-9.]+)g'),
+                                        Directory.MULTI_RE)
+        try:
+            with self.assertLogs('msrptw.directory', 'ERROR') as logs:
+                self.assertIsNone(Directory.get_weight('紅蘿蔔1.2.3kg'))
+            self.assertEqual(logs.records[0].getMessage(), Directory.ERROR_MAP[0])
+            self.assertEqual(Directory.get_weight('紅蘿蔔500g'), 500.0)
+        finally:
+            Directory.EXTRACTOR = None
+
+
+@unittest.skipIf(report.pd is None, 'numpy and pandas are not installed')
+class TestReport(unittest.TestCase):
+    def test_compute(self):
+        frame = report.pd.DataFrame.from_records([
+            (datetime.date(2018, 1, 1), '蔬菜', '紅蘿蔔', '頂好', '履歷紅蘿蔔', None, 69, 1000, 1),
+            (datetime.date(2018, 1, 1), '蔬菜', '紅蘿蔔', '愛買', '產銷履歷紅蘿蔔', None, 69, 600, 2),
+            (datetime.date(2018, 1, 1), '蔬菜', '紅蘿蔔', '濱江', '紅蘿蔔', None, 13, None, None),
+            (datetime.date(2018, 1, 1), '蔬菜', '紅蘿蔔', '大潤發', '台灣紅蘿蔔', None, 12, 200, 1),
+        ], columns=report.COLUMNS)
+        frame = report.compute(frame)
+        self.assertEqual(list(frame['name']), ['產銷履歷紅蘿蔔', '台灣紅蘿蔔', '履歷紅蘿蔔', '紅蘿蔔'])
+        self.assertEqual(list(frame['rank']), [1, 2, 3, 4])
+        self.assertEqual(list(frame['per_kg'][:3]), [57.5, 60.0, 69.0])
+        self.assertEqual(frame['unit_price'][0], 34.5)
+        self.assertEqual(frame['grams'][0], 1200)
+        self.assertTrue(report.np.isnan(frame['per_kg'][3]))
+
+    def test_empty_database(self):
+        setup_test_db()
+        with config.session_scope() as session:
+            frame = report.build(session)
+        self.assertEqual(len(frame), 0)
+        for writer in report.WRITERS.values():
+            writer(frame)
+        self.assertEqual(report.to_json(frame), '[]')
+
+
+class TestPriceIntervals(unittest.TestCase):
+    def place(self, intervals, day, price):
+        place_price(intervals, 1, datetime.date(2018, 1, day), price)
+        return [(i['valid_from'].day, i['valid_to'].day, i['price']) for i in intervals]
+
+    def test_extend(self):
+        intervals = []
+        self.assertEqual(self.place(intervals, 1, 10), [(1, 1, 10)])
+        self.assertEqual(self.place(intervals, 2, 10), [(1, 2, 10)])
+        # a missing day is not bridged
+        self.assertEqual(self.place(intervals, 4, 10), [(1, 2, 10), (4, 4, 10)])
+        self.assertEqual(self.place(intervals, 5, 10), [(1, 2, 10), (4, 5, 10)])
+        self.assertEqual(self.place(intervals, 6, 12), [(1, 2, 10), (4, 5, 10), (6, 6, 12)])
+
+    def test_split(self):
+        intervals = []
+        for day in range(1, 6):
+            self.place(intervals, day, 10)
+        self.assertEqual(self.place(intervals, 5, 10), [(1, 5, 10)])
+        self.assertEqual(self.place(intervals, 3, 12), [(1, 2, 10), (3, 3, 12), (4, 5, 10)])
+        self.assertEqual(self.place(intervals, 1, 9), [(1, 1, 9), (2, 2, 10), (3, 3, 12), (4, 5, 10)])
+        self.assertEqual(self.place(intervals, 3, 11), [(1, 1, 9), (2, 2, 10), (3, 3, 11), (4, 5, 10)])
+
+
+class TestQuery(unittest.TestCase):
+    def setUp(self):
+        setup_test_db()
+        with config.session_scope() as session:
+            part_id = session.query(Part.id).filter(Part.name == '紅蘿蔔').first()[0]
+            market_id = session.query(Market.id).filter(Market.name == '頂好').scalar()
+            daily = Product(name='紅蘿蔔', pid='1', market_id=market_id, part_id=part_id, weight=500, count=1)
+            interval = Product(name='履歷紅蘿蔔', pid='2', market_id=market_id, part_id=part_id, weight=1000,
+                               count=1)
+            session.add_all([daily, interval])
+            session.flush()
+            session.add_all([Price(product_id=daily.id, date=self.day(i), price=30) for i in (1, 2, 3)])
+            # the day the database switched to intervals, priced by both
+            session.add(PriceInterval(product_id=interval.id, valid_from=self.day(1), valid_to=self.day(5),
+                                      price=50))
+            session.add(Price(product_id=interval.id, date=self.day(5), price=50))
+
+    @staticmethod
+    def day(i):
+        return datetime.date(2018, 1, i)
+
+    def test_latest_prices(self):
+        with config.session_scope() as session:
+            rows = query.latest_prices(session, '紅蘿蔔', self.day(5))
+        self.assertEqual([(name, price, per_kg, date) for _, name, _, price, _, _, per_kg, date in rows], [
+            ('履歷紅蘿蔔', 50, 50.0, self.day(5)),
+            ('紅蘿蔔', 30, 60.0, self.day(3)),
+        ])
+
+    def test_price_series(self):
+        with config.session_scope() as session:
+            rows = query.price_series(session, '紅蘿蔔', self.day(2), self.day(5))
+        self.assertEqual([(date.day, name, price) for date, _, name, price, _ in rows], [
+            (2, '履歷紅蘿蔔', 50), (2, '紅蘿蔔', 30), (3, '履歷紅蘿蔔', 50), (3, '紅蘿蔔', 30),
+            (4, '履歷紅蘿蔔', 50), (5, '履歷紅蘿蔔', 50),
+        ])
+
+    @unittest.skipIf(report.pd is None, 'numpy and pandas are not installed')
+    def test_report(self):
+        with config.session_scope() as session:
+            frame = report.load(session, self.day(5), part_name='紅蘿蔔')
+        self.assertEqual(list(zip(frame['name'], frame['price'])), [('履歷紅蘿蔔', 50)])
+
+    def test_part_summary(self):
+        with config.session_scope() as session:
+            summary.rebuild(session, self.day(1), self.day(5))
+            rows = query.part_summary(session, '紅蘿蔔', self.day(3), self.day(5))
+        self.assertEqual([(date.day, market, products, low, high, mean) for
+                          date, market, products, low, _, high, mean, _, _, _, _ in rows], [
+            (3, '頂好', 2, 30, 50, 40.0), (4, '頂好', 1, 50, 50, 50.0), (5, '頂好', 1, 50, 50, 50.0),
+        ])
+
+
+class TestSummary(unittest.TestCase):
+    def test_statistics(self):
+        row = summary.statistics([39, 27, 29, 32], [39.0, 45.0, 48.0])
+        self.assertEqual(row['products'], 4)
+        self.assertEqual((row['min_price'], row['median_price'], row['max_price']), (27, 30.5, 39))
+        self.assertEqual(row['mean_price'], 31.75)
+        self.assertEqual((row['weighed'], row['median_per_kg'], row['mean_per_kg']), (3, 45.0, 44.0))
+
+    def test_unweighed(self):
+        row = summary.statistics([10], [])
+        self.assertEqual(row['weighed'], 0)
+        self.assertNotIn('median_per_kg', row)
+
+    def test_update_skips_missing_prices(self):
+        setup_test_db()
+        date = datetime.date(2018, 1, 1)
+        with config.session_scope() as session:
+            part_id = session.query(Part.id).filter(Part.name == '紅蘿蔔').first()[0]
+            market_id = session.query(Market.id).filter(Market.name == '頂好').scalar()
+            products = [Product(name='紅蘿蔔', pid=str(i), market_id=market_id, part_id=part_id, weight=500, count=1)
+                        for i in range(3)]
+            session.add_all(products)
+            session.flush()
+            session.add(Price(product_id=products[0].id, date=date, price=30))
+            session.add(Price(product_id=products[1].id, date=date, price=None))
+            session.add(PriceInterval(product_id=products[2].id, valid_from=date, valid_to=date, price=None))
+        with config.session_scope() as session:
+            self.assertEqual(summary.update(session, date), 1)
+            row = session.query(DailyPartSummary).one()
+            self.assertEqual((row.products, row.min_price, row.max_price), (1, 30, 30))
+
+
+class TestListing(unittest.TestCase):
+    def setUp(self):
+        setup_test_db()
+        self.browser = marketbrowser.WellcomeBrowser()
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'fixtures',
+                            'wellcome_listing.html')
+        with open(path, 'rb') as f:
+            self.page = html.fromstring(f.read())
+
+    def test_prices_of_single_items(self):
+        prefix = marketbrowser.WellcomeBrowser.INDEX_ROUTE
+        urls = self.browser.parse_listing(self.page, prefix)
+        self.assertEqual(sorted(url[len(prefix):] for url in urls), [
+            '/product/view/PAa1b', '/product/view/PBb2c', '/product/view/PLk2m', '/product/view/POOYb',
+            '/product/view/PQ3xa', '/product/view/PZr8c'
+        ])
+        # two prices, no price and a bundle of two products go to their product page
+        self.assertEqual(self.browser.listed, {
+            prefix + '/product/view/POOYb': 35,
+            prefix + '/product/view/PQ3xa': 1069,
+        })
+
+
+class TestParseProcesses(unittest.TestCase):
+    URL = 'https://sbd-ec.wellcome.com.tw/product/view/POOYb'
+
+    def setUp(self):
+        setup_test_db()
+        Directory.PRODUCTS.clear()
+        self.browser = marketbrowser.WellcomeBrowser()
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'fixtures', 'wellcome.html')
+        with open(path, 'rb') as f:
+            self.content = f.read()
+        # classes are patched, not the market sent to the parsing process
+        self.patched = [(cls, name, cls.__dict__.get(name)) for cls, name in (
+            (marketbrowser.WellcomeBrowser, 'config_generator'),
+            (marketbrowser.WellcomeBrowser, 'store'),
+            (marketbrowser.MarketBrowser, 'fetch_html'))]
+        self.stored = []
+        config_ = self.browser.configs[0]
+        marketbrowser.WellcomeBrowser.config_generator = lambda market: iter([(config_, [self.URL])])
+        marketbrowser.WellcomeBrowser.store = lambda market, config, product, price: self.stored.append(
+            Directory.to_record(product, price))
+        marketbrowser.MarketBrowser.fetch_html = staticmethod(lambda url, ttl=None: self.content)
+
+    def tearDown(self):
+        for cls, name, value in self.patched:
+            if value is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, value)
+        Directory.WRITER.close()
+
+    def test_same_record_as_threads(self):
+        product, price = self.browser.parse_product_price(self.URL, marketbrowser.MarketBrowser.parse_html(
+            self.content))
+        self.browser.direct(workers=1, processes=1)
+        self.assertEqual(self.stored, [Directory.to_record(product, price)])
+
+
+class TestRefresh(unittest.TestCase):
+    def setUp(self):
+        setup_test_db()
+        Directory.PRODUCTS.clear()
+        self.browser = marketbrowser.WellcomeBrowser()
+        with config.session_scope() as session:
+            part_id = session.query(Part.id).first()[0]
+        self.date = self.browser.date
+        self.product = Directory.set_product(self.new_product(part_id=part_id, weight=500,
+                                                              verified=self.date - datetime.timedelta(days=1)))
+
+    def tearDown(self):
+        Directory.WRITER.close()
+        Directory.PRODUCTS.clear()
+
+    def new_product(self, **kwargs):
+        return Product(name='紅蘿蔔', pid='POOYb', market_id=self.browser.market.id, count=1, **kwargs)
+
+    def test_updates_changed_fields(self):
+        self.browser.store(None, self.new_product(weight=1000), Price(price=35, date=self.date))
+        Directory.WRITER.flush()
+        with config.session_scope() as session:
+            product = session.query(Product).get(self.product.id)
+            self.assertEqual((product.weight, product.verified), (1000, self.date))
+        # read again by the next run, with the price of the day
+        Directory.PRODUCTS.clear()
+        marketbrowser.WellcomeBrowser()
+        found = Directory.PRODUCTS[(self.browser.market.id, 'POOYb')]
+        self.assertEqual((found[2], found[3][1], found[4]), (self.date, 1000, 35))
+
+    def test_suspicious_price(self):
+        self.browser.store(None, self.new_product(weight=500), Price(price=35, date=self.date))
+        self.assertEqual(self.browser.known_price('POOYb', 40).price, 40)
+        # more than SUSPICIOUS_RATIO away from the last price
+        self.assertIsNone(self.browser.known_price('POOYb', 60))
+        # no weight
+        self.browser.store(None, self.new_product(), Price(price=40, date=self.date))
+        self.assertIsNone(self.browser.known_price('POOYb', 40))
+
+
+class TestReferenceCache(unittest.TestCase):
+    def setUp(self):
+        setup_test_db()
+        references.invalidate()
+
+    def tearDown(self):
+        references.invalidate()
+
+    def test_flush_invalidates(self):
+        # loaded before the rows are added
+        self.assertIsNone(references.find('origin', '越南'))
+        self.assertIsNone(references.find('unit', '箱'))
+        with config.session_scope() as session:
+            session.add(Origin(name='越南'))
+            session.add(Unit(name='箱', level=4))
+            session.add(Unit(name='串', level=0))
+        self.assertIsNotNone(references.find('origin', '越南'))
+        units = references.units()
+        self.assertEqual(units[0].name, '箱')
+        self.assertEqual(units[-1].name, '串')
+        with config.session_scope() as session:
+            levels = dict((u.id, u.level) for u in session.query(Unit))
+        self.assertEqual([levels[u.id] for u in units], sorted(levels.values(), reverse=True))
+
+
+class TestClassificationMemo(unittest.TestCase):
+    def setUp(self):
+        setup_test_db()
+        classifications.invalidate()
+        with config.session_scope() as session:
+            self.config = session.query(Config).first()
+            self.part_id = self.config.parts[0].id
+            session.expunge_all()
+
+    def tearDown(self):
+        Directory.WRITER.close()
+        classifications.invalidate()
+
+    def remember(self, name, part_id, manual):
+        product = Product(name=name, part_id=part_id)
+        Directory.remember(self.config, product, manual=manual)
+
+    def classify(self, name):
+        product = Product(name=name)
+        if not Directory.classify_product_memo(self.config, product):
+            return False
+        return product.part_id
+
+    def stored(self):
+        with config.session_scope() as session:
+            return sorted((c.name, c.part_id, c.manual) for c in session.query(Classification))
+
+    def test_remember(self):
+        self.remember('履歷紅蘿蔔', self.part_id, manual=False)
+        # remembered once
+        self.remember('履歷紅蘿蔔', None, manual=True)
+        Directory.WRITER.flush()
+        self.assertEqual(self.stored(), [('履歷紅蘿蔔', self.part_id, False)])
+        # read back by the next run
+        classifications.invalidate()
+        self.assertEqual(self.classify('履歷紅蘿蔔'), self.part_id)
+        self.assertFalse(self.classify('洋蔥'))
+
+    def test_keywords_changed(self):
+        self.remember('a', self.part_id, manual=False)
+        self.remember('b', None, manual=True)
+        self.remember('c', self.part_id, manual=True)
+        Directory.WRITER.flush()
+        self.assertEqual(self.classify('a'), self.part_id)
+        with config.session_scope() as session:
+            session.add(Alias(name='履歷', part_id=self.part_id))
+        # automatic and given up names are matched again, a manual answer stays
+        self.assertEqual(self.stored(), [('c', self.part_id, True)])
+        self.assertFalse(self.classify('a'))
+        self.assertFalse(self.classify('b'))
+        self.assertEqual(self.classify('c'), self.part_id)
+
+    def test_part_deleted(self):
+        with config.session_scope() as session:
+            part = Part(name='測試', config_id=self.config.id)
+            session.add(part)
+            session.flush()
+            part_id = part.id
+        self.remember('d', part_id, manual=True)
+        self.remember('c', self.part_id, manual=True)
+        Directory.WRITER.flush()
+        with config.session_scope() as session:
+            session.delete(session.query(Part).get(part_id))
+        self.assertEqual(self.stored(), [('c', self.part_id, True)])
+        self.assertFalse(self.classify('d'))
+
+
+class TestStack(unittest.TestCase):
+    def setUp(self):
+        setup_test_db()
+        classifications.invalidate()
+        Directory.PRODUCTS.clear()
+        with config.session_scope() as session:
+            self.config = session.query(Config).first()
+            self.part_id = self.config.parts[0].id
+            self.market_id = session.query(Market.id).first()[0]
+            session.expunge_all()
+        self.date = datetime.date(2018, 12, 1)
+        fd, Directory.MANUAL_PATH = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+
+    def tearDown(self):
+        Directory.WRITER.close()
+        Directory.PRODUCTS.clear()
+        Directory.MANUAL_PATH = None
+        classifications.invalidate()
+
+    def record(self, pid, name, price):
+        product = Product(name=name, pid=pid, market_id=self.market_id, count=1, weight=500)
+        record = Directory.to_record(product, Price(price=price, date=self.date))
+        record['date'] = record['date'].isoformat()
+        record['config_id'] = self.config.id
+        return json.dumps(record, ensure_ascii=False) + '\n'
+
+    def test_replay_after_crash(self):
+        # the spill file of a run that crashed before clear_stack
+        Directory.set_product(Product(name='已存', pid='1', market_id=self.market_id, part_id=self.part_id))
+        Directory.remember(self.config, Product(name='記得', part_id=self.part_id), manual=True)
+        Directory.WRITER.flush()
+        classifications.invalidate()
+        with io.open(Directory.MANUAL_PATH, 'w', encoding='utf-8') as f:
+            f.write(self.record('1', '已存', 10))
+            f.write(self.record('2', '記得', 20))
+            f.write(self.record('3', '放棄', 30))
+
+        asked = []
+
+        def manual(config, product):
+            asked.append(product.name)
+            return product
+
+        classify_product_manual = Directory.classify_product_manual
+        Directory.classify_product_manual = staticmethod(manual)
+        try:
+            Directory.clear_stack()
+        finally:
+            Directory.classify_product_manual = classify_product_manual
+
+        # stored products are skipped, memoized names need no answer
+        self.assertEqual(asked, ['放棄'])
+        self.assertFalse(os.path.exists(Directory.MANUAL_PATH))
+        with config.session_scope() as session:
+            self.assertEqual(sorted(session.query(Product.pid, Product.part_id)),
+                             [('1', self.part_id), ('2', self.part_id), ('3', None)])
+            self.assertEqual(session.query(Price.price).join(Product).filter(Product.pid == '2').all(), [(20,)])
+            self.assertEqual(session.query(Price).count(), 1)
+            self.assertEqual(session.query(DailyPartSummary.products).filter(
+                DailyPartSummary.date == self.date).all(), [(1,)])
+
+
+class TestCarrfourInfos(unittest.TestCase):
+    def setUp(self):
+        setup_test_db()
+        Directory.PRODUCTS.clear()
+        marketapi.CarrfourBrowser.INFOS.clear()
+        self.market = marketapi.CarrfourBrowser()
+        self.fetched = []
+        self.get_infos = marketapi.CarrfourBrowser.get_infos
+
+        def get_infos(url, ttl=None):
+            self.fetched.append((url, ttl))
+            # slow enough for the other threads to ask for the same page
+            time.sleep(0.2)
+            return '臺灣', '500g', ''
+
+        marketapi.CarrfourBrowser.get_infos = staticmethod(get_infos)
+
+    def tearDown(self):
+        marketapi.CarrfourBrowser.get_infos = self.get_infos
+        marketapi.CarrfourBrowser.INFOS.clear()
+        Directory.WRITER.close()
+        Directory.PRODUCTS.clear()
+
+    def dic(self, id, price=50, page='/carrot'):
+        return {'Id': id, 'Name': '紅蘿蔔500g', 'Price': price, 'ItemQtyPerPack': 1, 'SeName': page}
+
+    def test_enrich_fetches_a_page_once(self):
+        # different ids of the same page, none memoized yet
+        infos = self.market.enrich([self.dic(i) for i in range(4)])
+        self.assertEqual(sorted(infos), [0, 1, 2, 3])
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual(marketapi.CarrfourBrowser.INFOS_INFLIGHT, {})
+
+    def test_infos_expire(self):
+        ttl = marketapi.CarrfourBrowser.INFOS_TTL
+        infos = marketapi.CarrfourBrowser.INFOS
+        infos[1] = (time.time(), ('日本', '', ''))
+        infos[2] = (time.time() - ttl - 1, ('日本', '', ''))
+        result = self.market.enrich([self.dic(1), self.dic(2)])
+        self.assertEqual(result, {1: ('日本', '', ''), 2: ('臺灣', '500g', '')})
+        self.assertEqual([ttl for _, ttl in self.fetched], [ttl])
+
+    def test_known_products(self):
+        with config.session_scope() as session:
+            part_id = session.query(Part.id).first()[0]
+        date = self.market.date
+
+        def product(pid, days):
+            Directory.set_product(Product(name='紅蘿蔔', pid=pid, market_id=self.market.market.id, count=1,
+                                          weight=500, part_id=part_id, verified=date - datetime.timedelta(days=days)))
+
+        product('1', 1)
+        product('2', Directory.REFRESH_DAYS)
+        marketapi.CarrfourBrowser.INFOS[2] = (time.time(), ('日本', '', ''))
+        self.market.api = lambda category_id, size: [self.dic(1, 45, '/1'), self.dic(2, 50, '/2'),
+                                                     self.dic(3, 50, '/3')]
+
+        results = self.market.get_products_prices(('215', 15))
+        # verified lately, the listing price is enough
+        product_id = Directory.PRODUCTS[(self.market.market.id, '1')][0]
+        self.assertIsNone(results[0][0])
+        self.assertEqual((results[0][1].product_id, results[0][1].price), (product_id, 45))
+        # due for refresh, not from the memo nor the disk cache, and new
+        origin_id = Directory.get_origin('臺灣').id
+        self.assertEqual([(r[0].pid, r[0].origin_id) for r in results[1:]], [('2', origin_id), ('3', origin_id)])
+        self.assertEqual(sorted(self.fetched), [
+            (marketapi.CarrfourBrowser.INDEX_ROUTE + '/2', 0),
+            (marketapi.CarrfourBrowser.INDEX_ROUTE + '/3', marketapi.CarrfourBrowser.INFOS_TTL),
+        ])
+
+
+class TestSQLAlchemyHandler(unittest.TestCase):
+    def setUp(self):
+        setup_test_db()
+        self.handler = SQLAlchemyHandler(capacity=3, interval=3600)
+        self.logger = logging.getLogger('msrptw.test.handler')
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+    def rows(self):
+        with config.session_scope() as session:
+            return [(log.level, log.msg) for log in session.query(Log).order_by(Log.id)]
+
+    def test_batches(self):
+        for i in range(5):
+            self.logger.warning('w%s', i)
+        # a full batch is written without waiting for the interval
+        for _ in range(50):
+            if self.rows():
+                break
+            time.sleep(0.05)
+        self.assertEqual([msg for _, msg in self.rows()], ['w0', 'w1', 'w2'])
+        self.handler.flush()
+        self.assertEqual(len(self.rows()), 5)
+
+    def test_rate_limit(self):
+        for _ in range(4):
+            self.logger.error('boom')
+        self.logger.error('other')
+        self.handler.flush()
+        # the repeats of the last window are reported by flush
+        self.assertEqual(self.rows(), [
+            ('ERROR', 'boom'), ('ERROR', 'other'), ('ERROR', SQLAlchemyHandler.SUPPRESSED % ('boom', 60, 3))
+        ])
+        self.logger.error('boom')
+        self.handler.close()
+        self.assertEqual(self.rows()[-1], ('ERROR', SQLAlchemyHandler.SUPPRESSED % ('boom', 60, 1)))
+
+    def test_retention(self):
+        with config.session_scope() as session:
+            old = Log(logger='old', level='INFO', msg='old')
+            old.datetime = datetime.datetime.now() - datetime.timedelta(days=10)
+            session.add(old)
+        self.handler.retention_days = 7
+        self.logger.warning('new')
+        self.handler.flush()
+        self.assertEqual(self.rows(), [('WARNING', 'new')])
+
+    def test_held_without_engine(self):
+        engine, config.engine = config.engine, None
+        try:
+            self.logger.warning('early')
+            self.handler.flush()
+        finally:
+            config.engine = engine
+        self.assertEqual(self.rows(), [])
+        self.handler.flush()
+        self.assertEqual(self.rows(), [('WARNING', 'early')])
+
+
+@unittest.skipIf(sqlite3.sqlite_version_info < (3, 35), 'sqlite drops columns since 3.35')
+class TestMigrate(unittest.TestCase):
+    # tables and columns added since the first release, whose tables had no index
+    NEW_TABLES = ['classification', 'price_interval', 'daily_part_summary']
+    NEW_COLUMNS = [('product', 'verified')]
+
+    def setUp(self):
+        config.setup_session('sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'old.db'))
+        metadata = Market.metadata
+        metadata.create_all(config.engine, tables=[table for table in metadata.sorted_tables
+                                                   if table.name not in self.NEW_TABLES])
+        for table in metadata.sorted_tables:
+            for index in table.indexes:
+                config.engine.execute('DROP INDEX IF EXISTS %s' % index.name)
+        for table, column in self.NEW_COLUMNS:
+            config.engine.execute('ALTER TABLE %s DROP COLUMN %s' % (table, column))
+        config.engine.execute("INSERT INTO product (id, name, pid) VALUES (1, 'a', '1')")
+        self.statements = []
+        event.listen(config.engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('CREATE', 'ALTER', 'DROP')):
+            self.statements.append(statement)
+
+    def test_migrate(self):
+        config.engine.execute("INSERT INTO price (product_id, date, price) VALUES (1, '2018-01-01', 10)")
+        config.migrate()
+        self.assertTrue(self.statements)
+        inspector = sqlalchemy.inspect(config.engine)
+        for table in Market.metadata.sorted_tables:
+            self.assertEqual(set(column['name'] for column in inspector.get_columns(table.name)),
+                             set(column.name for column in table.columns))
+            self.assertEqual(set(index['name'] for index in inspector.get_indexes(table.name)),
+                             set(index.name for index in table.indexes))
+        with config.session_scope() as session:
+            self.assertEqual(session.query(Price.price).all(), [(10,)])
+
+        # nothing left to do
+        del self.statements[:]
+        config.migrate()
+        self.assertEqual(self.statements, [])
+
+    def test_duplicate_prices(self):
+        for price in (10, 11):
+            config.engine.execute("INSERT INTO price (product_id, date, price) VALUES (1, '2018-01-01', %s)" % price)
+        with self.assertRaises(config.MigrationError) as raised:
+            config.migrate()
+        self.assertIn('ix_price_product_date', str(raised.exception))
+        self.assertIn('(1, 2018-01-01)', str(raised.exception))
+
+
+class TestParallelMarkets(unittest.TestCase):
+    def test_same_market_in_turn(self):
+        runs = []
+        lock = threading.Lock()
+
+        def market(name):
+            class StubMarket(object):
+                NAME = name
+
+                def direct(self, workers=None):
+                    start = time.time()
+                    time.sleep(0.1)
+                    with lock:
+                        runs.append((self.NAME, start, time.time()))
+            return StubMarket
+
+        carrefour, carrefour_browser, rtmart = market('家樂福'), market('家樂福'), market('大潤發')
+        self.assertEqual(builder.market_groups([carrefour, rtmart, carrefour_browser]),
+                         [[carrefour, carrefour_browser], [rtmart]])
+
+        markets = builder.MARKETS
+        builder.MARKETS = [carrefour, rtmart, carrefour_browser]
+        try:
+            builder.build('sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'test.db'), True, parallel_markets=3)
+        finally:
+            builder.MARKETS = markets
+        runs = dict((name, [(start, end) for n, start, end in runs if n == name]) for name in ('家樂福', '大潤發'))
+        (first, first_end), (second, _) = sorted(runs['家樂福'])
+        # one market after the other, another market alongside
+        self.assertGreaterEqual(second, first_end)
+        self.assertLess(runs['大潤發'][0][0], first_end)
+
+
+class TestWriter(unittest.TestCase):
+    def setUp(self):
+        setup_test_db()
+        with config.session_scope() as session:
+            self.market_id = session.query(Market.id).first()[0]
+        self.lost = []
+        self.writer = Writer(interval=3600, on_lost=self.lost.extend)
+        self.date = datetime.date(2018, 12, 1)
+
+    def tearDown(self):
+        self.writer.close()
+
+    def product(self, pid):
+        return Product(name=pid, pid=pid, market_id=self.market_id, count=1)
+
+    def stored(self):
+        with config.session_scope() as session:
+            return sorted(session.query(Product.pid, Price.price).join(Price, Price.product_id == Product.id))
+
+    def test_group_commit(self):
+        ids = [self.writer.insert_product(self.product('P%s' % i)).id for i in range(3)]
+        for i, id in enumerate(ids):
+            self.writer.put_price(id, self.date, 10 + i)
+        # the same day again, the last price wins
+        self.writer.put_price(ids[0], self.date, 9)
+        self.writer.flush()
+        self.assertEqual(self.stored(), [('P0', 9), ('P1', 11), ('P2', 12)])
+        self.assertEqual(self.writer.metrics()['rows'], 3)
+
+    def test_failed_insert_keeps_group(self):
+        a = self.writer.insert_product(self.product('A'))
+        self.writer.put_price(a.id, self.date, 10)
+        # same market and pid as A
+        with self.assertRaises(Exception):
+            self.writer.insert_product(self.product('A'))
+        c = self.writer.insert_product(self.product('C'))
+        self.assertNotEqual(a.id, c.id)
+        self.writer.put_price(c.id, self.date, 20)
+        self.writer.flush()
+        self.assertEqual(self.stored(), [('A', 10), ('C', 20)])
+        self.assertEqual(self.lost, [])
+
+    def test_failed_commit(self):
+        a = self.writer.insert_product(self.product('A'))
+        self.writer.flush()
+        b = self.writer.insert_product(self.product('B'))
+        self.writer.put_price(a.id, self.date, 10)
+        self.writer.put_price(b.id, self.date, 20)
+
+        # the connection drops once before the group commits
+        get_session = self.writer.get_session
+        failures = [Exception('connection lost')]
+
+        def failing_session():
+            if failures:
+                raise failures.pop()
+            return get_session()
+
+        self.writer.get_session = failing_session
+        self.writer.flush()
+        # B is gone with the rollback, A's price was put back and committed
+        self.assertEqual(self.lost, [b.id])
+        self.writer.flush()
+        self.assertEqual(self.stored(), [('A', 10)])
+        # rows still queued for B are dropped
+        self.writer.put_price(b.id, self.date + datetime.timedelta(days=1), 20)
+        self.writer.flush()
+        self.assertEqual(self.stored(), [('A', 10)])
+
+
 class TestDB(unittest.TestCase):
     def setUp(self):
 